@@ -0,0 +1,7 @@
+import os
+
+
+def default_channel_ids():
+    """Каналы по умолчанию из CHANNEL_ID (через запятую: основной канал и зеркала)"""
+    raw = os.getenv('CHANNEL_ID') or ''
+    return [chat_id.strip() for chat_id in raw.split(',') if chat_id.strip()]
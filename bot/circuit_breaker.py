@@ -0,0 +1,54 @@
+import time
+import logging
+
+CLOSED, OPEN = 'closed', 'open'
+
+
+class CircuitBreaker:
+    """Предохранитель для внешней зависимости (базы данных)
+
+    После failure_threshold ошибок подряд цепь размыкается: вызовы сразу получают
+    отказ, не дожидаясь таймаутов. Раз в reset_timeout секунд один вызов проходит
+    пробой; если он удался — цепь замыкается и работа продолжается как обычно.
+    """
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=10.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.logger = logging.getLogger(__name__)
+        self.state = CLOSED
+        self._failures = 0
+        self._probe_at = 0.0
+
+    @property
+    def is_open(self):
+        return self.state == OPEN
+
+    def allow(self):
+        """Можно ли выполнить вызов; в разомкнутом состоянии пропускает редкие пробы"""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if now >= self._probe_at:
+            self._probe_at = now + self.reset_timeout
+            return True
+        return False
+
+    def record_success(self):
+        self._failures = 0
+        if self.state == OPEN:
+            self.state = CLOSED
+            self.logger.warning(f"✅ {self.name}: снова доступна, цепь замкнута")
+
+    def record_failure(self):
+        self._failures += 1
+        if self.state == OPEN:
+            # Проба не удалась — следующая через reset_timeout
+            self._probe_at = time.monotonic() + self.reset_timeout
+        elif self._failures >= self.failure_threshold:
+            self.state = OPEN
+            self._probe_at = time.monotonic() + self.reset_timeout
+            self.logger.error(
+                f"❌ {self.name}: {self._failures} ошибок подряд, цепь разомкнута на {self.reset_timeout:.0f} c"
+            )
@@ -1,11 +1,139 @@
-from sqlalchemy import create_engine, and_, or_
-from sqlalchemy.orm import sessionmaker, joinedload
-from .models import Base, User, GameAnnouncement, GameRegistration, Admin, RecurringGameTemplate, FrequencyType
+from sqlalchemy import create_engine, and_, or_, select, exists, literal, insert, update, func, text, bindparam, tuple_, cast, Integer, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert, JSONB
+from sqlalchemy.orm import sessionmaker, joinedload, contains_eager, aliased
+from .models import Base, User, GameAnnouncement, GameRegistration, Admin, RecurringGameTemplate, FrequencyType, AnnouncementTemplate, OutboxEvent, ChannelTarget, ChannelMessage, LotteryEntry, TemplateSubscription, Notification, ConversationState, UserDataEntry, SchemaVersion
+from .query_budget import install_query_counter
+from .channels import default_channel_ids
+from .nicknames import normalize_nickname, NicknameTaken, HOMOGLYPHS
+from .circuit_breaker import CircuitBreaker
+from .db_pool import pool_options
+from .replicas import Replica, replica_urls, pin_to_primary, pinned_to_primary, is_write
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError, TimeoutError as PoolTimeoutError
+from collections import OrderedDict
+from contextvars import ContextVar
 from datetime import datetime, timedelta
 import os
+import random
+import hashlib
+import logging
+
+# normalize_nickname на SQL (для пересчета ключей ников уже сохраненных пользователей)
+_NICKNAME_KEY_SQL = (
+    "translate(lower(regexp_replace(trim(normalize(game_nickname, NFKC)), '\\s+', ' ', 'g')), "
+    f"'{''.join(HOMOGLYPHS)}', '{''.join(HOMOGLYPHS.values())}')"
+)
+
+# Колонки, добавленные в уже существующие таблицы: create_all их не создает
+SCHEMA_UPGRADES = [
+    "ALTER TABLE game_announcements ADD COLUMN IF NOT EXISTS registration_mode VARCHAR(20) DEFAULT 'fcfs'",
+    "ALTER TABLE game_announcements ADD COLUMN IF NOT EXISTS lottery_window_minutes INTEGER",
+    "ALTER TABLE game_announcements ADD COLUMN IF NOT EXISTS lottery_weighted BOOLEAN DEFAULT false",
+    "ALTER TABLE game_announcements ADD COLUMN IF NOT EXISTS lottery_closes_at TIMESTAMP",
+    "ALTER TABLE game_announcements ADD COLUMN IF NOT EXISTS lottery_drawn_at TIMESTAMP",
+    "ALTER TABLE recurring_game_templates ADD COLUMN IF NOT EXISTS registration_mode VARCHAR(20) DEFAULT 'fcfs'",
+    "ALTER TABLE recurring_game_templates ADD COLUMN IF NOT EXISTS lottery_window_minutes INTEGER",
+    "ALTER TABLE recurring_game_templates ADD COLUMN IF NOT EXISTS lottery_weighted BOOLEAN DEFAULT false",
+    "ALTER TABLE game_announcements ADD COLUMN IF NOT EXISTS queue_seq INTEGER DEFAULT 0",
+    "ALTER TABLE game_registrations ADD COLUMN IF NOT EXISTS queue_position INTEGER",
+    """UPDATE game_registrations r SET queue_position = ranked.rn
+       FROM (SELECT id, row_number() OVER (PARTITION BY game_id ORDER BY is_reserve, registered_at, id) AS rn
+             FROM game_registrations WHERE queue_position IS NULL) AS ranked
+       WHERE r.id = ranked.id""",
+    """UPDATE game_announcements g SET queue_seq = q.max_position
+       FROM (SELECT game_id, max(queue_position) AS max_position FROM game_registrations GROUP BY game_id) AS q
+       WHERE g.id = q.game_id AND coalesce(g.queue_seq, 0) < q.max_position""",
+    "CREATE INDEX IF NOT EXISTS ix_game_registrations_queue ON game_registrations (game_id, is_reserve, queue_position)",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS nickname_key VARCHAR(100)",
+    # Ключи, посчитанные по старым правилам нормализации, пересчитываются следующим шагом
+    f"""UPDATE users SET nickname_key = NULL
+        WHERE nickname_key IS NOT NULL AND nickname_key <> {_NICKNAME_KEY_SQL}""",
+    # Старые дубли ника (с точностью до нормализации) остаются без ключа у всех, кроме первого
+    f"""UPDATE users u SET nickname_key = ranked.nickname_key
+        FROM (SELECT id, {_NICKNAME_KEY_SQL} AS nickname_key,
+                     row_number() OVER (PARTITION BY {_NICKNAME_KEY_SQL} ORDER BY id) AS rn
+              FROM users) AS ranked
+        WHERE u.id = ranked.id AND ranked.rn = 1 AND u.nickname_key IS NULL
+          AND NOT EXISTS (SELECT 1 FROM users taken WHERE taken.nickname_key = ranked.nickname_key)""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_users_nickname_key ON users (nickname_key)",
+    # Записи удаляются вместе с игрой средствами БД (passive_deletes): create_all не меняет
+    # внешний ключ в уже созданной таблице, поэтому он пересоздается с ON DELETE CASCADE
+    """DO $$
+       DECLARE
+           fk record;
+           replaced boolean := false;
+       BEGIN
+           FOR fk IN
+               SELECT c.conname
+               FROM pg_constraint c
+               JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY (c.conkey)
+               WHERE c.contype = 'f'
+                 AND c.conrelid = 'game_registrations'::regclass
+                 AND c.confrelid = 'game_announcements'::regclass
+                 AND a.attname = 'game_id'
+                 AND c.confdeltype <> 'c'
+           LOOP
+               EXECUTE format('ALTER TABLE game_registrations DROP CONSTRAINT %I', fk.conname);
+               replaced := true;
+           END LOOP;
+           IF replaced THEN
+               ALTER TABLE game_registrations ADD CONSTRAINT game_registrations_game_id_fkey
+                   FOREIGN KEY (game_id) REFERENCES game_announcements (id) ON DELETE CASCADE;
+           END IF;
+       END $$""",
+    # Одна запись игрока на игру: старые дубли (кроме самой ранней записи) удаляются
+    """DO $$
+       BEGIN
+           IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_game_registrations_game_user') THEN
+               DELETE FROM game_registrations r
+               USING game_registrations earlier
+               WHERE earlier.game_id = r.game_id AND earlier.user_id = r.user_id AND earlier.id < r.id;
+               ALTER TABLE game_registrations
+                   ADD CONSTRAINT uq_game_registrations_game_user UNIQUE (game_id, user_id);
+           END IF;
+       END $$""",
+]
+
+
+def schema_fingerprint():
+    """Отпечаток схемы кода: таблицы, колонки, индексы, ограничения и SCHEMA_UPGRADES"""
+    digest = hashlib.sha256()
+    for table in sorted(Base.metadata.tables.values(), key=lambda t: t.name):
+        digest.update(table.name.encode())
+        for column in table.columns:
+            digest.update(f"{column.name}:{column.type}:{column.nullable}".encode())
+        for index in sorted(table.indexes, key=lambda i: i.name or ''):
+            digest.update(f"ix:{index.name}:{index.unique}".encode())
+        for constraint in sorted(table.constraints, key=lambda c: c.name or ''):
+            digest.update(f"c:{constraint.name}".encode())
+    for statement in SCHEMA_UPGRADES:
+        digest.update(statement.encode())
+    return digest.hexdigest()
+
+
+# Чтения, которые при недоступной базе отдают последний удачный результат:
+# /games, /profile и отрисовка анонсов для канала
+DEGRADED_READS = (
+    'get_user', 'get_active_games', 'get_registrations_for_games',
+    'get_game_by_id', 'get_game_registrations', 'get_channel_messages',
+)
+
+
+# Чтения, которые могут идти на реплики (списки игр и записей, статистика)
+REPLICA_READS = (
+    'get_active_games', 'get_all_games', 'get_game_registrations', 'get_registrations_for_games',
+    'get_user_registrations', 'get_all_users', 'get_registered_users',
+)
+
+# Реплика, выбранная для текущего чтения (см. Database._with_replica)
+_read_replica = ContextVar('read_replica', default=None)
+
+
+class DatabaseUnavailable(Exception):
+    """База недоступна: истек таймаут, пропало соединение или разомкнут предохранитель"""
 
 class Database:
-    def __init__(self):
+    def __init__(self, database_url=None):
         self.db_name = os.getenv('DB_NAME')
         self.db_user = os.getenv('DB_USER')
         self.db_password = os.getenv('DB_PASSWORD')
@@ -20,25 +148,276 @@ class Database:
         safe_password = self.db_password or ''
         display_password = '***' if safe_password else 'NO_PASSWORD'
         
-        self.database_url = f"postgresql://{self.db_user}:{safe_password}@{self.db_host}:{self.db_port}/{self.db_name}"
+        self.database_url = database_url or f"postgresql://{self.db_user}:{safe_password}@{self.db_host}:{self.db_port}/{self.db_name}"
         safe_database_url = f"postgresql://{self.db_user}:{display_password}@{self.db_host}:{self.db_port}/{self.db_name}"
+        if database_url:
+            safe_database_url = database_url.split('@')[-1]
         print(f"🔗 Подключаемся к БД: {safe_database_url}")
         
         try:
-            self.engine = create_engine(self.database_url)
+            self.engine = self._create_engine(self.database_url)
+            self.breaker = CircuitBreaker(
+                'База данных',
+                failure_threshold=int(os.getenv('DB_BREAKER_FAILURES', '3')),
+                reset_timeout=float(os.getenv('DB_BREAKER_RESET_SECONDS', '10')),
+            )
+            self._install_replicas()
+            self._install_breaker()
             self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+            # За сколько часов до игры напоминать записавшимся (0 — не напоминать)
+            self.reminder_hours = float(os.getenv('REMINDER_HOURS', '3'))
         except Exception as e:
             print(f"❌ Ошибка подключения к БД: {e}")
             raise
         
+    def _create_engine(self, url):
+        """Движок с пулом из окружения и таймаутами (для основной базы и реплик)"""
+        # Таймауты: зависшая база не должна держать обработчики бесконечно
+        engine = create_engine(
+            url,
+            **pool_options(),
+            connect_args={
+                'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '5')),
+                'options': (
+                    f"-c statement_timeout={int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '5000'))} "
+                    f"-c lock_timeout={int(os.getenv('DB_LOCK_TIMEOUT_MS', '3000'))}"
+                ),
+            },
+        )
+        install_query_counter(engine)
+        return engine
+
     def init_db(self):
         """Инициализация базы данных, создание таблиц"""
         Base.metadata.create_all(bind=self.engine)
+        self._upgrade_schema()
+        self._backfill_channel_messages()
+        self._store_schema_fingerprint()
         print("✅ База данных инициализирована")
+
+    def ensure_schema(self, fast=False):
+        """Схема для запуска: при быстром старте — только сверка отпечатка
+
+        Если отпечаток в базе совпадает с моделями, create_all и переносы данных
+        пропускаются; иначе (новая база, новые колонки) выполняется полный init_db.
+        Возвращает True, если понадобился init_db.
+        """
+        if fast and self.schema_is_current():
+            return False
+        self.init_db()
+        return True
+
+    def schema_is_current(self):
+        """Совпадает ли схема базы с моделями: один запрос вместо отражения всех таблиц"""
+        try:
+            with self.engine.connect() as conn:
+                stored = conn.execute(
+                    select(SchemaVersion.fingerprint).where(SchemaVersion.id == 1)
+                ).scalar()
+        except ProgrammingError:
+            # Таблицы schema_version еще нет — база старше быстрого старта
+            return False
+        return stored == schema_fingerprint()
+
+    def _store_schema_fingerprint(self):
+        fingerprint = schema_fingerprint()
+        with self.engine.begin() as conn:
+            conn.execute(
+                pg_insert(SchemaVersion).values(id=1, fingerprint=fingerprint, applied_at=datetime.utcnow())
+                .on_conflict_do_update(
+                    index_elements=[SchemaVersion.id],
+                    set_={'fingerprint': fingerprint, 'applied_at': datetime.utcnow()}
+                )
+            )
+
+    def _upgrade_schema(self):
+        """Добавление новых колонок в таблицы, созданные старыми версиями бота"""
+        with self.engine.begin() as conn:
+            # Переносы данных на больших таблицах дольше обычного statement_timeout
+            conn.execute(text("SET LOCAL statement_timeout = 0"))
+            for statement in SCHEMA_UPGRADES:
+                conn.execute(text(statement))
+
+    def _backfill_channel_messages(self):
+        """Перенос channel_message_id старых анонсов в channel_messages (первый канал из CHANNEL_ID)"""
+        channels = default_channel_ids()
+        if not channels:
+            return
+        session = self.get_session()
+        try:
+            legacy = select(
+                GameAnnouncement.id,
+                literal(channels[0]),
+                GameAnnouncement.channel_message_id
+            ).where(
+                GameAnnouncement.channel_message_id.isnot(None),
+                ~exists().where(ChannelMessage.game_id == GameAnnouncement.id)
+            )
+            session.execute(
+                pg_insert(ChannelMessage).from_select(['game_id', 'chat_id', 'message_id'], legacy)
+                .on_conflict_do_nothing(constraint='uq_channel_messages_game_chat')
+            )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
     
     def get_session(self):
-        """Получение сессии базы данных"""
+        """Получение сессии базы данных (при разомкнутом предохранителе — сразу отказ)"""
+        if not self.breaker.allow():
+            raise DatabaseUnavailable("База данных временно недоступна")
+        return self.SessionLocal()
+
+    def get_read_session(self):
+        """Сессия для чтения: реплика, выбранная в _with_replica, иначе основная база"""
+        replica = _read_replica.get()
+        if replica is not None:
+            return replica.SessionLocal()
+        if not self.breaker.allow():
+            raise DatabaseUnavailable("База данных временно недоступна")
         return self.SessionLocal()
+
+    def _install_replicas(self):
+        """Чтения из REPLICA_READS — на реплики из DB_REPLICA_URLS, если они заданы
+
+        Реплика выбирается по кругу среди не отставших больше DB_REPLICA_MAX_LAG.
+        После любой записи в основную базу чтения той же задачи (ответ на апдейт,
+        проход воркера) DB_READ_YOUR_WRITES_SECONDS идут на основную базу, чтобы
+        пользователь сразу видел свою запись. Ошибка реплики повторяется на основной.
+        """
+        self.replicas = [
+            Replica(
+                engine,
+                sessionmaker(autocommit=False, autoflush=False, bind=engine),
+                max_lag=float(os.getenv('DB_REPLICA_MAX_LAG', '5')),
+                check_interval=float(os.getenv('DB_REPLICA_LAG_CHECK_SECONDS', '2')),
+                retry_seconds=float(os.getenv('DB_REPLICA_RETRY_SECONDS', '30')),
+            )
+            for engine in (self._create_engine(url) for url in replica_urls())
+        ]
+        if not self.replicas:
+            return
+        self._replica_turn = 0
+        pin_seconds = float(os.getenv('DB_READ_YOUR_WRITES_SECONDS', '10'))
+
+        @event.listens_for(self.engine, 'after_cursor_execute')
+        def _on_write(conn, cursor, statement, parameters, context, executemany):
+            if is_write(statement, context):
+                pin_to_primary(pin_seconds)
+
+        for name in REPLICA_READS:
+            setattr(self, name, self._with_replica(getattr(self, name)))
+        print(f"📚 Реплик для чтения: {len(self.replicas)}")
+
+    def _pick_replica(self):
+        if pinned_to_primary():
+            return None
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self._replica_turn % len(self.replicas)]
+            self._replica_turn += 1
+            if replica.available():
+                return replica
+        return None
+
+    def _with_replica(self, read):
+        def wrapper(*args, **kwargs):
+            replica = self._pick_replica()
+            if replica is None:
+                return read(*args, **kwargs)
+            token = _read_replica.set(replica)
+            try:
+                return read(*args, **kwargs)
+            except (OperationalError, PoolTimeoutError) as e:
+                replica.mark_down(e)
+            finally:
+                _read_replica.reset(token)
+            return read(*args, **kwargs)
+
+        wrapper.__name__ = read.__name__
+        wrapper.__doc__ = read.__doc__
+        return wrapper
+
+    def warm_pool(self, connections=None):
+        """Открытие соединений заранее, чтобы первые запросы не платили за подключение
+
+        Соединения берутся одновременно (иначе пул вернет одно и то же) и сразу
+        возвращаются. Возвращает число открытых соединений.
+        """
+        connections = connections or self.engine.pool.size()
+        opened = []
+        try:
+            for _ in range(connections):
+                conn = self.engine.connect()
+                opened.append(conn)
+                conn.execute(text("SELECT 1"))
+        finally:
+            for conn in opened:
+                conn.close()
+        return len(opened)
+
+    def pool_stats(self):
+        """Метрики пула соединений (см. InstrumentedQueuePool.stats)"""
+        return self.engine.pool.stats()
+
+    @property
+    def degraded(self):
+        """Режим только для чтения из снимков: база недоступна"""
+        return self.breaker.is_open
+
+    def _install_breaker(self):
+        """Учет ошибок базы в предохранителе и снимки чтений для деградированного режима
+
+        Удачный запрос замыкает цепь, обрыв соединения или таймаут считаются отказом
+        и превращаются в DatabaseUnavailable. Чтения из DEGRADED_READS запоминают
+        последний результат и отдают его, пока база недоступна.
+        """
+        breaker = self.breaker
+
+        @event.listens_for(self.engine, 'after_cursor_execute')
+        def _on_success(conn, cursor, statement, parameters, context, executemany):
+            breaker.record_success()
+
+        @event.listens_for(self.engine, 'handle_error')
+        def _on_error(context):
+            # Отказ базы — обрыв, неудачное подключение или statement_timeout (57014);
+            # дедлоки и прочие ошибки запросов предохранитель не трогают
+            timed_out = getattr(context.original_exception, 'pgcode', None) == '57014'
+            connect_failed = context.connection is None and isinstance(context.sqlalchemy_exception, OperationalError)
+            if context.is_disconnect or connect_failed or timed_out:
+                breaker.record_failure()
+                return DatabaseUnavailable(str(context.original_exception).strip())
+
+        self._read_snapshots = OrderedDict()
+        self._max_read_snapshots = int(os.getenv('DB_SNAPSHOT_CACHE_SIZE', '10000'))
+        for name in DEGRADED_READS:
+            setattr(self, name, self._with_snapshot(name, getattr(self, name)))
+
+    def _with_snapshot(self, name, read):
+        logger = logging.getLogger(__name__)
+
+        def wrapper(*args, **kwargs):
+            key = (name, tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args),
+                   tuple(sorted(kwargs.items())))
+            try:
+                result = read(*args, **kwargs)
+            except (DatabaseUnavailable, PoolTimeoutError) as e:
+                if isinstance(e, PoolTimeoutError):
+                    self.breaker.record_failure()
+                if key not in self._read_snapshots:
+                    raise DatabaseUnavailable("База данных временно недоступна") from e
+                logger.debug("База недоступна, %s отдан из снимка", name)
+                return self._read_snapshots[key]
+            self._read_snapshots[key] = result
+            self._read_snapshots.move_to_end(key)
+            if len(self._read_snapshots) > self._max_read_snapshots:
+                self._read_snapshots.popitem(last=False)
+            return result
+
+        wrapper.__name__ = name
+        wrapper.__doc__ = read.__doc__
+        return wrapper
     
     # === USER METHODS ===
     def add_user(self, user_data):
@@ -52,6 +431,7 @@ class Database:
                 last_name=user_data.get('last_name'),
                 name=user_data['name'],
                 game_nickname=user_data['game_nickname'],
+                nickname_key=normalize_nickname(user_data['game_nickname']),
                 bio=user_data.get('bio'),
                 photo_id=user_data.get('photo_id'),
                 registration_complete=user_data.get('registration_complete', True),
@@ -61,6 +441,11 @@ class Database:
             session.commit()
             session.refresh(new_user)
             return new_user
+        except IntegrityError as e:
+            session.rollback()
+            if 'uq_users_nickname_key' in str(e.orig):
+                raise NicknameTaken(user_data['game_nickname']) from e
+            raise e
         except Exception as e:
             session.rollback()
             raise e
@@ -76,10 +461,81 @@ class Database:
                 for key, value in update_data.items():
                     if hasattr(user, key) and key != 'user_id':
                         setattr(user, key, value)
+                if 'game_nickname' in update_data:
+                    user.nickname_key = normalize_nickname(update_data['game_nickname'])
                 session.commit()
                 session.refresh(user)
                 return user
             return None
+        except IntegrityError as e:
+            session.rollback()
+            if 'uq_users_nickname_key' in str(e.orig):
+                raise NicknameTaken(update_data.get('game_nickname')) from e
+            raise e
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+    
+    def upsert_user(self, user_data):
+        """Сохранение профиля одним INSERT ... ON CONFLICT (user_id) DO UPDATE ... RETURNING
+
+        Возвращает (пользователь, created). Старый ник читается подзапросом в том же
+        выражении (он видит данные до вставки): если ник сменился, анонсы активных игр
+        пользователя ставятся на обновление — в них показан ник.
+        """
+        session = self.get_session()
+        try:
+            now = datetime.utcnow()
+            values = {
+                'user_id': user_data['user_id'],
+                'username': user_data.get('username'),
+                'first_name': user_data.get('first_name'),
+                'last_name': user_data.get('last_name'),
+                'name': user_data['name'],
+                'game_nickname': user_data['game_nickname'],
+                'nickname_key': normalize_nickname(user_data['game_nickname']),
+                'bio': user_data.get('bio'),
+                'photo_id': user_data.get('photo_id'),
+                'registration_complete': user_data.get('registration_complete', True),
+                'registered_at': user_data.get('registered_at'),
+                'created_at': now,
+                'updated_at': now,
+            }
+            stmt = pg_insert(User).values(**values)
+            updated = {key: stmt.excluded[key] for key in values if key not in ('user_id', 'created_at', 'registered_at')}
+            # Дата регистрации остается первой
+            updated['registered_at'] = func.coalesce(User.registered_at, stmt.excluded.registered_at)
+            previous = aliased(User)
+            old_nickname = select(previous.game_nickname).where(
+                previous.user_id == user_data['user_id']
+            ).scalar_subquery()
+            user, old_nickname, created = session.execute(
+                stmt.on_conflict_do_update(index_elements=[User.user_id], set_=updated).returning(
+                    User, old_nickname.label('old_nickname'), literal_column('xmax = 0').label('created')
+                )
+            ).one()
+
+            if not created and old_nickname != user.game_nickname:
+                game_ids = [game_id for (game_id,) in session.query(GameRegistration.game_id).join(
+                    GameRegistration.game
+                ).filter(
+                    GameRegistration.user_id == user.user_id,
+                    GameAnnouncement.is_active == True,
+                    GameAnnouncement.is_published == True
+                ).all()]
+                self._enqueue_outbox(session, 'refresh', game_ids)
+
+            # Отвязываем до commit, чтобы атрибуты не истекли и не понадобился refresh
+            session.expunge(user)
+            session.commit()
+            return user, created
+        except IntegrityError as e:
+            session.rollback()
+            if 'uq_users_nickname_key' in str(e.orig):
+                raise NicknameTaken(user_data['game_nickname']) from e
+            raise e
         except Exception as e:
             session.rollback()
             raise e
@@ -95,16 +551,24 @@ class Database:
             session.close()
     
     def get_user_by_nickname(self, game_nickname):
-        """Получение пользователя по игровому нику"""
+        """Получение пользователя по игровому нику (без учета регистра и лишних пробелов)"""
+        session = self.get_session()
+        try:
+            return session.query(User).filter(User.nickname_key == normalize_nickname(game_nickname)).first()
+        finally:
+            session.close()
+    
+    def get_nickname_owners(self):
+        """Все занятые ники: [(nickname_key, user_id)]"""
         session = self.get_session()
         try:
-            return session.query(User).filter(User.game_nickname == game_nickname).first()
+            return session.query(User.nickname_key, User.user_id).filter(User.nickname_key.isnot(None)).all()
         finally:
             session.close()
     
     def get_all_users(self):
         """Получение всех пользователей"""
-        session = self.get_session()
+        session = self.get_read_session()
         try:
             return session.query(User).all()
         finally:
@@ -112,7 +576,7 @@ class Database:
     
     def get_registered_users(self):
         """Получение только зарегистрированных пользователей"""
-        session = self.get_session()
+        session = self.get_read_session()
         try:
             return session.query(User).filter(User.registration_complete == True).all()
         finally:
@@ -157,8 +621,8 @@ class Database:
             session.close()
     
     # === GAME ANNOUNCEMENT METHODS ===
-    def create_game_announcement(self, announcement_data):
-        """Создание анонса игры"""
+    def create_game_announcement(self, announcement_data, publish=False):
+        """Создание анонса игры (publish=True — публикация через outbox в той же транзакции)"""
         session = self.get_session()
         try:
             game = GameAnnouncement(
@@ -174,9 +638,18 @@ class Database:
                 recurring_template_id=announcement_data.get('recurring_template_id'),
                 host=announcement_data.get('host', 'Не указан'),
                 publication_date=announcement_data.get('publication_date'),
-                is_published=announcement_data.get('is_published', False)
+                is_published=announcement_data.get('is_published', False),
+                registration_mode=announcement_data.get('registration_mode') or 'fcfs',
+                lottery_window_minutes=announcement_data.get('lottery_window_minutes'),
+                lottery_weighted=announcement_data.get('lottery_weighted') or False
             )
             session.add(game)
+            session.flush()
+            if game.recurring_template_id:
+                self._register_subscribers(session, game)
+            if publish:
+                self._enqueue_outbox(session, 'publish', game.id)
+            self._schedule_reminder(session, game)
             session.commit()
             session.refresh(game)
             return game
@@ -198,17 +671,132 @@ class Database:
         finally:
             session.close()
 
-    def mark_game_as_published(self, game_id, channel_message_id):
-        """Пометить игру как опубликованную"""
+    def record_channel_message(self, game_id, chat_id, message_id):
+        """Сохранить id анонса в канале и пометить игру опубликованной (одна транзакция)"""
         session = self.get_session()
         try:
-            game = session.query(GameAnnouncement).filter(GameAnnouncement.id == game_id).first()
+            stmt = pg_insert(ChannelMessage).values(
+                game_id=game_id,
+                chat_id=str(chat_id),
+                message_id=message_id,
+                published_at=datetime.utcnow()
+            )
+            stmt = stmt.on_conflict_do_update(
+                constraint='uq_channel_messages_game_chat',
+                set_={'message_id': stmt.excluded.message_id, 'published_at': stmt.excluded.published_at}
+            )
+            session.execute(stmt)
+            game = session.query(GameAnnouncement).filter(
+                GameAnnouncement.id == game_id
+            ).with_for_update().first()
             if game:
                 game.is_published = True
-                game.channel_message_id = channel_message_id
-                session.commit()
-                return True
-            return False
+                if game.registration_mode == 'lottery' and not game.lottery_closes_at:
+                    self._open_lottery(session, game)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def get_channel_messages(self, game_ids):
+        """Опубликованные анонсы по каналам: {game_id: {chat_id: message_id}}"""
+        result = {game_id: {} for game_id in game_ids}
+        if not game_ids:
+            return result
+        session = self.get_session()
+        try:
+            rows = session.query(
+                ChannelMessage.game_id, ChannelMessage.chat_id, ChannelMessage.message_id
+            ).filter(ChannelMessage.game_id.in_(game_ids)).all()
+            for game_id, chat_id, message_id in rows:
+                result[game_id][chat_id] = message_id
+            return result
+        finally:
+            session.close()
+
+    def get_channel_targets(self, games):
+        """Каналы публикации для игр одним запросом: {game_id: [chat_id, ...]}
+
+        games — пары (game_id, recurring_template_id). Свои каналы игры важнее каналов
+        шаблона; пустой список означает каналы по умолчанию.
+        """
+        result = {game_id: [] for game_id, _ in games}
+        if not games:
+            return result
+        template_ids = {template_id for _, template_id in games if template_id}
+        session = self.get_session()
+        try:
+            targets = session.query(ChannelTarget).filter(
+                ChannelTarget.is_active == True,
+                or_(
+                    ChannelTarget.game_id.in_(list(result)),
+                    ChannelTarget.recurring_template_id.in_(template_ids)
+                )
+            ).order_by(ChannelTarget.id).all()
+        finally:
+            session.close()
+
+        by_game = {}
+        by_template = {}
+        for target in targets:
+            if target.game_id:
+                by_game.setdefault(target.game_id, []).append(target.chat_id)
+            else:
+                by_template.setdefault(target.recurring_template_id, []).append(target.chat_id)
+        for game_id, template_id in games:
+            result[game_id] = by_game.get(game_id) or by_template.get(template_id, [])
+        return result
+
+    def get_all_channel_targets(self):
+        """Все настроенные каналы публикации (для админов)"""
+        session = self.get_session()
+        try:
+            return session.query(ChannelTarget).filter(
+                ChannelTarget.is_active == True
+            ).order_by(ChannelTarget.recurring_template_id, ChannelTarget.game_id, ChannelTarget.id).all()
+        finally:
+            session.close()
+
+    def set_channel_targets(self, chat_ids, game_id=None, recurring_template_id=None):
+        """Замена каналов игры или регулярного шаблона (пустой список — каналы по умолчанию)
+
+        Уже опубликованные игры ставятся на повторную публикацию: анонс уйдет только
+        в каналы, где его еще нет.
+        """
+        session = self.get_session()
+        try:
+            if game_id is not None:
+                owner = session.query(GameAnnouncement).filter(GameAnnouncement.id == game_id).first()
+                condition = ChannelTarget.game_id == game_id
+            else:
+                owner = session.query(RecurringGameTemplate).filter(
+                    RecurringGameTemplate.id == recurring_template_id
+                ).first()
+                condition = ChannelTarget.recurring_template_id == recurring_template_id
+            if not owner:
+                return False
+
+            session.query(ChannelTarget).filter(condition).delete(synchronize_session=False)
+            for chat_id in dict.fromkeys(chat_ids):
+                session.add(ChannelTarget(
+                    chat_id=str(chat_id),
+                    game_id=game_id,
+                    recurring_template_id=recurring_template_id
+                ))
+
+            published = session.query(GameAnnouncement.id).filter(
+                GameAnnouncement.is_active == True,
+                GameAnnouncement.is_published == True,
+                GameAnnouncement.id == game_id if game_id is not None
+                else GameAnnouncement.recurring_template_id == recurring_template_id
+            ).all()
+            for (published_id,) in published:
+                self._enqueue_outbox(session, 'publish', published_id, rearm=True)
+
+            session.commit()
+            return True
         except Exception as e:
             session.rollback()
             raise e
@@ -217,7 +805,7 @@ class Database:
 
     def get_active_games(self):
         """Получение активных анонсов игр (только будущие и опубликованные)"""
-        session = self.get_session()
+        session = self.get_read_session()
         try:
             return session.query(GameAnnouncement).filter(
                 GameAnnouncement.is_active == True,
@@ -229,7 +817,7 @@ class Database:
     
     def get_all_games(self):
         """Получение всех игр (для админов)"""
-        session = self.get_session()
+        session = self.get_read_session()
         try:
             return session.query(GameAnnouncement).order_by(GameAnnouncement.game_date).all()
         finally:
@@ -249,18 +837,145 @@ class Database:
             session.close()
     
     def update_game(self, game_id, update_data):
-        """Обновление данных игры"""
+        """Обновление данных игры (при смене max_players состав перераспределяется)"""
         session = self.get_session()
         try:
-            game = session.query(GameAnnouncement).filter(GameAnnouncement.id == game_id).first()
+            game, _ = self._apply_game_update(session, game_id, update_data)
             if game:
-                for key, value in update_data.items():
-                    if hasattr(game, key) and key != 'id':
-                        setattr(game, key, value)
                 session.commit()
                 session.refresh(game)
-                return game
-            return None
+            return game
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def update_game_capacity(self, game_id, max_players):
+        """Смена числа мест с перераспределением состава
+
+        Возвращает (игра, {'promoted': [user_id], 'demoted': [user_id]}) или (None, None).
+        """
+        session = self.get_session()
+        try:
+            game, changes = self._apply_game_update(session, game_id, {'max_players': max_players})
+            if game:
+                session.commit()
+                session.refresh(game)
+            return game, changes
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _apply_game_update(self, session, game_id, update_data):
+        """Изменение полей игры, перераспределение состава и обновление анонса в одной транзакции"""
+        game = session.query(GameAnnouncement).filter(
+            GameAnnouncement.id == game_id
+        ).with_for_update().first()
+        if not game:
+            return None, None
+
+        old_date = game.game_date
+        for key, value in update_data.items():
+            if hasattr(game, key) and key != 'id':
+                setattr(game, key, value)
+
+        changes = None
+        if 'max_players' in update_data:
+            session.flush()
+            changes = self._rebalance_roster(session, game)
+            self._enqueue_notifications(session, 'promoted', game_id, changes['promoted'])
+            self._enqueue_notifications(session, 'demoted', game_id, changes['demoted'])
+        if game.game_date != old_date:
+            # Перенос: сообщаем всему составу и напоминаем заново к новому времени
+            self._enqueue_notifications(session, 'rescheduled', game_id)
+            session.query(Notification).filter(
+                Notification.game_id == game_id,
+                Notification.kind == 'reminder'
+            ).delete(synchronize_session=False)
+            self._schedule_reminder(session, game)
+        if game.is_published:
+            self._enqueue_outbox(session, 'refresh', game_id)
+        return game, changes
+
+    def _rebalance_roster(self, session, game):
+        """Пересчет основы/резерва всего состава одним UPDATE с оконной функцией
+
+        Порядок: текущая основа, затем резерв, внутри — по позиции в очереди (а не по
+        registered_at: позиция выдается по счетчику игры под блокировкой и, в отличие от
+        времени, не совпадает у параллельных записей и пачек из розыгрыша). При
+        уменьшении мест последние из основы уходят в начало резерва, при увеличении
+        первые из резерва переходят в основу. Меняются только строки, чей статус
+        действительно изменился. Строка игры должна быть заблокирована вызывающим.
+        """
+        rows = session.execute(text("""
+            WITH ranked AS (
+                SELECT id,
+                       row_number() OVER (ORDER BY is_reserve, queue_position, id) AS rn
+                FROM game_registrations
+                WHERE game_id = :game_id
+            )
+            UPDATE game_registrations r
+            SET is_reserve = ranked.rn > :max_players
+            FROM ranked
+            WHERE r.id = ranked.id
+              AND r.is_reserve IS DISTINCT FROM (ranked.rn > :max_players)
+            RETURNING r.user_id, r.is_reserve
+        """), {'game_id': game.id, 'max_players': game.max_players}).all()
+        return {
+            'promoted': [user_id for user_id, is_reserve in rows if not is_reserve],
+            'demoted': [user_id for user_id, is_reserve in rows if is_reserve],
+        }
+
+    def compact_queue_positions(self, sparsity=2):
+        """Уплотнение позиций в очереди у активных игр с большими пропусками
+
+        Позиции не переиспользуются после отписок, поэтому у длинных листов ожидания
+        счетчик уходит вперед. Игры, где queue_seq больше числа записей в sparsity раз,
+        блокируются и перенумеровываются одним оконным UPDATE с сохранением порядка.
+        Возвращает число уплотненных игр.
+        """
+        session = self.get_session()
+        try:
+            # Ночное обслуживание: без обычного statement_timeout
+            session.execute(text("SET LOCAL statement_timeout = 0"))
+            sparse_ids = [game_id for (game_id,) in session.query(GameAnnouncement.id).outerjoin(
+                GameRegistration, GameRegistration.game_id == GameAnnouncement.id
+            ).filter(
+                GameAnnouncement.is_active == True
+            ).group_by(GameAnnouncement.id).having(
+                func.coalesce(GameAnnouncement.queue_seq, 0) > sparsity * func.count(GameRegistration.id)
+            ).all()]
+            if not sparse_ids:
+                return 0
+            # Блокируем игры в порядке id, чтобы не конфликтовать с записью
+            session.query(GameAnnouncement.id).filter(
+                GameAnnouncement.id.in_(sparse_ids)
+            ).order_by(GameAnnouncement.id).with_for_update().all()
+            session.execute(text("""
+                WITH ranked AS (
+                    SELECT id,
+                           row_number() OVER (
+                               PARTITION BY game_id ORDER BY is_reserve, queue_position, id
+                           ) AS rn
+                    FROM game_registrations
+                    WHERE game_id IN :game_ids
+                )
+                UPDATE game_registrations r
+                SET queue_position = ranked.rn
+                FROM ranked
+                WHERE r.id = ranked.id
+                  AND r.queue_position IS DISTINCT FROM ranked.rn
+            """).bindparams(bindparam('game_ids', expanding=True)), {'game_ids': sparse_ids})
+            session.execute(text("""
+                UPDATE game_announcements g
+                SET queue_seq = (SELECT count(*) FROM game_registrations r WHERE r.game_id = g.id)
+                WHERE g.id IN :game_ids
+            """).bindparams(bindparam('game_ids', expanding=True)), {'game_ids': sparse_ids})
+            session.commit()
+            return len(sparse_ids)
         except Exception as e:
             session.rollback()
             raise e
@@ -340,7 +1055,19 @@ class Database:
             ).all()
         finally:
             session.close()
-    
+
+    def get_recurring_game_dates(self):
+        """Уже созданные регулярные игры: множество (template_id, дата игры)"""
+        session = self.get_session()
+        try:
+            rows = session.query(
+                GameAnnouncement.recurring_template_id,
+                GameAnnouncement.game_date
+            ).filter(GameAnnouncement.recurring_template_id.isnot(None)).all()
+            return {(template_id, game_date.date()) for template_id, game_date in rows}
+        finally:
+            session.close()
+
     def get_recurring_template_by_id(self, template_id):
         """Получение шаблона по ID"""
         session = self.get_session()
@@ -372,12 +1099,84 @@ class Database:
         finally:
             session.close()
     
+    # === ANNOUNCEMENT TEMPLATE METHODS ===
+    def get_template_versions(self):
+        """Версии всех шаблонов анонсов: {name: version} (легкий запрос для проверки кэша)"""
+        session = self.get_session()
+        try:
+            rows = session.query(AnnouncementTemplate.name, AnnouncementTemplate.version).all()
+            return {name: version for name, version in rows}
+        finally:
+            session.close()
+    
+    def get_announcement_template(self, name):
+        """Получение шаблона анонса по имени"""
+        session = self.get_session()
+        try:
+            return session.query(AnnouncementTemplate).filter(AnnouncementTemplate.name == name).first()
+        finally:
+            session.close()
+    
+    def get_announcement_templates(self):
+        """Получение всех шаблонов анонсов"""
+        session = self.get_session()
+        try:
+            return session.query(AnnouncementTemplate).order_by(AnnouncementTemplate.name).all()
+        finally:
+            session.close()
+    
+    def save_announcement_template(self, name, body, display_name=None, updated_by=None):
+        """Создание или обновление шаблона анонса (версия увеличивается)"""
+        session = self.get_session()
+        try:
+            template = session.query(AnnouncementTemplate).filter(
+                AnnouncementTemplate.name == name
+            ).with_for_update().first()
+            if template:
+                template.body = body
+                template.version = template.version + 1
+                template.updated_by = updated_by
+                if display_name:
+                    template.display_name = display_name
+            else:
+                template = AnnouncementTemplate(
+                    name=name,
+                    display_name=display_name or name,
+                    body=body,
+                    version=1,
+                    updated_by=updated_by
+                )
+                session.add(template)
+            session.commit()
+            session.refresh(template)
+            return template
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+    
     # === REGISTRATION METHODS ===
     def register_for_game(self, game_id, user_id):
-        """Запись пользователя на игру"""
+        """Запись пользователя на игру
+
+        Сначала блокируется строка игры (UPDATE счетчика очереди), и только потом, со
+        свежим снимком, проверяется повторная запись и считается основа: параллельные
+        нажатия одного игрока не создадут двух записей, а записи разных — не переполнят основу.
+        """
         session = self.get_session()
         try:
-            # Проверяем, не записан ли уже пользователь
+            # Берем следующую позицию в очереди; UPDATE блокирует строку игры до коммита
+            claimed = session.execute(
+                update(GameAnnouncement).where(GameAnnouncement.id == game_id).values(
+                    queue_seq=func.coalesce(GameAnnouncement.queue_seq, 0) + 1
+                ).returning(GameAnnouncement.queue_seq, GameAnnouncement.max_players, GameAnnouncement.is_published)
+            ).first()
+            if not claimed:
+                return None
+            queue_position, max_players, is_published = claimed
+            
+            # Проверяем, не записан ли уже пользователь (под блокировкой; откат вернет счетчик)
             existing_reg = session.query(GameRegistration).filter(
                 GameRegistration.game_id == game_id,
                 GameRegistration.user_id == user_id
@@ -386,27 +1185,25 @@ class Database:
             if existing_reg:
                 return None  # Уже записан
             
-            # Получаем игру
-            game = session.query(GameAnnouncement).filter(GameAnnouncement.id == game_id).first()
-            if not game:
-                return None
-            
-            # Считаем текущие записи
+            # Считаем текущие записи (диапазон индекса по основе)
             main_registrations = session.query(GameRegistration).filter(
                 GameRegistration.game_id == game_id,
                 GameRegistration.is_reserve == False
             ).count()
             
             # Определяем, в основную группу или в резерв
-            is_reserve = main_registrations >= game.max_players
+            is_reserve = main_registrations >= max_players
             
             # Создаем запись
             registration = GameRegistration(
                 game_id=game_id,
                 user_id=user_id,
-                is_reserve=is_reserve
+                is_reserve=is_reserve,
+                queue_position=queue_position
             )
             session.add(registration)
+            if is_published:
+                self._enqueue_outbox(session, 'refresh', game_id)
             session.commit()
             session.refresh(registration)
             
@@ -417,10 +1214,109 @@ class Database:
         finally:
             session.close()
     
+    def register_for_games(self, game_ids, user_id):
+        """Запись на несколько игр одной транзакцией
+
+        Сначала строки игр блокируются (FOR UPDATE по возрастанию id, без дедлоков между
+        пачками), и только следующим оператором — со свежим снимком — считаются основа и
+        резерв, выдаются позиции очереди и вставляются записи. Подсчет в том же операторе,
+        что и блокировка, видел бы снимок до коммита параллельной записи и переполнял основу.
+        Для игр в окне розыгрыша подается заявка.
+        Обновления анонсов ставятся в outbox одной вставкой (по событию на игру).
+        Возвращает {game_id: (статус, номер)}, статус — 'main', 'reserve' или 'lottery';
+        игр, на которые записаться нельзя или уже записан, в ответе нет.
+        """
+        game_ids = list(dict.fromkeys(game_ids))
+        if not game_ids:
+            return {}
+        session = self.get_session()
+        try:
+            # Блокировка игр отдельным оператором: следующий увидит все закоммиченные записи
+            session.execute(
+                select(GameAnnouncement.id).where(GameAnnouncement.id.in_(game_ids))
+                .order_by(GameAnnouncement.id).with_for_update()
+            ).all()
+            registered = session.execute(text("""
+                WITH target AS (
+                    UPDATE game_announcements g
+                    SET queue_seq = coalesce(g.queue_seq, 0) + 1
+                    WHERE g.id IN :game_ids
+                      AND g.is_active AND g.is_published
+                      AND (g.registration_mode IS DISTINCT FROM 'lottery' OR g.lottery_drawn_at IS NOT NULL)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM game_registrations r
+                          WHERE r.game_id = g.id AND r.user_id = :user_id
+                      )
+                    RETURNING g.id, g.max_players, g.queue_seq
+                ),
+                placed AS (
+                    SELECT t.id AS game_id,
+                           (SELECT count(*) FROM game_registrations r
+                            WHERE r.game_id = t.id AND NOT r.is_reserve) AS main_count,
+                           (SELECT count(*) FROM game_registrations r
+                            WHERE r.game_id = t.id AND r.is_reserve) AS reserve_count,
+                           t.max_players,
+                           t.queue_seq
+                    FROM target t
+                ),
+                inserted AS (
+                    INSERT INTO game_registrations (game_id, user_id, is_reserve, registered_at, queue_position)
+                    SELECT p.game_id, :user_id, p.main_count >= p.max_players, :now, p.queue_seq
+                    FROM placed p
+                    RETURNING game_id, is_reserve
+                )
+                SELECT i.game_id, i.is_reserve,
+                       CASE WHEN i.is_reserve THEN p.reserve_count ELSE p.main_count END + 1 AS position
+                FROM inserted i JOIN placed p ON p.game_id = i.game_id
+            """).bindparams(bindparam('game_ids', expanding=True)), {
+                'game_ids': game_ids,
+                'user_id': user_id,
+                'now': datetime.utcnow(),
+            }).all()
+
+            entered = session.execute(text("""
+                INSERT INTO lottery_entries (game_id, user_id, entered_at)
+                SELECT g.id, :user_id, :now
+                FROM game_announcements g
+                WHERE g.id IN :game_ids
+                  AND g.is_active AND g.is_published
+                  AND g.registration_mode = 'lottery' AND g.lottery_drawn_at IS NULL
+                FOR SHARE OF g
+                ON CONFLICT ON CONSTRAINT uq_lottery_entries_game_user DO NOTHING
+                RETURNING game_id
+            """).bindparams(bindparam('game_ids', expanding=True)), {
+                'game_ids': game_ids,
+                'user_id': user_id,
+                'now': datetime.utcnow(),
+            }).all()
+
+            result = {
+                game_id: ('reserve' if is_reserve else 'main', position)
+                for game_id, is_reserve, position in registered
+            }
+            result.update({game_id: ('lottery', None) for (game_id,) in entered})
+
+            self._enqueue_outbox(session, 'refresh', [game_id for game_id, _, _ in registered])
+            session.commit()
+            return result
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+    
     def unregister_from_game(self, game_id, user_id):
-        """Отмена записи с игры"""
+        """Отмена записи с игры
+
+        Строка игры блокируется, как при записи: иначе параллельные запись и отписка
+        видят устаревший состав — продвижение из резерва теряется или основа переполняется.
+        """
         session = self.get_session()
         try:
+            # Блокировка игры отдельным оператором: дальше видны все закоммиченные записи
+            session.execute(
+                select(GameAnnouncement.id).where(GameAnnouncement.id == game_id).with_for_update()
+            ).first()
             registration = session.query(GameRegistration).filter(
                 GameRegistration.game_id == game_id,
                 GameRegistration.user_id == user_id
@@ -435,11 +1331,13 @@ class Database:
                     first_reserve = session.query(GameRegistration).filter(
                         GameRegistration.game_id == game_id,
                         GameRegistration.is_reserve == True
-                    ).order_by(GameRegistration.registered_at).first()
+                    ).order_by(GameRegistration.queue_position).first()
                     
                     if first_reserve:
                         first_reserve.is_reserve = False
+                        self._enqueue_notifications(session, 'promoted', game_id, [first_reserve.user_id])
                 
+                self._enqueue_outbox(session, 'refresh', game_id)
                 session.commit()
                 return True
             return False
@@ -451,17 +1349,63 @@ class Database:
     
     def get_game_registrations(self, game_id):
         """Получение всех записей на игру с предзагрузкой пользователей"""
-        session = self.get_session()
+        session = self.get_read_session()
         try:
             return session.query(GameRegistration).filter(
                 GameRegistration.game_id == game_id
             ).options(joinedload(GameRegistration.user)).order_by(
                 GameRegistration.is_reserve,
-                GameRegistration.registered_at
+                GameRegistration.queue_position
             ).all()
         finally:
             session.close()
     
+    def get_queue_place(self, registration):
+        """Место в основе или резерве: диапазон индекса (game_id, is_reserve, queue_position)"""
+        session = self.get_session()
+        try:
+            return session.query(func.count(GameRegistration.id)).filter(
+                GameRegistration.game_id == registration.game_id,
+                GameRegistration.is_reserve == registration.is_reserve,
+                GameRegistration.queue_position <= registration.queue_position
+            ).scalar()
+        finally:
+            session.close()
+    
+    def get_registrations_for_games(self, game_ids):
+        """Записи на несколько игр одним запросом: {game_id: [записи]}"""
+        result = {game_id: [] for game_id in game_ids}
+        if not game_ids:
+            return result
+        session = self.get_read_session()
+        try:
+            registrations = session.query(GameRegistration).filter(
+                GameRegistration.game_id.in_(game_ids)
+            ).options(joinedload(GameRegistration.user)).order_by(
+                GameRegistration.game_id,
+                GameRegistration.is_reserve,
+                GameRegistration.queue_position
+            ).all()
+            for registration in registrations:
+                result[registration.game_id].append(registration)
+            return result
+        finally:
+            session.close()
+
+    def get_games_for_publication(self, game_ids):
+        """Игры вместе с записями и пользователями одним запросом (для пакетной публикации)"""
+        if not game_ids:
+            return []
+        session = self.get_session()
+        try:
+            return session.query(GameAnnouncement).filter(
+                GameAnnouncement.id.in_(game_ids)
+            ).options(
+                joinedload(GameAnnouncement.registrations).joinedload(GameRegistration.user)
+            ).order_by(GameAnnouncement.game_date).all()
+        finally:
+            session.close()
+
     def is_user_registered(self, game_id, user_id):
         """Проверка, записан ли пользователь на игру"""
         session = self.get_session()
@@ -476,12 +1420,733 @@ class Database:
     
     def get_user_registrations(self, user_id):
         """Получение всех игр, на которые записан пользователь"""
-        session = self.get_session()
+        session = self.get_read_session()
         try:
             return session.query(GameRegistration).filter(
                 GameRegistration.user_id == user_id
-            ).join(GameAnnouncement).order_by(
+            ).join(GameRegistration.game).options(
+                contains_eager(GameRegistration.game)
+            ).order_by(
                 GameAnnouncement.game_date
             ).all()
         finally:
-            session.close()
\ No newline at end of file
+            session.close()
+    
+    # === SUBSCRIPTION METHODS ===
+    def _register_subscribers(self, session, game):
+        """Автозапись подписчиков шаблона на новую игру одним INSERT ... SELECT
+
+        Места получают первые max_players подписчиков по порядку подписки; остальные
+        места разыгрываются обычной записью.
+        """
+        order = (TemplateSubscription.created_at, TemplateSubscription.id)
+        # Порядок подписки задают позиции очереди из счетчика игры; registered_at — реальное время
+        first_position = game.queue_seq or 0
+        subscribers = select(
+            literal(game.id),
+            TemplateSubscription.user_id,
+            literal(False),
+            literal(datetime.utcnow()),
+            first_position + func.row_number().over(order_by=order)
+        ).select_from(TemplateSubscription).join(
+            User, User.user_id == TemplateSubscription.user_id
+        ).where(
+            TemplateSubscription.template_id == game.recurring_template_id,
+            User.registration_complete == True
+        ).order_by(*order).limit(game.max_players)
+        result = session.execute(
+            insert(GameRegistration).from_select(
+                ['game_id', 'user_id', 'is_reserve', 'registered_at', 'queue_position'], subscribers
+            )
+        )
+        game.queue_seq = first_position + result.rowcount
+
+    def subscribe_to_template(self, template_id, user_id):
+        """Подписка на регулярный шаблон: 'subscribed', 'duplicate' или None, если шаблона нет"""
+        session = self.get_session()
+        try:
+            template = session.query(RecurringGameTemplate.id).filter(
+                RecurringGameTemplate.id == template_id,
+                RecurringGameTemplate.is_active == True
+            ).first()
+            if not template:
+                return None
+            created = session.execute(
+                pg_insert(TemplateSubscription).values(
+                    template_id=template_id,
+                    user_id=user_id,
+                    created_at=datetime.utcnow()
+                ).on_conflict_do_nothing(constraint='uq_template_subscriptions_template_user')
+                .returning(TemplateSubscription.id)
+            ).first()
+            session.commit()
+            return 'subscribed' if created else 'duplicate'
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def unsubscribe_from_template(self, template_id, user_id):
+        """Отписка от шаблона (уже созданные записи на игры остаются)"""
+        session = self.get_session()
+        try:
+            deleted = session.query(TemplateSubscription).filter(
+                TemplateSubscription.template_id == template_id,
+                TemplateSubscription.user_id == user_id
+            ).delete(synchronize_session=False)
+            session.commit()
+            return deleted > 0
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def get_user_subscriptions(self, user_id):
+        """id шаблонов, на которые подписан пользователь"""
+        session = self.get_session()
+        try:
+            return {template_id for (template_id,) in session.query(TemplateSubscription.template_id).filter(
+                TemplateSubscription.user_id == user_id
+            ).all()}
+        finally:
+            session.close()
+
+    # === LOTTERY METHODS ===
+    def _open_lottery(self, session, game):
+        """Открытие окна заявок (при публикации) и постановка розыгрыша в outbox
+
+        lottery_closes_at, как и game_date, — локальное время (его видят игроки);
+        розыгрыш ставится ровно на этот момент, переведенный в UTC outbox.
+        """
+        window = timedelta(minutes=game.lottery_window_minutes or 15)
+        game.lottery_closes_at = datetime.now() + window
+        self._enqueue_outbox(session, 'draw', game.id, rearm=True, run_at=self._local_to_utc(game.lottery_closes_at))
+
+    def set_registration_mode(self, mode, window_minutes=None, weighted=False, game_id=None, recurring_template_id=None):
+        """Режим записи игры или регулярного шаблона: fcfs или lottery
+
+        Если игра уже опубликована, окно заявок открывается сразу; при возврате к fcfs
+        уже поданные заявки разыгрываются немедленно.
+        """
+        session = self.get_session()
+        try:
+            if game_id is not None:
+                owner = session.query(GameAnnouncement).filter(
+                    GameAnnouncement.id == game_id
+                ).with_for_update().first()
+            else:
+                owner = session.query(RecurringGameTemplate).filter(
+                    RecurringGameTemplate.id == recurring_template_id
+                ).first()
+            if not owner:
+                return False
+
+            owner.registration_mode = mode
+            owner.lottery_window_minutes = window_minutes
+            owner.lottery_weighted = weighted
+
+            if game_id is not None and owner.is_published and not owner.lottery_drawn_at:
+                if mode == 'lottery' and not owner.lottery_closes_at:
+                    self._open_lottery(session, owner)
+                elif mode != 'lottery' and owner.lottery_closes_at:
+                    self._enqueue_outbox(session, 'draw', game_id, rearm=True)
+
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def enter_lottery(self, game_id, user_id):
+        """Заявка на розыгрыш одним запросом: 'entered', 'duplicate' или 'closed'
+
+        FOR SHARE на строке игры не дает заявке проскочить мимо идущего розыгрыша:
+        она дождется его окончания и увидит lottery_drawn_at.
+        """
+        session = self.get_session()
+        try:
+            candidate = select(
+                GameAnnouncement.id,
+                literal(user_id),
+                literal(datetime.utcnow())
+            ).where(
+                GameAnnouncement.id == game_id,
+                GameAnnouncement.lottery_drawn_at.is_(None)
+            ).with_for_update(read=True)
+            entered = session.execute(
+                pg_insert(LotteryEntry).from_select(['game_id', 'user_id', 'entered_at'], candidate)
+                .on_conflict_do_nothing(constraint='uq_lottery_entries_game_user')
+                .returning(LotteryEntry.id)
+            ).first()
+            session.commit()
+            if entered:
+                return 'entered'
+
+            duplicate = session.query(LotteryEntry.id).filter(
+                LotteryEntry.game_id == game_id,
+                LotteryEntry.user_id == user_id
+            ).first()
+            return 'duplicate' if duplicate else 'closed'
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def leave_lottery(self, game_id, user_id):
+        """Отзыв заявки до розыгрыша"""
+        session = self.get_session()
+        try:
+            deleted = session.query(LotteryEntry).filter(
+                LotteryEntry.game_id == game_id,
+                LotteryEntry.user_id == user_id
+            ).delete(synchronize_session=False)
+            session.commit()
+            return deleted > 0
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def draw_lottery(self, game_id, outbox_event=None):
+        """Розыгрыш мест одной транзакцией: записи, уведомления участникам, очистка заявок, обновление анонса
+
+        Порядок — случайный ключ u ** (1 / вес) по убыванию (взвешенная выборка без
+        возвращения); вес = 1 + число сыгранных игр в основе, если lottery_weighted.
+        Возвращает {'main': [...], 'reserve': [...]} или None, если розыгрыш уже был.
+        """
+        session = self.get_session()
+        try:
+            game = session.query(GameAnnouncement).filter(
+                GameAnnouncement.id == game_id
+            ).with_for_update().first()
+            if not game or game.lottery_drawn_at:
+                if outbox_event:
+                    self._complete_outbox(session, [outbox_event])
+                session.commit()
+                return None
+
+            entrants = [user_id for (user_id,) in session.query(LotteryEntry.user_id).filter(
+                LotteryEntry.game_id == game_id,
+                ~exists().where(and_(
+                    GameRegistration.game_id == game_id,
+                    GameRegistration.user_id == LotteryEntry.user_id
+                ))
+            ).all()]
+
+            weights = {}
+            if game.lottery_weighted and entrants:
+                weights = dict(session.query(
+                    GameRegistration.user_id, func.count(GameRegistration.id)
+                ).join(GameRegistration.game).filter(
+                    GameRegistration.user_id.in_(entrants),
+                    GameRegistration.is_reserve == False,
+                    GameAnnouncement.game_date < datetime.now()
+                ).group_by(GameRegistration.user_id).all())
+
+            order = sorted(
+                entrants,
+                key=lambda user_id: random.random() ** (1.0 / (1 + weights.get(user_id, 0))),
+                reverse=True
+            )
+
+            main_taken = session.query(func.count(GameRegistration.id)).filter(
+                GameRegistration.game_id == game_id,
+                GameRegistration.is_reserve == False
+            ).scalar()
+            free_slots = max(0, game.max_players - main_taken)
+
+            now = datetime.utcnow()
+            if order:
+                # Резервируем блок позиций в очереди: порядок резерва — порядок розыгрыша
+                first_position = (game.queue_seq or 0) + 1
+                game.queue_seq = first_position + len(order) - 1
+                session.execute(insert(GameRegistration), [
+                    {
+                        'game_id': game_id,
+                        'user_id': user_id,
+                        'is_reserve': position >= free_slots,
+                        'registered_at': now,
+                        'queue_position': first_position + position,
+                    }
+                    for position, user_id in enumerate(order)
+                ])
+
+            # Каждому участнику — личный итог розыгрыша (основа или место в резерве)
+            self._enqueue_notifications(session, 'lottery', game_id, order)
+            session.query(LotteryEntry).filter(LotteryEntry.game_id == game_id).delete(synchronize_session=False)
+            game.lottery_drawn_at = datetime.now()
+            self._enqueue_outbox(session, 'refresh', game_id)
+            if outbox_event:
+                self._complete_outbox(session, [outbox_event])
+            session.commit()
+            return {'main': order[:free_slots], 'reserve': order[free_slots:]}
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    # === NOTIFICATION METHODS ===
+    def _schedule_reminder(self, session, game):
+        """Постановка напоминания об игре в outbox на reminder_hours до начала
+
+        game_date хранится в локальном времени, а run_at outbox — в UTC. Если до
+        игры осталось меньше reminder_hours, напоминание не ставится.
+        """
+        if not self.reminder_hours:
+            return
+        remind_at = game.game_date - timedelta(hours=self.reminder_hours)
+        if remind_at <= datetime.now():
+            return
+        self._enqueue_outbox(session, 'remind', game.id, rearm=True, run_at=self._local_to_utc(remind_at))
+
+    @staticmethod
+    def _local_to_utc(moment):
+        """Локальное время игры (game_date, lottery_closes_at) -> UTC для run_at outbox"""
+        return moment + (datetime.utcnow() - datetime.now())
+
+    def _enqueue_notifications(self, session, kind, game_id, user_ids=None):
+        """Постановка личных уведомлений в очередь внутри текущей транзакции
+
+        user_ids=None — весь состав игры: получатели выбираются одним INSERT ... SELECT
+        по записям; game_id тогда может быть списком игр. Напоминание ставится один
+        раз, остальные уведомления при повторной постановке взводятся заново.
+        """
+        game_ids = list(game_id) if isinstance(game_id, (list, tuple, set)) else [game_id]
+        if not game_ids or user_ids is not None and not user_ids:
+            return
+        now = datetime.utcnow()
+        if user_ids is not None:
+            stmt = pg_insert(Notification).values([
+                {
+                    'kind': kind,
+                    'game_id': game_ids[0],
+                    'user_id': user_id,
+                    'dedupe_key': f"{kind}:{game_ids[0]}:{user_id}",
+                    'status': 'pending',
+                    'attempts': 0,
+                    'next_attempt_at': now,
+                    'created_at': now,
+                }
+                for user_id in user_ids
+            ])
+        else:
+            roster = select(
+                literal(kind),
+                GameRegistration.game_id,
+                GameRegistration.user_id,
+                func.concat(kind, ':', GameRegistration.game_id, ':', GameRegistration.user_id),
+                literal('pending'),
+                literal(0),
+                literal(now),
+                literal(now)
+            ).where(GameRegistration.game_id.in_(game_ids))
+            stmt = pg_insert(Notification).from_select(
+                ['kind', 'game_id', 'user_id', 'dedupe_key', 'status', 'attempts', 'next_attempt_at', 'created_at'],
+                roster
+            )
+        if kind == 'reminder':
+            stmt = stmt.on_conflict_do_nothing(index_elements=[Notification.dedupe_key])
+        else:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Notification.dedupe_key],
+                set_={
+                    'status': 'pending',
+                    'attempts': 0,
+                    'next_attempt_at': now,
+                    'created_at': now,
+                    'last_error': None,
+                }
+            )
+        session.execute(stmt)
+
+    def queue_reminders(self, outbox_events):
+        """Напоминания по сработавшим событиям remind: все составы одной вставкой
+
+        Закрывает события в той же транзакции. Архивные игры пропускаются.
+        """
+        if not outbox_events:
+            return
+        session = self.get_session()
+        try:
+            game_ids = [game_id for (game_id,) in session.query(GameAnnouncement.id).filter(
+                GameAnnouncement.id.in_([outbox_event['game_id'] for outbox_event in outbox_events]),
+                GameAnnouncement.is_active == True
+            ).all()]
+            self._enqueue_notifications(session, 'reminder', game_ids)
+            self._complete_outbox(session, outbox_events)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def claim_notification_batch(self, limit=100, lease_seconds=120):
+        """Захват пачки готовых уведомлений вместе с данными игры и статусом записи
+
+        Одна выборка на пачку: игра и запись получателя присоединяются к уведомлениям,
+        поэтому отправка не делает запросов на каждого игрока. Захват — аренда,
+        как у outbox.
+        """
+        session = self.get_session()
+        try:
+            now = datetime.utcnow()
+            rows = session.query(
+                Notification, GameAnnouncement.title, GameAnnouncement.game_date,
+                GameAnnouncement.location, GameAnnouncement.is_active, GameRegistration.is_reserve
+            ).join(
+                GameAnnouncement, GameAnnouncement.id == Notification.game_id
+            ).outerjoin(GameRegistration, and_(
+                GameRegistration.game_id == Notification.game_id,
+                GameRegistration.user_id == Notification.user_id
+            )).filter(
+                Notification.status == 'pending',
+                Notification.next_attempt_at <= now
+            ).order_by(Notification.id).limit(limit).with_for_update(
+                of=Notification, skip_locked=True
+            ).all()
+
+            claimed = []
+            for notification, title, game_date, location, is_active, is_reserve in rows:
+                notification.attempts += 1
+                notification.next_attempt_at = now + timedelta(seconds=lease_seconds)
+                claimed.append({
+                    'id': notification.id,
+                    'kind': notification.kind,
+                    'game_id': notification.game_id,
+                    'user_id': notification.user_id,
+                    'attempts': notification.attempts,
+                    'title': title,
+                    'game_date': game_date,
+                    'location': location,
+                    'is_active': is_active,
+                    'registered': is_reserve is not None,
+                    'is_reserve': bool(is_reserve),
+                })
+            session.commit()
+            return claimed
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def finish_notifications(self, sent_ids=(), skipped_ids=()):
+        """Пометить отправленные и пропущенные (игрок уже не в составе) уведомления"""
+        if not sent_ids and not skipped_ids:
+            return
+        session = self.get_session()
+        try:
+            now = datetime.utcnow()
+            for status, ids in (('sent', sent_ids), ('skipped', skipped_ids)):
+                if ids:
+                    session.query(Notification).filter(
+                        Notification.id.in_(list(ids))
+                    ).update({'status': status, 'sent_at': now, 'last_error': None}, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def retry_notification(self, notification, error, delay_seconds, give_up=False):
+        """Отложить уведомление на повтор (или пометить как failed)"""
+        session = self.get_session()
+        try:
+            values = {'last_error': str(error)[:1000]}
+            if give_up:
+                values['status'] = 'failed'
+            else:
+                values['next_attempt_at'] = datetime.utcnow() + timedelta(seconds=delay_seconds)
+            session.query(Notification).filter(
+                Notification.id == notification['id']
+            ).update(values, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    # === OUTBOX METHODS ===
+    def _enqueue_outbox(self, session, kind, game_id, rearm=False, run_at=None):
+        """Постановка операции с каналом в outbox внутри текущей транзакции
+
+        publish ставится один раз на игру (rearm — взвести заново, например при
+        смене каналов); refresh — одна строка на игру, которая заново взводится
+        при каждом изменении (правки состава схлопываются). run_at (UTC) —
+        отложенное событие, например розыгрыш мест по окончании окна заявок.
+        game_id может быть списком: события для всех игр ставятся одной вставкой.
+        """
+        game_ids = list(game_id) if isinstance(game_id, (list, tuple, set)) else [game_id]
+        if not game_ids:
+            return
+        now = datetime.utcnow()
+        stmt = pg_insert(OutboxEvent).values([
+            {
+                'kind': kind,
+                'game_id': event_game_id,
+                'idempotency_key': f"{kind}:{event_game_id}",
+                'status': 'pending',
+                'revision': 0,
+                'attempts': 0,
+                'next_attempt_at': run_at or now,
+                'created_at': now,
+            }
+            for event_game_id in game_ids
+        ])
+        if kind == 'refresh' or rearm:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[OutboxEvent.idempotency_key],
+                set_={
+                    'status': 'pending',
+                    'revision': OutboxEvent.revision + 1,
+                    'attempts': 0,
+                    'next_attempt_at': stmt.excluded.next_attempt_at,
+                    'last_error': None,
+                }
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[OutboxEvent.idempotency_key])
+        session.execute(stmt)
+    
+    def enqueue_publication(self, game_id):
+        """Постановка публикации игры в outbox"""
+        session = self.get_session()
+        try:
+            self._enqueue_outbox(session, 'publish', game_id)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+    
+    def enqueue_refresh(self, game_id):
+        """Постановка обновления анонса в outbox"""
+        session = self.get_session()
+        try:
+            self._enqueue_outbox(session, 'refresh', game_id)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+    
+    def claim_outbox_batch(self, limit=50, lease_seconds=60):
+        """Захват пачки готовых событий outbox
+
+        Захват — это аренда: next_attempt_at сдвигается на lease_seconds, поэтому
+        если процесс упадет посреди обработки, событие вернется в очередь само.
+        """
+        session = self.get_session()
+        try:
+            now = datetime.utcnow()
+            events = session.query(OutboxEvent).filter(
+                OutboxEvent.status == 'pending',
+                OutboxEvent.next_attempt_at <= now
+            ).order_by(OutboxEvent.id).limit(limit).with_for_update(skip_locked=True).all()
+            
+            claimed = []
+            for outbox_event in events:
+                outbox_event.attempts += 1
+                outbox_event.next_attempt_at = now + timedelta(seconds=lease_seconds)
+                claimed.append({
+                    'id': outbox_event.id,
+                    'kind': outbox_event.kind,
+                    'game_id': outbox_event.game_id,
+                    'revision': outbox_event.revision,
+                    'attempts': outbox_event.attempts,
+                })
+            session.commit()
+            return claimed
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+    
+    def _complete_outbox(self, session, events):
+        """Закрытие событий, если их не взвели заново во время обработки"""
+        now = datetime.utcnow()
+        for outbox_event in events:
+            session.query(OutboxEvent).filter(
+                OutboxEvent.id == outbox_event['id'],
+                OutboxEvent.revision == outbox_event['revision']
+            ).update({'status': 'done', 'processed_at': now, 'last_error': None}, synchronize_session=False)
+    
+    def complete_outbox_events(self, events):
+        """Пометить обработанные события outbox"""
+        if not events:
+            return
+        session = self.get_session()
+        try:
+            self._complete_outbox(session, events)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+    
+    def defer_outbox_events(self, events, delay_seconds):
+        """Отложить взятые события без учета попытки (например, при перегрузке бота)"""
+        if not events:
+            return
+        session = self.get_session()
+        try:
+            session.query(OutboxEvent).filter(
+                tuple_(OutboxEvent.id, OutboxEvent.revision).in_(
+                    [(outbox_event['id'], outbox_event['revision']) for outbox_event in events]
+                )
+            ).update({
+                'next_attempt_at': datetime.utcnow() + timedelta(seconds=delay_seconds),
+                'attempts': OutboxEvent.attempts - 1,
+            }, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+    
+    def retry_outbox_event(self, outbox_event, error, delay_seconds, give_up=False):
+        """Отложить событие outbox на повтор (или пометить как failed)"""
+        session = self.get_session()
+        try:
+            values = {'last_error': str(error)[:1000]}
+            if give_up:
+                values['status'] = 'failed'
+            else:
+                values['next_attempt_at'] = datetime.utcnow() + timedelta(seconds=delay_seconds)
+            session.query(OutboxEvent).filter(
+                OutboxEvent.id == outbox_event['id'],
+                OutboxEvent.revision == outbox_event['revision']
+            ).update(values, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    # === CONVERSATION PERSISTENCE METHODS ===
+    def get_conversation_states(self, name):
+        """Идущие диалоги ConversationHandler'а: {key_json: pickle состояния}"""
+        session = self.get_session()
+        try:
+            return dict(session.query(ConversationState.key, ConversationState.state).filter(
+                ConversationState.name == name
+            ).all())
+        finally:
+            session.close()
+
+    def expire_conversation_states(self, name, older_than, flow_keys=()):
+        """Удаление диалогов без активности с older_than (UTC) вместе с их ключами user_data
+
+        Ключ диалога — [chat_id, user_id], пользователь берется из второго элемента.
+        """
+        session = self.get_session()
+        try:
+            expired = session.query(ConversationState).filter(
+                ConversationState.name == name,
+                ConversationState.updated_at < older_than
+            )
+            if flow_keys:
+                user_ids = select(
+                    cast(cast(ConversationState.key, JSONB)[1].astext, Integer)
+                ).where(
+                    ConversationState.name == name,
+                    ConversationState.updated_at < older_than
+                )
+                session.query(UserDataEntry).filter(
+                    UserDataEntry.user_id.in_(user_ids),
+                    UserDataEntry.key.in_(list(flow_keys))
+                ).delete(synchronize_session=False)
+            count = expired.delete(synchronize_session=False)
+            session.commit()
+            return count
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def get_user_data_entries(self, user_id):
+        """Сохраненные ключи user_data пользователя: {key: pickle}"""
+        session = self.get_session()
+        try:
+            return dict(session.query(UserDataEntry.key, UserDataEntry.value).filter(
+                UserDataEntry.user_id == user_id
+            ).all())
+        finally:
+            session.close()
+
+    def save_persistence_batch(self, conversations=(), user_data=None, dropped_users=()):
+        """Сброс накопленных изменений диалогов и user_data одной транзакцией
+
+        conversations — [(name, key_json, pickle состояния или None)], None удаляет диалог;
+        user_data — {user_id: (измененные ключи {key: pickle}, удаленные ключи, replace)},
+        replace=True сначала стирает все ключи пользователя (его прошлое состояние неизвестно);
+        dropped_users — пользователи, чьи данные удаляются целиком.
+        """
+        user_data = user_data or {}
+        now = datetime.utcnow()
+        session = self.get_session()
+        try:
+            states = [(name, key, state) for name, key, state in conversations if state is not None]
+            ended = [(name, key) for name, key, state in conversations if state is None]
+            if states:
+                stmt = pg_insert(ConversationState).values([
+                    {'name': name, 'key': key, 'state': state, 'updated_at': now}
+                    for name, key, state in states
+                ])
+                session.execute(stmt.on_conflict_do_update(
+                    constraint='uq_conversation_states_name_key',
+                    set_={'state': stmt.excluded.state, 'updated_at': now}
+                ))
+            if ended:
+                session.query(ConversationState).filter(
+                    tuple_(ConversationState.name, ConversationState.key).in_(ended)
+                ).delete(synchronize_session=False)
+
+            cleared = list(dropped_users) + [user_id for user_id, (_, _, replace) in user_data.items() if replace]
+            if cleared:
+                session.query(UserDataEntry).filter(
+                    UserDataEntry.user_id.in_(cleared)
+                ).delete(synchronize_session=False)
+            removed = [
+                (user_id, key)
+                for user_id, (_, removed_keys, replace) in user_data.items() if not replace
+                for key in removed_keys
+            ]
+            if removed:
+                session.query(UserDataEntry).filter(
+                    tuple_(UserDataEntry.user_id, UserDataEntry.key).in_(removed)
+                ).delete(synchronize_session=False)
+            changed = [
+                {'user_id': user_id, 'key': key, 'value': value, 'updated_at': now}
+                for user_id, (changed_keys, _, _) in user_data.items()
+                for key, value in changed_keys.items()
+            ]
+            if changed:
+                stmt = pg_insert(UserDataEntry).values(changed)
+                session.execute(stmt.on_conflict_do_update(
+                    constraint='uq_user_data_entries_user_key',
+                    set_={'value': stmt.excluded.value, 'updated_at': now}
+                ))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
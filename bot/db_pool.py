@@ -0,0 +1,76 @@
+import os
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+def pool_options():
+    """Настройки пула соединений из окружения (аргументы create_engine)"""
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', '5')),
+        # Соединения старше pool_recycle секунд пересоздаются до того, как их оборвет сервер или балансировщик
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        # Проверка соединения перед выдачей: оборванное заменяется новым, а не падает посреди обработчика
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+    }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool с метриками: ожидание выдачи соединения, загрузка, ошибки соединений
+
+    Время выдачи считается целиком, как его видит обработчик: ожидание свободного
+    соединения, создание нового и pre-ping.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.connect_errors = 0
+        self.invalidated = 0
+        self._wait_ms = 0.0
+        self._max_wait_ms = 0.0
+        event.listen(self, 'invalidate', self._on_invalidate)
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            self.checkout_timeouts += 1
+            raise
+        except Exception:
+            self.connect_errors += 1
+            raise
+        finally:
+            wait_ms = (time.perf_counter() - started) * 1000
+            self.checkouts += 1
+            self._wait_ms = wait_ms if self._wait_ms == 0 else self._wait_ms + 0.1 * (wait_ms - self._wait_ms)
+            self._max_wait_ms = max(self._max_wait_ms, wait_ms)
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        # Соединение выброшено из пула: оборвалось, не прошло pre-ping или истек recycle
+        if exception is not None:
+            self.invalidated += 1
+
+    def stats(self):
+        """Снимок метрик; максимум ожидания считается заново с каждого снимка"""
+        capacity = self.size() + max(self._max_overflow, 0)
+        checked_out = self.checkedout()
+        stats = {
+            'pool_size': self.size(),
+            'pool_checked_out': checked_out,
+            'pool_overflow': max(self.overflow(), 0),
+            'pool_utilization': round(checked_out / capacity, 2) if capacity else 0.0,
+            'checkout_wait_ms': round(self._wait_ms, 1),
+            'checkout_wait_max_ms': round(self._max_wait_ms, 1),
+            'checkout_timeouts': self.checkout_timeouts,
+            'connect_errors': self.connect_errors,
+            'invalidated_connections': self.invalidated,
+        }
+        self._max_wait_ms = 0.0
+        return stats
@@ -0,0 +1,191 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import deque
+from telegram import Update
+from telegram.constants import ChatType
+from telegram.ext import BaseUpdateProcessor
+
+# Полосы приоритета: меньше — раньше
+ADMIN, INTERACTIVE, BULK = 0, 1, 2
+LANE_NAMES = {ADMIN: 'admin', INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+# Команды админов обгоняют очередь пользовательских нажатий
+ADMIN_COMMANDS = {
+    'newgame', 'editgame', 'archive', 'settemplate', 'setchannels', 'lottery', 'templates', 'cancel',
+}
+
+# Запись и отписка (кнопки под постом в канале и в личке) — основной путь, не сбрасывается
+REGISTRATION_CALLBACK_RE = re.compile(r'^(join|leave)_')
+
+
+def classify(update):
+    """Полоса апдейта: команды админов, личные диалоги и нажатия, массовый трафик"""
+    if not isinstance(update, Update):
+        return BULK
+    query = update.callback_query
+    if query and query.data and REGISTRATION_CALLBACK_RE.match(query.data):
+        return INTERACTIVE
+    message = update.message
+    if message and message.text and message.text.startswith('/'):
+        command = message.text[1:].split(maxsplit=1)[0].split('@')[0] if len(message.text) > 1 else ''
+        if command in ADMIN_COMMANDS:
+            return ADMIN
+    chat = update.effective_chat
+    if chat is not None and chat.type == ChatType.PRIVATE:
+        return INTERACTIVE
+    # Посты каналов, правки и прочие апдейты без действия пользователя — массовый трафик
+    return BULK
+
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """Обработка апдейтов с полосами приоритета, сбросом нагрузки и метриками
+
+    Базовый семафор PTB честный (FIFO), поэтому ему дан большой лимит, а реальное
+    число одновременно обрабатываемых апдейтов (UPDATE_CONCURRENCY) ограничивают
+    слоты этого класса: освободившийся слот достается первому ожидающему из самой
+    приоритетной полосы. Апдейты одного пользователя идут строго по очереди, чтобы
+    диалоги и user_data не гонялись.
+
+    При глубине очереди больше SHED_BULK_DEPTH новые массовые апдейты отбрасываются
+    (на нажатие отвечаем всплывающим «перегружен»; запись и отписка не отбрасываются никогда), а при глубине больше
+    DEFER_REFRESH_DEPTH outbox откладывает обновления анонсов (см. defer_refreshes).
+    """
+
+    def __init__(self):
+        self.concurrency = int(os.getenv('UPDATE_CONCURRENCY', '16'))
+        super().__init__(max_concurrent_updates=max(self.concurrency, int(os.getenv('UPDATE_MAX_PENDING', '10000'))))
+        self.shed_bulk_depth = int(os.getenv('SHED_BULK_DEPTH', '500'))
+        self.defer_refresh_depth = int(os.getenv('DEFER_REFRESH_DEPTH', '100'))
+        self.logger = logging.getLogger(__name__)
+        self._active = 0
+        self._waiting = {lane: deque() for lane in LANE_NAMES}
+        self._user_locks = {}
+        self._handler_ms = 0.0
+        self._wait_ms = 0.0
+        self.shed = 0
+        self._overloaded = False
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def queue_depth(self):
+        return sum(len(waiting) for waiting in self._waiting.values())
+
+    def defer_refreshes(self):
+        """Пора ли откладывать несрочные обновления анонсов (вызывает outbox)"""
+        return self.queue_depth > self.defer_refresh_depth
+
+    def stats(self):
+        """Метрики диспетчера: очередь по полосам, занятые слоты, средние задержки"""
+        return {
+            'queue_depth': self.queue_depth,
+            'queue_by_lane': {LANE_NAMES[lane]: len(waiting) for lane, waiting in self._waiting.items()},
+            'active_updates': self._active,
+            'handler_ms': round(self._handler_ms, 1),
+            'queue_wait_ms': round(self._wait_ms, 1),
+            'shed_updates': self.shed,
+        }
+
+    async def do_process_update(self, update, coroutine):
+        lane = classify(update)
+        if lane == BULK and self.queue_depth >= self.shed_bulk_depth:
+            await self._shed(update, coroutine)
+            return
+
+        user = update.effective_user if isinstance(update, Update) else None
+        lock = self._user_lock(user.id) if user else None
+        locked = False
+        queued_at = time.perf_counter()
+        try:
+            if lock:
+                await lock.acquire()
+                locked = True
+            await self._acquire_slot(lane)
+            started = time.perf_counter()
+            self._wait_ms = self._ewma(self._wait_ms, (started - queued_at) * 1000)
+            try:
+                await coroutine
+            finally:
+                self._handler_ms = self._ewma(self._handler_ms, (time.perf_counter() - started) * 1000)
+                self._release_slot()
+        finally:
+            if lock:
+                if locked:
+                    lock.release()
+                self._drop_user_lock(user.id, lock)
+
+    async def _shed(self, update, coroutine):
+        """Отказ без обработки: корутина закрывается, на нажатие — короткий ответ"""
+        coroutine.close()
+        self.shed += 1
+        query = update.callback_query if isinstance(update, Update) else None
+        if query:
+            try:
+                await query.answer("⏳ Бот перегружен, нажмите еще раз через минуту")
+            except Exception as e:
+                self.logger.debug(f"Не удалось ответить на отброшенное нажатие: {e}")
+
+    async def _acquire_slot(self, lane):
+        if self._active < self.concurrency and not self.queue_depth:
+            self._active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting[lane].append(waiter)
+        self._check_overload()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже выдан — возвращаем его следующему
+                self._release_slot()
+            else:
+                self._waiting[lane].remove(waiter)
+            raise
+
+    def _release_slot(self):
+        for lane in sorted(self._waiting):
+            waiting = self._waiting[lane]
+            while waiting:
+                waiter = waiting.popleft()
+                if not waiter.done():
+                    # Слот переходит к ожидающему, счетчик не меняется
+                    waiter.set_result(None)
+                    self._check_overload()
+                    return
+        self._active -= 1
+        self._check_overload()
+
+    def _check_overload(self):
+        """Лог переходов в перегрузку и обратно (сам счетчик — в stats)"""
+        overloaded = self.defer_refreshes()
+        if overloaded != self._overloaded:
+            self._overloaded = overloaded
+            if overloaded:
+                self.logger.warning(f"Перегрузка: в очереди {self.queue_depth} апдейтов", extra=self.stats())
+            else:
+                self.logger.info("Очередь апдейтов разобрана", extra=self.stats())
+
+    def _user_lock(self, user_id):
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _drop_user_lock(self, user_id, lock):
+        entry = self._user_locks.get(user_id)
+        if entry is not None and entry[0] is lock:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._user_locks[user_id]
+
+    @staticmethod
+    def _ewma(current, value, alpha=0.1):
+        return value if current == 0 else current + alpha * (value - current)
@@ -1,11 +1,17 @@
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, ConversationHandler
+from telegram.error import RetryAfter
 from datetime import datetime, timedelta
 import os
+import time
+import asyncio
 import logging
-from .templates import GameTemplates
+from .templates import GameTemplates, DEFAULT_TEMPLATES, PLACEHOLDERS, validate_template, validate_template_html
 from .models import FrequencyType
-from apscheduler.triggers.date import DateTrigger
+from .outbox import OutboxWorker
+from .notifications import NotificationWorker
+from .rate_limit import TelegramRateLimiter
+from .channels import default_channel_ids
 
 class GameAnnouncementStates:
     TITLE = 1
@@ -25,8 +31,12 @@ class GameAnnouncementManager:
         self.db = database
         self.bot = bot
         self.scheduler = scheduler
-        self.templates = GameTemplates()
+        self.templates = GameTemplates(database)
         self.logger = logging.getLogger(__name__)
+        self.outbox = OutboxWorker(database, self)
+        self.rate_limiter = TelegramRateLimiter()
+        self.notifications = NotificationWorker(database, bot, self.rate_limiter)
+        self.publish_concurrency = int(os.getenv('PUBLISH_CONCURRENCY', '8'))
     
     async def start_creation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начало создания анонса"""
@@ -362,11 +372,10 @@ class GameAnnouncementManager:
                     
                     # Обработка публикации
                     if announcement_data.get('publish_immediately'):
-                        # Публикуем сразу
-                        game_data['is_published'] = True
-                        game = self.db.create_game_announcement(game_data)
-                        await self._publish_announcement(game, context)
-                        response_text = "✅ Анонс создан и опубликован!"
+                        # Публикуем сразу: игра и событие публикации пишутся одной транзакцией
+                        game = self.db.create_game_announcement(game_data, publish=True)
+                        self.outbox.notify()
+                        response_text = "✅ Анонс создан и будет опубликован в канале в ближайшие секунды!"
                     else:
                         # Запланированная публикация
                         publication_datetime = announcement_data.get('publication_datetime')
@@ -452,19 +461,24 @@ class GameAnnouncementManager:
                 'is_recurring': True,
                 'recurring_template_id': template.id,
                 'host': template.host,
+                'custom_text': template.custom_text,
+                'registration_mode': template.registration_mode,
+                'lottery_window_minutes': template.lottery_window_minutes,
+                'lottery_weighted': template.lottery_weighted,
                 'publication_date': publication_datetime,
                 'is_published': False
             }
             
-            game = self.db.create_game_announcement(game_data)
+            # Если время публикации уже прошло, публикуем сразу (через outbox)
+            publish_now = publication_datetime <= datetime.now()
+            game = self.db.create_game_announcement(game_data, publish=publish_now)
             
             # Планируем публикацию
-            if publication_datetime > datetime.now():
+            if publish_now:
+                self.outbox.notify()
+            else:
                 self.schedule_announcement_publication(game.id, publication_datetime)
                 self.logger.info(f"Запланирована публикация регулярной игры {game.id} на {publication_datetime}")
-            else:
-                # Если время публикации уже прошло, публикуем сразу
-                await self._publish_announcement_direct(game)
             
             return game
             
@@ -524,7 +538,8 @@ class GameAnnouncementManager:
             # Добавляем задание в планировщик
             self.scheduler.add_job(
                 self._publish_scheduled_announcement,
-                trigger=DateTrigger(run_date=publication_datetime),
+                trigger='date',
+                run_date=publication_datetime,
                 args=[game_id],
                 id=f'game_publish_{game_id}',
                 replace_existing=True
@@ -538,74 +553,111 @@ class GameAnnouncementManager:
             return False
 
     async def _publish_scheduled_announcement(self, game_id):
-        """Публикация запланированного анонса"""
+        """Публикация запланированного анонса (ставится в outbox)"""
         try:
             self.logger.info(f"Запуск запланированной публикации для игры {game_id}")
-            
-            # ИСПРАВЛЕНИЕ: Используем check_published=False чтобы найти неопубликованную игру
-            game = self.db.get_game_by_id(game_id, check_published=False)
-            if not game:
-                self.logger.error(f"Игра {game_id} не найдена")
-                return
-            
-            # Публикуем анонс
-            await self._publish_announcement_direct(game)
-            
-            self.logger.info(f"Анонс игры {game_id} успешно опубликован по расписанию")
-            
+            self.db.enqueue_publication(game_id)
+            self.outbox.notify()
         except Exception as e:
             self.logger.error(f"Ошибка при публикации запланированного анонса {game_id}: {e}")
 
-    async def _publish_announcement_direct(self, game):
-        """Прямая публикация анонса (без контекста)"""
-        channel_id = os.getenv('CHANNEL_ID')
-        
-        if not channel_id:
-            self.logger.error("CHANNEL_ID не указан в настройках")
-            return
-        
-        try:
-            final_text = await self._format_final_announcement(game)
-            message = await self.bot.send_message(
-                chat_id=channel_id,
-                text=final_text,
-                parse_mode='HTML'
-            )
-            
-            # Сохраняем ID сообщения и помечаем как опубликованное
-            self.db.update_channel_message_id(game.id, message.message_id)
-            self.db.mark_game_as_published(game.id, message.message_id)
-            self.logger.info(f"Анонс игры {game.id} опубликован в канале")
-            
-        except Exception as e:
-            self.logger.error(f"Ошибка публикации в канал: {e}")
-            raise e
+    async def publish_game(self, game_id, outbox_event=None):
+        """Отправка одного анонса в канал (обертка над publish_games)"""
+        errors = await self.publish_games([game_id], {game_id: outbox_event} if outbox_event else None)
+        if game_id in errors:
+            raise errors[game_id]
 
-    async def _publish_announcement(self, game, context):
-        """Публикация анонса в канал (с контекстом)"""
-        channel_id = os.getenv('CHANNEL_ID')
-        
-        if not channel_id:
-            self.logger.error("CHANNEL_ID не указан в настройках")
-            return
-        
-        try:
-            final_text = await self._format_final_announcement(game)
-            message = await context.bot.send_message(
-                chat_id=channel_id,
-                text=final_text,
-                parse_mode='HTML'
+    async def publish_games(self, game_ids, outbox_events=None):
+        """Пакетная публикация анонсов во все каналы игр (вызывается outbox-воркером)
+
+        Игры вместе с составами грузятся одним запросом, тексты рендерятся для всей
+        пачки сразу, а отправка во все каналы идет параллельно — не больше
+        PUBLISH_CONCURRENCY запросов одновременно и в пределах лимитов Bot API.
+        id сообщения сохраняется сразу после отправки в каждый канал, поэтому повтор
+        отправляет анонс только туда, где его еще нет. Событие outbox закрывается,
+        когда анонс есть во всех каналах игры.
+        Возвращает {game_id: ошибка} для неудавшихся публикаций.
+        """
+        outbox_events = outbox_events or {}
+        game_ids = list(dict.fromkeys(game_ids))
+        games = {game.id: game for game in self.db.get_games_for_publication(game_ids)}
+        targets = self.db.get_channel_targets([(game.id, game.recurring_template_id) for game in games.values()])
+        published = self.db.get_channel_messages(list(games))
+        default_channels = default_channel_ids()
+
+        sends = []
+        done = []
+        errors = {}
+        for game_id in game_ids:
+            game = games.get(game_id)
+            if not game:
+                self.logger.error(f"Игра {game_id} не найдена")
+                done.append(game_id)
+                continue
+
+            channels = targets[game_id] or default_channels
+            if not channels:
+                errors[game_id] = RuntimeError("Каналы публикации не настроены (CHANNEL_ID или /setchannels)")
+                continue
+
+            missing = [chat_id for chat_id in channels if chat_id not in published[game_id]]
+            if not missing:
+                # Повторная доставка события: анонс уже во всех каналах, второй раз не отправляем
+                self.logger.info(f"Анонс игры {game_id} уже опубликован, пропускаем")
+                done.append(game_id)
+                continue
+
+            registrations = sorted(game.registrations, key=lambda r: (r.queue_position or 0, r.id))
+            content = self._render_announcement(game, registrations)
+            sends.extend((game_id, chat_id, content) for chat_id in missing)
+
+        semaphore = asyncio.Semaphore(self.publish_concurrency)
+
+        async def publish(game_id, chat_id, content):
+            async with semaphore:
+                message = await self._send_to_channel(chat_id, *content)
+            self.db.record_channel_message(game_id, chat_id, message.message_id)
+            self.logger.info(f"Анонс игры {game_id} опубликован в {chat_id}", extra={'game_id': game_id})
+
+        started = time.monotonic()
+        results = await asyncio.gather(
+            *(publish(*send) for send in sends),
+            return_exceptions=True
+        )
+        for (game_id, chat_id, _), result in zip(sends, results):
+            if isinstance(result, Exception) and game_id not in errors:
+                self.logger.error(f"Не удалось опубликовать игру {game_id} в {chat_id}: {result}")
+                errors[game_id] = result
+
+        done.extend(game_id for game_id, _, _ in sends if game_id not in errors)
+        self.db.complete_outbox_events([
+            outbox_events[game_id] for game_id in dict.fromkeys(done) if outbox_events.get(game_id)
+        ])
+
+        if len(sends) > 1:
+            self.logger.info(
+                "Пакетная публикация: %s отправок, ошибок по играм: %s, %.1f c",
+                len(sends), len(errors), time.monotonic() - started,
+                extra={'duration_ms': round((time.monotonic() - started) * 1000)}
             )
-            
-            # Сохраняем ID сообщения
-            self.db.update_channel_message_id(game.id, message.message_id)
-            self.db.mark_game_as_published(game.id, message.message_id)
-            self.logger.info(f"Анонс игры {game.id} опубликован в канале")
-            
-        except Exception as e:
-            self.logger.error(f"Ошибка публикации в канал: {e}")
-            raise e
-    
+        return errors
+
+    async def _send_to_channel(self, channel_id, text, reply_markup=None, attempts=3):
+        """send_message в пределах лимитов; RetryAfter замораживает чат и повторяет отправку"""
+        for attempt in range(1, attempts + 1):
+            await self.rate_limiter.acquire(channel_id)
+            try:
+                return await self.bot.send_message(
+                    chat_id=channel_id,
+                    text=text,
+                    parse_mode='HTML',
+                    reply_markup=reply_markup
+                )
+            except RetryAfter as e:
+                self.rate_limiter.retry_after(channel_id, float(e.retry_after))
+                if attempt == attempts:
+                    raise
+
     def _format_announcement_preview(self, announcement_data):
         """Форматирование превью анонса"""
         game_date = announcement_data['game_date']
@@ -647,63 +699,241 @@ class GameAnnouncementManager:
         return frequency_map.get(frequency, str(frequency))
     
     async def _format_final_announcement(self, game):
-        """Форматирование финального анонса для канала"""
-        templates = self.templates.get_templates()
-        template = templates.get(game.template, templates['standard'])
-        
-        formatted_date = self.templates.format_date(game.game_date)
-        
+        """Форматирование финального анонса для канала: (текст, кнопки)"""
         # Получаем актуальные записи на игру
         registrations = self.db.get_game_registrations(game.id)
-        
-        # Форматируем список игроков
-        players_list = self._format_players_list(registrations, game.max_players)
-        current_players = len([r for r in registrations if not r.is_reserve])
-        
-        text = template['template'].format(
-            title=game.title,
-            description=game.description,
-            date=formatted_date,
-            location=game.location,
-            max_players=game.max_players,
-            current_players=current_players,
-            players_list=players_list,
-            host=game.host or "Не указан"
+        return self._render_announcement(game, registrations)
+
+    def _render_announcement(self, game, registrations):
+        """Текст анонса и кнопки записи со счетчиками по одному и тому же составу"""
+        main_count = sum(1 for r in registrations if not r.is_reserve)
+        reserve_count = len(registrations) - main_count
+        return (
+            self.templates.render(game, registrations),
+            self._announcement_keyboard(game, main_count, reserve_count)
         )
-        
-        return text
+
+    def _announcement_keyboard(self, game, main_count, reserve_count):
+        """Кнопки под постом в канале: запись/отписка (обрабатывает handle_registration_callback)"""
+        if game.registration_mode == 'lottery' and not game.lottery_drawn_at:
+            join_label = "🎲 Подать заявку"
+        elif main_count < game.max_players:
+            join_label = f"📝 Записаться · {main_count}/{game.max_players}"
+        else:
+            join_label = f"⏳ В резерв · {main_count}/{game.max_players} +{reserve_count}"
+
+        keyboard = [[
+            InlineKeyboardButton(join_label, callback_data=f"join_{game.id}"),
+            InlineKeyboardButton("🚫 Отписаться", callback_data=f"leave_{game.id}"),
+        ]]
+        link = self.join_link(game.id)
+        if link:
+            keyboard.append([InlineKeyboardButton("🤖 Открыть в боте", url=link)])
+        return InlineKeyboardMarkup(keyboard)
+
+    def join_link(self, game_id):
+        """Deep link /start join_<id>; None, пока бот не инициализирован"""
+        try:
+            username = self.bot.username
+        except RuntimeError:
+            return None
+        return f"https://t.me/{username}?start=join_{game_id}"
     
-    def _format_players_list(self, registrations, max_players):
-        """Форматирование списка игроков"""
-        main_players = [r for r in registrations if not r.is_reserve]
-        reserve_players = [r for r in registrations if r.is_reserve]
+    async def set_template(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Просмотр и изменение шаблонов анонсов
+
+        /settemplate                     — список шаблонов и плейсхолдеров
+        /settemplate <name>              — текущий текст шаблона
+        /settemplate <name> + текст      — сохранить шаблон (текст со второй строки)
+        /settemplate game <id> + текст   — свой текст для игры (без текста — сброс)
+        /settemplate recurring <id> + текст — свой текст для регулярного шаблона
+        """
+        user_id = update.effective_user.id
         
-        lines = []
+        if not self.db.is_admin(user_id):
+            await update.message.reply_text("❌ Эта команда доступна только администраторам!")
+            return
         
-        # Основной список
-        for i, reg in enumerate(main_players, 1):
-            if reg.user and reg.user.game_nickname:
-                player_name = reg.user.game_nickname
-            else:
-                player_name = "Неизвестный игрок"
-            lines.append(f"{i}. {player_name}")
-        
-        # Резервный список
-        if reserve_players:
-            lines.append("\n⏳ Резерв:")
-            for i, reg in enumerate(reserve_players, 1):
-                if reg.user and reg.user.game_nickname:
-                    player_name = reg.user.game_nickname
+        header, _, body = update.message.text.partition('\n')
+        args = header.split()[1:]
+        body = body.strip()
+        
+        if not args:
+            stored = {t.name: t for t in self.db.get_announcement_templates()}
+            names = sorted(set(DEFAULT_TEMPLATES) | set(stored))
+            text = "🧩 ШАБЛОНЫ АНОНСОВ:\n\n"
+            for name in names:
+                if name in stored:
+                    text += f"• {name} — {stored[name].display_name} (v{stored[name].version})\n"
                 else:
-                    player_name = "Неизвестный игрок"
-                lines.append(f"R{i}. {player_name}")
+                    text += f"• {name} — {DEFAULT_TEMPLATES[name]['name']} (встроенный)\n"
+            text += "\n📌 Плейсхолдеры:\n"
+            text += "\n".join(f"{{{{{key}}}}} — {value}" for key, value in PLACEHOLDERS.items())
+            text += "\n\n💡 /settemplate <имя>, а со второй строки — текст шаблона"
+            await update.message.reply_text(text)
+            return
         
-        # Если записей нет
-        if not lines:
-            return "Пока никто не записался 😔"
+        if body:
+            unknown = validate_template(body)
+            if unknown:
+                await update.message.reply_text(
+                    "❌ Неизвестные плейсхолдеры: " + ", ".join(f"{{{{{name}}}}}" for name in unknown)
+                )
+                return
+            errors = validate_template_html(body)
+            if errors:
+                # С такой разметкой Telegram отклонил бы каждую публикацию анонса
+                await update.message.reply_text(
+                    "❌ Ошибка HTML-разметки:\n" + "\n".join(f"• {error}" for error in errors[:5])
+                )
+                return
         
-        return "\n".join(lines)
+        if args[0] in ('game', 'recurring'):
+            try:
+                target_id = int(args[1])
+            except (IndexError, ValueError):
+                await update.message.reply_text(f"❌ Укажите ID: /settemplate {args[0]} <id>")
+                return
+            
+            if args[0] == 'game':
+                updated = self.db.update_game(target_id, {'custom_text': body or None})
+            else:
+                updated = self.db.update_recurring_template(target_id, {'custom_text': body or None})
+            
+            if not updated:
+                await update.message.reply_text("❌ Не найдено!")
+                return
+            
+            if args[0] == 'game':
+                # update_game уже поставил обновление анонса в outbox
+                self.outbox.notify()
+            
+            await update.message.reply_text(
+                "✅ Свой текст анонса сохранен" if body else "✅ Свой текст анонса сброшен"
+            )
+            return
+        
+        name = args[0]
+        if not body:
+            template = self.db.get_announcement_template(name)
+            if template:
+                source, version = template.body, f"v{template.version}"
+            elif name in DEFAULT_TEMPLATES:
+                source, version = DEFAULT_TEMPLATES[name]['template'], "встроенный"
+            else:
+                await update.message.reply_text("❌ Шаблон не найден!")
+                return
+            await update.message.reply_text(f"🧩 {name} ({version}):\n\n{source}")
+            return
+        
+        display_name = DEFAULT_TEMPLATES.get(name, {}).get('name')
+        template = self.db.save_announcement_template(name, body, display_name, user_id)
+        self.templates.invalidate()
+        await update.message.reply_text(f"✅ Шаблон '{name}' сохранен (v{template.version})")
     
+    async def set_channels(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Каналы публикации игр и регулярных шаблонов
+
+        /setchannels                                 — каналы по умолчанию и настроенные
+        /setchannels game <id> <chat_id> ...         — свои каналы для игры
+        /setchannels recurring <id> <chat_id> ...    — свои каналы для регулярного шаблона
+        Без chat_id — сброс к каналам по умолчанию.
+        """
+        user_id = update.effective_user.id
+
+        if not self.db.is_admin(user_id):
+            await update.message.reply_text("❌ Эта команда доступна только администраторам!")
+            return
+
+        args = context.args or []
+
+        if not args:
+            default_channels = default_channel_ids()
+            text = "📡 КАНАЛЫ ПУБЛИКАЦИИ:\n\n"
+            text += "По умолчанию (CHANNEL_ID): " + (", ".join(default_channels) or "не заданы") + "\n"
+
+            owners = {}
+            for target in self.db.get_all_channel_targets():
+                if target.game_id:
+                    key = f"Игра {target.game_id}"
+                else:
+                    key = f"Шаблон {target.recurring_template_id}"
+                owners.setdefault(key, []).append(target.chat_id)
+            for key, chat_ids in owners.items():
+                text += f"• {key}: {', '.join(chat_ids)}\n"
+
+            text += "\n💡 /setchannels game|recurring <id> <chat_id> ..."
+            await update.message.reply_text(text)
+            return
+
+        if args[0] not in ('game', 'recurring') or len(args) < 2 or not args[1].isdigit():
+            await update.message.reply_text("❌ Формат: /setchannels game|recurring <id> <chat_id> ...")
+            return
+
+        target_id = int(args[1])
+        chat_ids = args[2:]
+        if args[0] == 'game':
+            updated = self.db.set_channel_targets(chat_ids, game_id=target_id)
+        else:
+            updated = self.db.set_channel_targets(chat_ids, recurring_template_id=target_id)
+
+        if not updated:
+            await update.message.reply_text("❌ Не найдено!")
+            return
+
+        # Опубликованные игры уже поставлены в outbox: анонс уйдет в новые каналы
+        self.outbox.notify()
+        await update.message.reply_text(
+            f"✅ Каналы сохранены: {', '.join(chat_ids)}" if chat_ids else "✅ Используются каналы по умолчанию"
+        )
+
+    async def set_lottery(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Режим записи через розыгрыш для популярных игр
+
+        /lottery game|recurring <id> <минуты> [weighted] — окно заявок после публикации
+        /lottery game|recurring <id> off                 — обычная запись (кто первый)
+        """
+        user_id = update.effective_user.id
+
+        if not self.db.is_admin(user_id):
+            await update.message.reply_text("❌ Эта команда доступна только администраторам!")
+            return
+
+        args = context.args or []
+        usage = (
+            "❌ Формат: /lottery game|recurring <id> <минуты> [weighted]\n"
+            "или /lottery game|recurring <id> off"
+        )
+        if len(args) < 3 or args[0] not in ('game', 'recurring') or not args[1].isdigit():
+            await update.message.reply_text(usage)
+            return
+
+        if args[2] == 'off':
+            mode, window, weighted = 'fcfs', None, False
+        elif args[2].isdigit() and int(args[2]) > 0:
+            mode, window, weighted = 'lottery', int(args[2]), 'weighted' in args[3:]
+        else:
+            await update.message.reply_text(usage)
+            return
+
+        target = {'game_id': int(args[1])} if args[0] == 'game' else {'recurring_template_id': int(args[1])}
+        if not self.db.set_registration_mode(mode, window, weighted, **target):
+            await update.message.reply_text("❌ Не найдено!")
+            return
+
+        if args[0] == 'game':
+            # Для опубликованной игры розыгрыш (или обновление кнопок) уже в outbox
+            self.db.enqueue_refresh(int(args[1]))
+            self.outbox.notify()
+
+        if mode == 'lottery':
+            await update.message.reply_text(
+                f"🎲 Запись через розыгрыш: окно заявок {window} мин после публикации"
+                + (", вес по числу сыгранных игр" if weighted else "")
+            )
+        else:
+            await update.message.reply_text("✅ Обычная запись (кто первый)")
+
     async def cancel_creation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Отмена создания анонса"""
         context.user_data.pop('game_announcement', None)
@@ -713,9 +943,19 @@ class GameAnnouncementManager:
         )
         return ConversationHandler.END
     
+    async def timeout_creation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Таймаут создания анонса: очищаем черновик"""
+        context.user_data.pop('game_announcement', None)
+        if update.effective_chat:
+            await context.bot.send_message(
+                update.effective_chat.id,
+                "⌛ Время на создание анонса истекло. Начните заново: /newgame",
+                reply_markup=ReplyKeyboardRemove()
+            )
+    
     async def update_channel_announcement(self, game_id):
-        """Обновление анонса в канале с актуальным списком игроков"""
-        self.logger.info(f"Начинаем обновление анонса для игры {game_id}")
+        """Обновление анонса во всех каналах с актуальным списком игроков"""
+        self.logger.debug("Начинаем обновление анонса для игры %s", game_id, extra={'game_id': game_id})
         
         game = self.db.get_game_by_id(game_id)
         if not game:
@@ -724,38 +964,51 @@ class GameAnnouncementManager:
         
         # Проверяем, опубликована ли игра
         if not game.is_published:
-            self.logger.info(f"Игра {game_id} еще не опубликована, пропускаем обновление анонса")
+            self.logger.debug("Игра %s еще не опубликована, пропускаем обновление анонса", game_id)
             return
         
-        if not game.channel_message_id:
-            self.logger.error(f"❌ Для игры {game_id} не указан channel_message_id")
+        messages = self.db.get_channel_messages([game_id])[game_id]
+        if not messages:
+            self.logger.error(f"❌ Для игры {game_id} нет опубликованных сообщений в каналах")
             return
         
-        channel_id = os.getenv('CHANNEL_ID')
-        if not channel_id:
-            self.logger.error("❌ CHANNEL_ID не указан в переменных окружения")
-            return
+        # Текст и кнопки со счетчиками одни на все каналы, правки уходят параллельно
+        new_text, reply_markup = await self._format_final_announcement(game)
+        results = await asyncio.gather(
+            *(self._edit_in_channel(game_id, chat_id, message_id, new_text, reply_markup)
+              for chat_id, message_id in messages.items()),
+            return_exceptions=True
+        )
         
-        self.logger.info(f"Обновляем сообщение {game.channel_message_id} в канале {channel_id}")
+        # Остальные ошибки пробрасываем: outbox-воркер повторит попытку
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    async def _edit_in_channel(self, game_id, chat_id, message_id, text, reply_markup=None):
+        """Правка анонса в одном канале в пределах лимитов"""
+        self.logger.debug("Обновляем сообщение %s в канале %s", message_id, chat_id)
         
         try:
-            # Формируем обновленный текст анонса
-            new_text = await self._format_final_announcement(game)
-            
-            # Редактируем сообщение в канале
+            # Правки расходуют тот же лимит чата, что и отправка
+            await self.rate_limiter.acquire(chat_id)
             await self.bot.edit_message_text(
-                chat_id=channel_id,
-                message_id=game.channel_message_id,
-                text=new_text,
-                parse_mode='HTML'
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                parse_mode='HTML',
+                reply_markup=reply_markup
             )
-            self.logger.info(f"✅ Анонс игры {game_id} обновлен в канале")
+            self.logger.info("✅ Анонс игры %s обновлен в %s", game_id, chat_id, extra={'game_id': game_id})
             
         except Exception as e:
             error_msg = str(e)
+            if isinstance(e, RetryAfter):
+                self.rate_limiter.retry_after(chat_id, float(e.retry_after))
             if "Message is not modified" in error_msg:
-                self.logger.info(f"✅ Сообщение для игры {game_id} не требует изменений")
+                self.logger.debug("Сообщение для игры %s в %s не требует изменений", game_id, chat_id)
             elif "Message to edit not found" in error_msg:
-                self.logger.error(f"❌ Сообщение для игры {game_id} не найдено в канале")
+                self.logger.error(f"❌ Сообщение для игры {game_id} не найдено в {chat_id}")
             else:
-                self.logger.error(f"❌ Ошибка при обновлении анонса в канале: {e}")
\ No newline at end of file
+                self.logger.error(f"❌ Ошибка при обновлении анонса в {chat_id}: {e}")
+                raise
@@ -1,7 +1,10 @@
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.constants import ChatType
 from telegram.ext import ContextTypes, CallbackQueryHandler
 from datetime import datetime
 import logging
+import time
+from .query_budget import query_budget
 
 class GameRegistrationManager:
     def __init__(self, database, announcement_manager):
@@ -9,6 +12,7 @@ class GameRegistrationManager:
         self.announcement_manager = announcement_manager
         self.logger = logging.getLogger(__name__)
     
+    @query_budget(2)
     async def show_games_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показ списка доступных игр (только опубликованных)"""
         # Получаем только опубликованные игры
@@ -19,13 +23,18 @@ class GameRegistrationManager:
             return
         
         text = "🎮 ДОСТУПНЫЕ ИГРЫ:\n\n"
+        if self.db.degraded:
+            text += "⚠️ База недоступна — показаны последние сохраненные данные, запись временно закрыта.\n\n"
+        
+        # Записи на все игры одним запросом вместо двух запросов на каждую игру
+        registrations_by_game = self.db.get_registrations_for_games([game.id for game in games])
         
         for game in games:
             # Дополнительная проверка, что игра опубликована
             if not game.is_published:
                 continue
                 
-            registrations = self.db.get_game_registrations(game.id)
+            registrations = registrations_by_game.get(game.id, [])
             main_players = [r for r in registrations if not r.is_reserve]
             reserve_players = [r for r in registrations if r.is_reserve]
             
@@ -41,7 +50,7 @@ class GameRegistrationManager:
                 text += f" +{len(reserve_players)} в резерве"
             
             # Проверяем, записан ли пользователь
-            user_registered = self.db.is_user_registered(game.id, update.effective_user.id)
+            user_registered = any(r.user_id == update.effective_user.id for r in registrations)
             status = "✅ Вы записаны" if user_registered else "❌ Вы не записаны"
             text += f"\n{status}\n"
             
@@ -65,122 +74,284 @@ class GameRegistrationManager:
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
             text = ""  # Сбрасываем для следующего сообщения
+        
+        # Выбор нескольких игр сразу: отметки хранятся в user_data, запись — одним действием
+        available = [
+            (game.id, f"{game.game_date.strftime('%d.%m')} {game.title}")
+            for game in games
+            if game.is_published and not any(
+                r.user_id == update.effective_user.id for r in registrations_by_game.get(game.id, [])
+            )
+        ]
+        if len(available) > 1:
+            context.user_data['game_picker'] = {'games': available, 'picked': []}
+            await update.message.reply_text(
+                "🗂 Записаться сразу на несколько игр — отметьте нужные:",
+                reply_markup=self._picker_keyboard(context.user_data['game_picker'])
+            )
+
+    def _picker_keyboard(self, picker):
+        """Клавиатура выбора игр: отметки переключаются без обращения к БД"""
+        keyboard = [
+            [InlineKeyboardButton(
+                f"{'☑️' if game_id in picker['picked'] else '⬜️'} {label}"[:60],
+                callback_data=f"pick_{game_id}"
+            )]
+            for game_id, label in picker['games']
+        ]
+        keyboard.append([InlineKeyboardButton(
+            f"✅ Записаться на выбранные ({len(picker['picked'])})",
+            callback_data="pickdone"
+        )])
+        return InlineKeyboardMarkup(keyboard)
+
+    @query_budget(4)
+    async def handle_picker_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отметка игр и запись на все выбранные одним действием"""
+        query = update.callback_query
+        picker = context.user_data.get('game_picker')
+        if not picker:
+            await query.answer("Список устарел, откройте /games заново", show_alert=True)
+            return
+
+        if query.data.startswith('pick_'):
+            game_id = int(query.data.split('_')[1])
+            if game_id in picker['picked']:
+                picker['picked'].remove(game_id)
+            else:
+                picker['picked'].append(game_id)
+            await query.answer()
+            await query.edit_message_reply_markup(reply_markup=self._picker_keyboard(picker))
+            return
+
+        if not picker['picked']:
+            await query.answer("Отметьте хотя бы одну игру", show_alert=True)
+            return
+        await query.answer()
+
+        user_id = query.from_user.id
+        user = self.db.get_user(user_id)
+        if not user or not user.registration_complete:
+            await query.edit_message_text(
+                "❌ Сначала нужно завершить регистрацию!\n"
+                "Используйте /registrate для регистрации."
+            )
+            return
 
-    async def _join_game(self, query, game_id, user_id):
+        results = self.db.register_for_games(picker['picked'], user_id)
+        context.user_data.pop('game_picker', None)
+        # Обновления анонсов всех игр уже в outbox — будим воркер один раз
+        self.announcement_manager.outbox.notify()
+
+        self.logger.info("Пользователь %s записан на %s игр из %s", user_id, len(results), len(picker['picked']),
+                         extra={'user_id': user_id, 'audit': True})
+
+        lines = []
+        for game_id, label in picker['games']:
+            if game_id not in picker['picked']:
+                continue
+            status, position = results.get(game_id, (None, None))
+            if status == 'main':
+                lines.append(f"✅ {label} — номер {position}")
+            elif status == 'reserve':
+                lines.append(f"⏳ {label} — резерв R{position}")
+            elif status == 'lottery':
+                lines.append(f"🎲 {label} — заявка на розыгрыш")
+            else:
+                lines.append(f"▫️ {label} — уже записаны или запись закрыта")
+
+        await query.edit_message_text(
+            "🗂 Запись на выбранные игры:\n\n" + "\n".join(lines) +
+            "\n\n📢 Списки в анонсах канала обновятся автоматически!"
+        )
+
+    def _callback_reply(self, query):
+        """Ответ на нажатие: в личке — правка сообщения, под постом в канале — всплывающее окно
+
+        Пост в канале общий для всех, поэтому личный ответ в него не пишется.
+        """
+        in_channel = query.message is not None and query.message.chat.type == ChatType.CHANNEL
+
+        async def reply(text, alert=None, deep_link=None):
+            if not in_channel:
+                await query.edit_message_text(text)
+            elif deep_link:
+                # t.me/<bot>?start=... в ответе на callback открывает чат с ботом
+                await query.answer(url=deep_link)
+            else:
+                await query.answer((alert or text)[:200], show_alert=True)
+
+        return in_channel, reply
+
+    async def _join_game(self, game_id, user_id, reply):
         """Запись на игру с обновлением анонса в канале"""
-        self.logger.info(f"Пользователь {user_id} записывается на игру {game_id}")
+        self.logger.debug("Пользователь %s записывается на игру %s", user_id, game_id,
+                          extra={'user_id': user_id, 'game_id': game_id})
         
         # Проверяем, зарегистрирован ли пользователь
         user = self.db.get_user(user_id)
         if not user or not user.registration_complete:
-            await query.edit_message_text(
+            await reply(
                 "❌ Сначала нужно завершить регистрацию!\n"
-                "Используйте /registrate для регистрации."
+                "Используйте /registrate для регистрации.",
+                deep_link=self.announcement_manager.join_link(game_id)
             )
             return
         
         # Проверяем, существует ли игра и опубликована ли она
         game = self.db.get_game_by_id(game_id)
         if not game:
-            await query.edit_message_text("❌ Игра не найдена!")
+            await reply("❌ Игра не найдена!")
             return
         
         if not game.is_published:
-            await query.edit_message_text("❌ Эта игра еще не опубликована!")
+            await reply("❌ Эта игра еще не опубликована!")
             return
         
+        if game.registration_mode == 'lottery' and not game.lottery_drawn_at:
+            # Окно заявок: одна вставка без пересчета состава и правки анонса
+            result = self.db.enter_lottery(game_id, user_id)
+            closes_at = game.lottery_closes_at.strftime('%H:%M') if game.lottery_closes_at else 'скоро'
+            if result == 'entered':
+                self.logger.info("Заявка пользователя %s на розыгрыш игры %s", user_id, game_id,
+                                 extra={'user_id': user_id, 'game_id': game_id, 'audit': True})
+                await reply(
+                    f"🎲 Заявка принята!\n"
+                    f"🏆 {game.title}\n"
+                    f"📅 {game.game_date.strftime('%d.%m %H:%M')}\n\n"
+                    f"Места разыгрываются в {closes_at} среди всех заявок — "
+                    f"время нажатия не важно.",
+                    alert=f"🎲 Заявка принята! Розыгрыш мест в {closes_at}"
+                )
+                return
+            if result == 'duplicate':
+                await reply(f"🎲 Вы уже подали заявку, розыгрыш в {closes_at}")
+                return
+            # 'closed': розыгрыш только что прошел — записываем в общем порядке
+        
         # Записываем на игру
         registration = self.db.register_for_game(game_id, user_id)
         
         if registration is None:
-            await query.edit_message_text("❌ Вы уже записаны на эту игру!")
+            await reply("❌ Вы уже записаны на эту игру!")
             return
         
-        self.logger.info(f"Пользователь {user_id} успешно записан на игру {game_id}")
+        self.logger.info("Пользователь %s записан на игру %s", user_id, game_id,
+                         extra={'user_id': user_id, 'game_id': game_id, 'audit': True})
         
-        # Обновляем анонс в канале только если игра опубликована
-        if game.is_published and game.channel_message_id:
-            try:
-                self.logger.info(f"Начинаем обновление анонса для игры {game_id}")
-                await self.announcement_manager.update_channel_announcement(game_id)
-                self.logger.info(f"Анонс для игры {game_id} обновлен")
-            except Exception as e:
-                self.logger.error(f"⚠️ Ошибка при обновлении анонса: {e}")
+        # Обновление анонса в канале уже записано в outbox вместе с записью — будим воркер
+        self.announcement_manager.outbox.notify()
         
-        # Формируем ответ
-        registrations = self.db.get_game_registrations(game_id)
-        main_players = [r for r in registrations if not r.is_reserve]
+        # Формируем ответ: место считается по индексу очереди, без загрузки состава
+        place = self.db.get_queue_place(registration)
+        game_date = game.game_date.strftime('%d.%m %H:%M')
         
         if registration.is_reserve:
-            position = len([r for r in registrations if r.is_reserve])
             response = (
                 f"✅ Вы записаны на игру!\n"
                 f"🏆 {game.title}\n"
-                f"📅 {game.game_date.strftime('%d.%m %H:%M')}\n\n"
-                f"⚠️ Вы в резерве под номером {position}\n"
+                f"📅 {game_date}\n\n"
+                f"⚠️ Вы в резерве под номером {place}\n"
                 f"Как только место освободится, вы перейдете в основную группу."
             )
+            alert = f"⏳ {game.title}, {game_date}\nВы в резерве под номером {place}"
         else:
             response = (
                 f"✅ Вы успешно записались на игру!\n"
                 f"🏆 {game.title}\n"
-                f"📅 {game.game_date.strftime('%d.%m %H:%M')}\n"
+                f"📅 {game_date}\n"
                 f"📍 {game.location}\n\n"
-                f"🎯 Ваш номер в списке: {len(main_players)}\n"
-                f"📢 Список в анонсе канала обновлен автоматически!"
+                f"🎯 Ваш номер в списке: {place}\n"
+                f"📢 Список в анонсе канала обновится автоматически!"
             )
+            alert = f"✅ {game.title}, {game_date}\nВаш номер в списке: {place}"
         
-        await query.edit_message_text(response)
+        await reply(response, alert=alert)
 
-    async def _leave_game(self, query, game_id, user_id):
+    async def _leave_game(self, game_id, user_id, reply):
         """Отписка от игры с обновлением анонса в канале"""
-        self.logger.info(f"Пользователь {user_id} отписывается от игры {game_id}")
+        self.logger.debug("Пользователь %s отписывается от игры %s", user_id, game_id,
+                          extra={'user_id': user_id, 'game_id': game_id})
         
         # Проверяем, существует ли игра и опубликована ли она
         game = self.db.get_game_by_id(game_id)
         if not game:
-            await query.edit_message_text("❌ Игра не найдена!")
+            await reply("❌ Игра не найдена!")
             return
         
+        if game.registration_mode == 'lottery' and not game.lottery_drawn_at:
+            if self.db.leave_lottery(game_id, user_id):
+                await reply(f"🚫 Заявка на розыгрыш игры «{game.title}» отозвана")
+                return
+        
         success = self.db.unregister_from_game(game_id, user_id)
         
         if not success:
-            await query.edit_message_text("❌ Вы не были записаны на эту игру!")
+            await reply("❌ Вы не были записаны на эту игру!")
             return
         
-        self.logger.info(f"Пользователь {user_id} успешно отписан от игры {game_id}")
+        self.logger.info("Пользователь %s отписан от игры %s", user_id, game_id,
+                         extra={'user_id': user_id, 'game_id': game_id, 'audit': True})
         
-        # Обновляем анонс в канале только если игра опубликована
-        if game.is_published and game.channel_message_id:
-            try:
-                self.logger.info(f"Начинаем обновление анонса для игры {game_id}")
-                await self.announcement_manager.update_channel_announcement(game_id)
-                self.logger.info(f"Анонс для игры {game_id} обновлен")
-            except Exception as e:
-                self.logger.error(f"⚠️ Ошибка при обновлении анонса: {e}")
+        # Обновление анонса в канале уже записано в outbox вместе с записью — будим воркер
+        self.announcement_manager.outbox.notify()
         
+        game_date = game.game_date.strftime('%d.%m %H:%M')
         response = (
             f"🚫 Вы отписались от игры:\n"
             f"🏆 {game.title}\n"
-            f"📅 {game.game_date.strftime('%d.%m %H:%M')}\n\n"
+            f"📅 {game_date}\n\n"
             f"📢 Список в анонсе канала обновлен автоматически!\n"
             f"Надеемся увидеть вас в следующий раз! 👋"
         )
         
-        await query.edit_message_text(response)
+        await reply(response, alert=f"🚫 Вы отписались: {game.title}, {game_date}")
     
+    @query_budget(10)
     async def handle_registration_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработка callback'ов записи/отписки"""
+        """Обработка callback'ов записи/отписки (из списка /games и из-под поста в канале)"""
+        started = time.perf_counter()
         query = update.callback_query
-        await query.answer()
+        in_channel, reply = self._callback_reply(query)
+        if not in_channel:
+            # Под постом в канале ответом на callback будет само всплывающее окно
+            await query.answer()
         
         user_id = query.from_user.id
         data = query.data
+        game_id = None
         
         if data.startswith('join_'):
             game_id = int(data.split('_')[1])
-            await self._join_game(query, game_id, user_id)
+            await self._join_game(game_id, user_id, reply)
         
         elif data.startswith('leave_'):
             game_id = int(data.split('_')[1])
-            await self._leave_game(query, game_id, user_id)
+            await self._leave_game(game_id, user_id, reply)
+        
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        self.logger.info("Callback %s обработан за %s мс", data, duration_ms, extra={
+            'update_id': update.update_id,
+            'user_id': user_id,
+            'game_id': game_id,
+            'duration_ms': duration_ms,
+        })
+
+    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/start, в том числе deep link из поста в канале: /start join_<id>"""
+        payload = context.args[0] if context.args else ''
+        
+        if payload.startswith('join_') and payload[5:].isdigit():
+            async def reply(text, alert=None, deep_link=None):
+                await update.message.reply_text(text)
+            
+            await self._join_game(int(payload[5:]), update.effective_user.id, reply)
+            return
+        
+        await update.message.reply_text(
+            "👋 Привет! Я бот для записи на игры.\n\n"
+            "📝 /registrate — регистрация\n"
+            "🎮 /games — список игр\n"
+            "🔔 /subscribe — автозапись на регулярные игры\n"
+            "👤 /profile — ваш профиль"
+        )
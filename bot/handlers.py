@@ -1,6 +1,7 @@
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import ContextTypes, CommandHandler, MessageHandler, filters, ConversationHandler
+from telegram.ext import ContextTypes, CommandHandler, MessageHandler, TypeHandler, filters, ConversationHandler
 from .registration import RegistrationManager, RegistrationState
+from .persistence import conversation_timeout
 import os
 
 class Handlers:
@@ -31,9 +32,15 @@ class Handlers:
                 RegistrationState.CONFIRM: [
                     MessageHandler(filters.TEXT, self.registration_manager.confirm_registration)
                 ],
+                ConversationHandler.TIMEOUT: [
+                    TypeHandler(Update, self.registration_manager.timeout_registration)
+                ],
             },
             fallbacks=[CommandHandler('cancel', self.registration_manager.cancel_registration)],
-            allow_reentry=True
+            allow_reentry=True,
+            conversation_timeout=conversation_timeout(),
+            name='registration',
+            persistent=True
         )
     
     async def start_edit_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -78,6 +85,8 @@ class Handlers:
             return
         
         profile_text = self._format_profile(user)
+        if self.db.degraded:
+            profile_text += "\n\n⚠️ База недоступна — показаны последние сохраненные данные."
         
         if user.photo_id:
             await update.message.reply_photo(
@@ -0,0 +1,156 @@
+import os
+import json
+import queue
+import random
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+# Поля, которые попадают в JSON-лог, если переданы через extra={...}
+STRUCTURED_FIELDS = (
+    'update_id', 'user_id', 'game_id', 'duration_ms', 'resident_users', 'conversations',
+    'queue_depth', 'queue_by_lane', 'active_updates', 'handler_ms', 'queue_wait_ms', 'shed_updates',
+    'db_state', 'pool_size', 'pool_checked_out', 'pool_overflow', 'pool_utilization', 'checkout_wait_ms',
+    'checkout_wait_max_ms', 'checkout_timeouts', 'connect_errors', 'invalidated_connections', 'audit',
+)
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирование записей лога в одну JSON-строку"""
+
+    def format(self, record):
+        payload = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                payload[field] = value
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Сэмплирование болтливых логгеров
+
+    WARNING и выше и записи аудита (extra={'audit': True}: записи на игры, отписки,
+    заявки) пропускаются всегда; сэмплируются только массовые DEBUG/INFO.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._cache = {}
+
+    def _rate_for(self, name):
+        rate = self._cache.get(name)
+        if rate is None:
+            rate = 1.0
+            # Ищем самый длинный префикс: bot.game_registration покрывает и дочерние логгеры
+            best = ''
+            for prefix, value in self.rates.items():
+                if (name == prefix or name.startswith(prefix + '.')) and len(prefix) > len(best):
+                    best, rate = prefix, value
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or getattr(record, 'audit', False):
+            return True
+        rate = self._rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class _BackgroundQueueHandler(QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке"""
+
+    def prepare(self, record):
+        # Форматирование и запись на диск выполняются в потоке QueueListener
+        return record
+
+
+def _parse_sampling(value):
+    """Разбор LOG_SAMPLING вида 'bot.game_registration=0.1,bot.game_announcements=0.5'"""
+    rates = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        name, rate = item.split('=', 1)
+        try:
+            rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+def _build_file_handler():
+    """Файловый обработчик с ротацией по размеру или по времени"""
+    log_file = os.getenv('LOG_FILE', 'bot.log')
+    backup_count = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+
+    if os.getenv('LOG_ROTATION', 'size') == 'time':
+        return TimedRotatingFileHandler(
+            log_file,
+            when=os.getenv('LOG_ROTATION_WHEN', 'midnight'),
+            backupCount=backup_count,
+            encoding='utf-8'
+        )
+    return RotatingFileHandler(
+        log_file,
+        maxBytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+        backupCount=backup_count,
+        encoding='utf-8'
+    )
+
+
+def setup_logging():
+    """Настройка неблокирующего логирования через очередь и фоновый поток"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    text_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+    file_handler = _build_file_handler()
+    if os.getenv('LOG_FORMAT', 'json') == 'json':
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(text_format))
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(text_format))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _BackgroundQueueHandler(log_queue)
+    # Сэмплирование до постановки в очередь, чтобы отброшенные записи ничего не стоили
+    queue_handler.addFilter(SamplingFilter(_parse_sampling(
+        os.getenv('LOG_SAMPLING', 'bot.game_registration=0.1')
+    )))
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    # Шумные библиотеки пишут по строке на каждый HTTP-запрос к Bot API
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Сброс очереди логов на диск и остановка фонового потока"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
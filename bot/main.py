@@ -1,34 +1,40 @@
+import time
+# Отсчет отчета о запуске — до тяжелых импортов (telegram, sqlalchemy)
+PROCESS_STARTED = time.perf_counter()
+
 import os
 import logging
 import asyncio
 from dotenv import load_dotenv
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackQueryHandler
-from telegram import ReplyKeyboardRemove
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, MessageHandler, TypeHandler, filters, ConversationHandler, CallbackQueryHandler
+from telegram import Update, ReplyKeyboardRemove
+from telegram.constants import ChatType
+from telegram.error import BadRequest
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.date import DateTrigger
-from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime
-from .database import Database
+from .database import Database, DatabaseUnavailable
 from .handlers import Handlers
 from .game_announcements import GameAnnouncementManager, GameAnnouncementStates
 from .game_registration import GameRegistrationManager
 from .recurring_games import RecurringGameManager, RecurringGameStates
+from .logging_config import setup_logging, stop_logging
+from .channels import default_channel_ids
+from .persistence import PostgresPersistence, conversation_timeout
+from .rate_limit import FloodGuard
+from .dispatch import PriorityUpdateProcessor
+from .startup import StartupReport, fast_start_enabled
 
 # Загрузка переменных окружения
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+# Настройка логирования (запись на диск в фоновом потоке)
+setup_logging()
 
 class TelegramBot:
     def __init__(self):
+        self.startup = StartupReport(PROCESS_STARTED)
+        self.startup.mark('импорт')
+        self.fast_start = fast_start_enabled()
         self.bot_token = os.getenv('BOT_TOKEN')
         if not self.bot_token:
             raise ValueError("BOT_TOKEN не найден в переменных окружения!")
@@ -36,19 +42,35 @@ class TelegramBot:
         self.db = Database()
         self.handlers = Handlers(self.db)
         
-        # Создаем приложение
-        self.application = Application.builder().token(self.bot_token).build()
+        # Создаем приложение (TELEGRAM_API_BASE_URL позволяет подменить Bot API, например для нагрузочных тестов)
+        # Состояния диалогов и user_data живут в Postgres и переживают перезапуск
+        self.persistence = PostgresPersistence(self.db)
+        # Апдейты обрабатываются параллельно с полосами приоритета (админы и личка впереди)
+        self.update_processor = PriorityUpdateProcessor()
+        builder = Application.builder().token(self.bot_token).persistence(self.persistence).concurrent_updates(
+            self.update_processor
+        )
+        api_base_url = os.getenv('TELEGRAM_API_BASE_URL')
+        if api_base_url:
+            builder = builder.base_url(api_base_url)
+        self.application = builder.build()
         
         # Инициализируем планировщик
         self.scheduler = AsyncIOScheduler()
         
         # Инициализируем менеджеры
         self.game_manager = GameAnnouncementManager(self.db, self.application.bot, self.scheduler)
+        self.game_manager.outbox.defer_refreshes = self.update_processor.defer_refreshes
         self.registration_manager = GameRegistrationManager(self.db, self.game_manager)
         self.recurring_manager = RecurringGameManager(self.db, self.game_manager)
+        self.flood_guard = FloodGuard()
+        self.startup.mark('инициализация')
         
     def setup_handlers(self):
         """Настройка всех обработчиков"""
+        # Защита от флуда раньше всех обработчиков: отказ не доходит до базы
+        self.application.add_handler(TypeHandler(Update, self.guard_update), group=-1)
+        
         # Регистрация пользователей
         self.application.add_handler(self.handlers.get_conv_handler())
         self.application.add_handler(CommandHandler("profile", self.handlers.profile))
@@ -92,8 +114,14 @@ class TelegramBot:
                 GameAnnouncementStates.CONFIRM: [
                     MessageHandler(filters.TEXT & ~filters.COMMAND, self.game_manager.confirm_announcement)
                 ],
+                ConversationHandler.TIMEOUT: [
+                    TypeHandler(Update, self.game_manager.timeout_creation)
+                ],
             },
-            fallbacks=[CommandHandler("cancel", self.game_manager.cancel_creation)]
+            fallbacks=[CommandHandler("cancel", self.game_manager.cancel_creation)],
+            conversation_timeout=conversation_timeout(),
+            name="newgame",
+            persistent=True
         )
         
         self.application.add_handler(newgame_conv_handler)
@@ -105,40 +133,132 @@ class TelegramBot:
                 "AWAITING_GAME_ID": [
                     MessageHandler(filters.TEXT & ~filters.COMMAND, self.recurring_manager.handle_game_edit)
                 ],
-                "AWAITING_NEW_DATE": [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.recurring_manager.handle_new_date)
+                "AWAITING_FIELD": [
+                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.recurring_manager.handle_edit_field)
+                ],
+                "AWAITING_VALUE": [
+                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.recurring_manager.handle_edit_value)
+                ],
+                ConversationHandler.TIMEOUT: [
+                    TypeHandler(Update, self.timeout_edit)
                 ],
             },
-            fallbacks=[CommandHandler("cancel", self.cancel_edit)]
+            fallbacks=[CommandHandler("cancel", self.cancel_edit)],
+            conversation_timeout=conversation_timeout(),
+            name="editgame",
+            persistent=True
         )
         
         self.application.add_handler(edit_game_conv_handler)
         
-        # Регистрация на игры
+        # Регистрация на игры (кнопки под постом в канале ведут в тот же callback)
+        self.application.add_handler(CommandHandler("start", self.registration_manager.start))
         self.application.add_handler(CommandHandler("games", self.registration_manager.show_games_list))
+        self.application.add_handler(CommandHandler("subscribe", self.recurring_manager.subscribe))
+        self.application.add_handler(CommandHandler("unsubscribe", self.recurring_manager.unsubscribe))
         self.application.add_handler(CallbackQueryHandler(
             self.registration_manager.handle_registration_callback, 
             pattern='^(join|leave)_'
         ))
+        self.application.add_handler(CallbackQueryHandler(
+            self.registration_manager.handle_picker_callback,
+            pattern='^pick'
+        ))
         
         # Утилиты для админов
         self.application.add_handler(CommandHandler("templates", self.recurring_manager.list_templates))
+        self.application.add_handler(CommandHandler("settemplate", self.game_manager.set_template))
+        self.application.add_handler(CommandHandler("setchannels", self.game_manager.set_channels))
+        self.application.add_handler(CommandHandler("lottery", self.game_manager.set_lottery))
         self.application.add_handler(CommandHandler("archive", self.archive_games))
         
         # Общие утилиты
         self.application.add_handler(CommandHandler("get_channel_info", self.get_channel_info))
         self.application.add_handler(CommandHandler("test_channel", self.test_channel))
+        
+        # Ошибки обработчиков, в том числе отказы записи при недоступной базе
+        self.application.add_error_handler(self.handle_error)
+    
+    async def guard_update(self, update, context):
+        """Отсев слишком частых нажатий и команд до основных обработчиков"""
+        self.startup.first_update()
+        query = update.callback_query
+        message = update.message
+        if query:
+            game_id = None
+            dedupe_key = None
+            action, _, tail = (query.data or '').partition('_')
+            if action in ('join', 'leave') and tail.isdigit():
+                game_id = int(tail)
+                dedupe_key = query.data
+            reason = self.flood_guard.check(query.from_user.id, game_id, dedupe_key)
+            if reason is None:
+                return
+            if reason == 'duplicate':
+                # Повторное нажатие: первое уже обрабатывается
+                await query.answer()
+            elif reason == 'user':
+                await query.answer("⏳ Слишком часто, подождите пару секунд")
+            else:
+                await query.answer("⏳ Много желающих, нажмите еще раз через секунду")
+            raise ApplicationHandlerStop
+        
+        if message and message.text and message.text.startswith('/') and update.effective_user:
+            user_id = update.effective_user.id
+            if self.flood_guard.check_command(user_id) is not None:
+                # Отвечаем один раз за FLOOD_WARN_INTERVAL: ответ сам расходует лимит исходящих
+                if self.flood_guard.should_warn(user_id):
+                    await message.reply_text("⏳ Слишком много команд, подождите немного и повторите")
+                raise ApplicationHandlerStop
+    
+    async def handle_error(self, update, context):
+        """Ошибки обработчиков; пока база недоступна, запись отклоняется с понятным ответом"""
+        error = context.error
+        if not isinstance(error, (DatabaseUnavailable, PoolTimeoutError)):
+            logging.error(f"Ошибка при обработке апдейта: {error}", exc_info=error)
+            return
+        
+        logging.warning(f"Апдейт не обработан, база недоступна: {error}")
+        if not isinstance(update, Update):
+            return
+        text = (
+            "⚠️ Бот временно работает только на просмотр: запись и изменения недоступны.\n"
+            "Попробуйте еще раз через пару минут."
+        )
+        try:
+            if update.callback_query:
+                try:
+                    await update.callback_query.answer(text, show_alert=True)
+                    return
+                except BadRequest:
+                    # На нажатие уже ответили — пишем в личный чат
+                    pass
+            if update.effective_chat and update.effective_chat.type == ChatType.PRIVATE and update.effective_message:
+                await update.effective_message.reply_text(text)
+        except Exception as e:
+            logging.debug(f"Не удалось сообщить о недоступности базы: {e}")
     
     async def cancel_edit(self, update, context):
         """Отмена редактирования игры"""
-        context.user_data.pop('editing_game', None)
         context.user_data.pop('editing_game_id', None)
+        context.user_data.pop('editing_field', None)
         await update.message.reply_text(
             "❌ Редактирование игры отменено.",
             reply_markup=ReplyKeyboardRemove()
         )
         return ConversationHandler.END
     
+    async def timeout_edit(self, update, context):
+        """Таймаут редактирования игры"""
+        context.user_data.pop('editing_game_id', None)
+        context.user_data.pop('editing_field', None)
+        if update.effective_chat:
+            await context.bot.send_message(
+                update.effective_chat.id,
+                "⌛ Время на редактирование истекло. Начните заново: /editgame",
+                reply_markup=ReplyKeyboardRemove()
+            )
+    
     async def archive_games(self, update, context):
         """Архивирование прошедших игр"""
         user_id = update.effective_user.id
@@ -162,7 +282,7 @@ class TelegramBot:
                 f"🆔 ID: {channel.id}\n"
                 f"📛 Название: {channel.title}\n"
                 f"🔗 Username: @{channel.username or 'нет'}\n\n"
-                f"💡 Добавьте в .env:\n"
+                f"💡 Добавьте в .env (несколько каналов — через запятую):\n"
                 f"CHANNEL_ID={channel.id}"
             )
         else:
@@ -176,25 +296,25 @@ class TelegramBot:
             )
     
     async def test_channel(self, update, context):
-        """Тестовая команда для проверки отправки в канал"""
-        channel_id = os.getenv('CHANNEL_ID')
+        """Тестовая команда для проверки отправки в каналы по умолчанию"""
+        channel_ids = default_channel_ids()
         
-        if not channel_id:
+        if not channel_ids:
             await update.message.reply_text("❌ CHANNEL_ID не установлен")
             return
         
-        try:
-            await context.bot.send_message(
-                chat_id=channel_id,
-                text="✅ Тестовое сообщение от бота!\n\nКанал работает корректно! 🎉"
-            )
-            await update.message.reply_text("✅ Тестовое сообщение отправлено в канал!")
-        except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка отправки: {str(e)}")
+        for channel_id in channel_ids:
+            try:
+                await context.bot.send_message(
+                    chat_id=channel_id,
+                    text="✅ Тестовое сообщение от бота!\n\nКанал работает корректно! 🎉"
+                )
+                await update.message.reply_text(f"✅ Тестовое сообщение отправлено в {channel_id}!")
+            except Exception as e:
+                await update.message.reply_text(f"❌ Ошибка отправки в {channel_id}: {str(e)}")
     
-    def setup_scheduled_jobs(self):
-        """Настройка запланированных заданий при запуске"""
-        # Загружаем все запланированные публикации из базы
+    def load_scheduled_publications(self):
+        """Планирование публикаций, отложенных в базе"""
         scheduled_games = self.db.get_scheduled_games()
         
         for game in scheduled_games:
@@ -202,7 +322,17 @@ class TelegramBot:
             self.game_manager.schedule_announcement_publication(game.id, game.publication_date)
             
         logging.info(f"Загружено {len(scheduled_games)} запланированных публикаций")
-        
+    
+    def archive_old_games_on_start(self):
+        """Архивирование игр, прошедших, пока бот был выключен"""
+        try:
+            archived = self.db.archive_old_games()
+            logging.info(f"Автоматически архивировано {archived} прошедших игр")
+        except Exception as e:
+            logging.error(f"Ошибка при автоматическом архивировании: {e}")
+    
+    def setup_scheduled_jobs(self):
+        """Настройка периодических заданий при запуске"""
         # Запускаем задание для создания регулярных игр
         self.scheduler.add_job(
             self.create_recurring_games,
@@ -222,16 +352,36 @@ class TelegramBot:
             id='archive_old_games',
             replace_existing=True
         )
+        
+        # Уплотнение позиций в очередях записи с большими пропусками
+        self.scheduler.add_job(
+            self.compact_queues_daily,
+            'cron',
+            hour=1,
+            minute=30,
+            id='compact_queue_positions',
+            replace_existing=True
+        )
+        
+        # Метрики резидентного состояния и очереди апдейтов
+        self.scheduler.add_job(
+            self.log_runtime_metrics,
+            'interval',
+            minutes=int(os.getenv('METRICS_INTERVAL_MINUTES', '1')),
+            id='log_runtime_metrics',
+            replace_existing=True
+        )
     
     async def create_recurring_games(self):
         """Создание регулярных игр по шаблонам"""
         try:
             templates = self.db.get_recurring_templates()
+            existing_dates = self.db.get_recurring_game_dates()
             created_count = 0
-            
+
             for template in templates:
                 # Проверяем, нужно ли создать следующую игру для этого шаблона
-                next_game = await self.recurring_manager.create_next_game_from_template(template)
+                next_game = await self.recurring_manager.create_next_game_from_template(template, existing_dates)
                 if next_game:
                     created_count += 1
                     logging.info(f"Создана регулярная игра {next_game.id} из шаблона {template.id}")
@@ -251,38 +401,112 @@ class TelegramBot:
         except Exception as e:
             logging.error(f"Ошибка при автоматическом архивировании: {e}")
     
+    async def log_runtime_metrics(self):
+        """Метрики: база и пул соединений, загруженные пользователи и диалоги, очередь апдейтов и задержки"""
+        stats = {
+            **self.persistence.stats(),
+            **self.update_processor.stats(),
+            **self.db.pool_stats(),
+            'db_state': self.db.breaker.state,
+        }
+        logging.info(
+            f"База: {stats['db_state']}, пул {stats['pool_checked_out']}/{stats['pool_size']}+{stats['pool_overflow']}, "
+            f"выдача {stats['checkout_wait_ms']} мс (макс. {stats['checkout_wait_max_ms']}), "
+            f"таймаутов {stats['checkout_timeouts']}, ошибок соединений {stats['connect_errors']}; "
+            f"резидентное состояние: пользователей {stats['resident_users']}, диалогов {stats['conversations']}; "
+            f"очередь апдейтов {stats['queue_depth']} {stats['queue_by_lane']}, "
+            f"обработка {stats['handler_ms']} мс, ожидание {stats['queue_wait_ms']} мс, "
+            f"отброшено {stats['shed_updates']}",
+            extra=stats
+        )
+    
+    async def compact_queues_daily(self):
+        """Ежедневное уплотнение позиций в очередях записи"""
+        try:
+            compacted = self.db.compact_queue_positions()
+            if compacted > 0:
+                logging.info(f"Уплотнены очереди записи у {compacted} игр")
+        except Exception as e:
+            logging.error(f"Ошибка при уплотнении очередей записи: {e}")
+    
+    def warm_pool(self):
+        """Соединения с базой открываются до первых запросов"""
+        try:
+            warmed = self.db.warm_pool()
+            logging.info(f"🔌 Пул соединений прогрет: {warmed}")
+        except Exception as e:
+            logging.error(f"Не удалось прогреть пул соединений: {e}")
+    
     async def on_startup(self, application: Application):
         """Действия при запуске бота"""
-        # Загрузка запланированных публикаций
+        # Периодические задания и планировщик
         self.setup_scheduled_jobs()
-        
-        # Запуск планировщика
         self.scheduler.start()
         logging.info("📅 Планировщик запущен")
         
+        # Запуск outbox-воркера (публикации и обновления анонсов) и рассылки уведомлений
+        self.game_manager.outbox.start()
+        self.game_manager.notifications.start()
+        
+        if self.fast_start:
+            # Прогрев, загрузка расписания и регулярные игры — в фоне, после запуска polling
+            asyncio.create_task(self.boot_in_background())
+            return
+        
+        self.warm_pool()
+        self.load_scheduled_publications()
         # Создаем регулярные игры при запуске
         await self.create_recurring_games()
+        asyncio.create_task(self.report_ready())
+    
+    async def report_ready(self):
+        """Отчет о запуске, как только приложение начало принимать апдейты"""
+        while not self.application.running:
+            await asyncio.sleep(0.01)
+        self.startup.ready()
+    
+    async def boot_in_background(self):
+        """Задачи запуска, которые не нужны для ответа на первый апдейт (быстрый старт)
+
+        Синхронная работа с базой уходит в потоки, чтобы не задерживать апдейты.
+        Пока ники не загружены, занятость ника проверяет уникальный индекс в базе.
+        """
+        await self.report_ready()
+        await self.startup.run_background({
+            'пул соединений': asyncio.to_thread(self.warm_pool),
+            'ники': asyncio.to_thread(self.handlers.registration_manager.nicknames.load),
+            'публикации по расписанию': asyncio.to_thread(self.load_scheduled_publications),
+            'архивирование': asyncio.to_thread(self.archive_old_games_on_start),
+            'регулярные игры': self.create_recurring_games(),
+        })
     
     async def on_shutdown(self, application: Application):
         """Действия при остановке бота"""
-        # Остановка планировщика
+        # Остановка outbox-воркера, рассылки уведомлений и планировщика
+        await self.game_manager.outbox.stop()
+        await self.game_manager.notifications.stop()
         self.scheduler.shutdown()
         logging.info("📅 Планировщик остановлен")
+        
+        # Дописываем очередь логов на диск
+        stop_logging()
     
     def run(self):
         """Запуск бота"""
-        # Инициализация базы данных
-        self.db.init_db()
+        # Инициализация базы данных (при быстром старте — только сверка отпечатка схемы)
+        with self.startup.phase('схема'):
+            if self.db.ensure_schema(fast=self.fast_start) and self.fast_start:
+                logging.info("Схема базы изменилась — выполнен полный init_db")
         
-        # Автоматическое архивирование старых игр при запуске
-        try:
-            archived = self.db.archive_old_games()
-            logging.info(f"Автоматически архивировано {archived} прошедших игр")
-        except Exception as e:
-            logging.error(f"Ошибка при автоматическом архивировании: {e}")
+        if not self.fast_start:
+            # Занятые игровые ники — в память, чтобы регистрация не сканировала базу
+            self.handlers.registration_manager.nicknames.load()
+            # Автоматическое архивирование старых игр при запуске
+            self.archive_old_games_on_start()
         
         # Настройка обработчиков
-        self.setup_handlers()
+        with self.startup.phase('обработчики'):
+            self.setup_handlers()
         
         # Регистрация обработчиков запуска и остановки
         self.application.post_init = self.on_startup
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, ForeignKey, Enum as SQLEnum
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, ForeignKey, Index, UniqueConstraint, LargeBinary, Enum as SQLEnum
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -23,6 +23,7 @@ class User(Base):
     last_name = Column(String(100))
     name = Column(String(100), nullable=False)
     game_nickname = Column(String(100), nullable=False)
+    nickname_key = Column(String(100))  # Нормализованный ник (normalize_nickname), уникален
     bio = Column(Text)
     photo_id = Column(String(500))
     registration_complete = Column(Boolean, default=False)
@@ -30,8 +31,12 @@ class User(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     registered_at = Column(DateTime)
     
-    # Исправленная связь с записями на игры
-    registrations = relationship("GameRegistration", back_populates="user")
+    # Связи загружаются только явно (joinedload/selectinload в запросе), ленивая загрузка запрещена
+    registrations = relationship("GameRegistration", back_populates="user", lazy="raise")
+    
+    __table_args__ = (
+        Index('uq_users_nickname_key', 'nickname_key', unique=True),
+    )
     
     def __repr__(self):
         return f"<User(user_id={self.user_id}, game_nickname='{self.game_nickname}')>"
@@ -60,7 +65,7 @@ class GameAnnouncement(Base):
     game_date = Column(DateTime, nullable=False)
     location = Column(String(200))
     max_players = Column(Integer, default=10)
-    channel_message_id = Column(Integer)
+    channel_message_id = Column(Integer)  # Устарело: id сообщений по каналам хранятся в channel_messages
     created_by = Column(Integer, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)
@@ -72,9 +77,21 @@ class GameAnnouncement(Base):
     publication_date = Column(DateTime)  # Когда опубликовать анонс
     is_published = Column(Boolean, default=False)  # Опубликован ли анонс
     
-    # Связь с записями
-    registrations = relationship("GameRegistration", back_populates="game", cascade="all, delete-orphan")
-    recurring_template = relationship("RecurringGameTemplate", back_populates="games")
+    # Режим записи: fcfs — кто первый нажал, lottery — заявки в окне и розыгрыш мест
+    registration_mode = Column(String(20), default='fcfs')
+    lottery_window_minutes = Column(Integer)  # Длительность окна заявок после публикации
+    lottery_weighted = Column(Boolean, default=False)  # Вес заявки растет с числом сыгранных игр
+    lottery_closes_at = Column(DateTime)  # Задается при публикации
+    lottery_drawn_at = Column(DateTime)
+    
+    queue_seq = Column(Integer, default=0)  # Последняя выданная позиция в очереди записей
+    
+    # Связь с записями (удаление записей делает БД через ON DELETE CASCADE)
+    registrations = relationship(
+        "GameRegistration", back_populates="game", cascade="all, delete-orphan",
+        passive_deletes=True, lazy="raise"
+    )
+    recurring_template = relationship("RecurringGameTemplate", back_populates="games", lazy="raise")
     
     def __repr__(self):
         return f"<GameAnnouncement(title='{self.title}', date={self.game_date})>"
@@ -83,14 +100,22 @@ class GameRegistration(Base):
     __tablename__ = 'game_registrations'
     
     id = Column(Integer, primary_key=True)
-    game_id = Column(Integer, ForeignKey('game_announcements.id'), nullable=False)
+    game_id = Column(Integer, ForeignKey('game_announcements.id', ondelete='CASCADE'), nullable=False)
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
     registered_at = Column(DateTime, default=datetime.utcnow)
     is_reserve = Column(Boolean, default=False)
+    # Позиция в очереди игры: растет с каждой записью, пропуски после отписок допустимы.
+    # Порядок в основе и резерве, продвижение и "место в очереди" — по ней
+    queue_position = Column(Integer)
     
     # Связи
-    game = relationship("GameAnnouncement", back_populates="registrations")
-    user = relationship("User", back_populates="registrations")
+    game = relationship("GameAnnouncement", back_populates="registrations", lazy="raise")
+    user = relationship("User", back_populates="registrations", lazy="raise")
+    
+    __table_args__ = (
+        Index('ix_game_registrations_queue', 'game_id', 'is_reserve', 'queue_position'),
+        UniqueConstraint('game_id', 'user_id', name='uq_game_registrations_game_user'),
+    )
     
     def __repr__(self):
         return f"<GameRegistration(user_id={self.user_id}, game_id={self.game_id}, reserve={self.is_reserve})>"
@@ -127,6 +152,11 @@ class RecurringGameTemplate(Base):
     # Для еженедельных игр
     day_of_week = Column(Integer)  # 0-6 (понедельник-воскресенье)
     
+    # Режим записи для создаваемых игр (см. GameAnnouncement.registration_mode)
+    registration_mode = Column(String(20), default='fcfs')
+    lottery_window_minutes = Column(Integer)
+    lottery_weighted = Column(Boolean, default=False)
+    
     # Даты
     start_date = Column(DateTime, nullable=False)
     end_date = Column(DateTime)
@@ -137,7 +167,207 @@ class RecurringGameTemplate(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Связь с созданными играми
-    games = relationship("GameAnnouncement", back_populates="recurring_template")
+    games = relationship("GameAnnouncement", back_populates="recurring_template", lazy="raise")
+    
+    def __repr__(self):
+        return f"<RecurringGameTemplate(title='{self.title}', frequency={self.frequency})>"
+
+class AnnouncementTemplate(Base):
+    __tablename__ = 'announcement_templates'
+    
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50), unique=True, nullable=False)  # Ключ, на который ссылается GameAnnouncement.template
+    display_name = Column(String(100))
+    body = Column(Text, nullable=False)  # Текст с плейсхолдерами вида {{title}}
+    version = Column(Integer, nullable=False, default=1)  # Растет при каждом изменении, по нему сбрасывается кэш
+    updated_by = Column(Integer)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<AnnouncementTemplate(name='{self.name}', version={self.version})>"
+
+
+class OutboxEvent(Base):
+    """Отложенная операция с каналом, записанная в одной транзакции с изменением в БД"""
+    __tablename__ = 'outbox_events'
+    
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(30), nullable=False)  # publish | refresh | draw | remind
+    game_id = Column(Integer, ForeignKey('game_announcements.id', ondelete='CASCADE'))
+    idempotency_key = Column(String(100), unique=True, nullable=False)  # publish:<id>, refresh:<id>, draw:<id>, remind:<id>
+    status = Column(String(20), nullable=False, default='pending')  # pending | done | failed
+    revision = Column(Integer, nullable=False, default=0)  # Растет при повторной постановке, защищает от потери изменений
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime)
+    
+    __table_args__ = (
+        Index('ix_outbox_events_due', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f"<OutboxEvent(kind='{self.kind}', game_id={self.game_id}, status='{self.status}')>"
+
+
+class ChannelTarget(Base):
+    """Канал или чат-зеркало, куда публикуются анонсы игры или регулярного шаблона
+
+    Свои каналы игры важнее каналов шаблона; если нет ни тех, ни других,
+    используются каналы по умолчанию из CHANNEL_ID.
+    """
+    __tablename__ = 'channel_targets'
+    
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(String(100), nullable=False)  # -100... или @username
+    game_id = Column(Integer, ForeignKey('game_announcements.id', ondelete='CASCADE'))
+    recurring_template_id = Column(Integer, ForeignKey('recurring_game_templates.id', ondelete='CASCADE'))
+    is_active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_channel_targets_game_id', 'game_id'),
+        Index('ix_channel_targets_recurring_template_id', 'recurring_template_id'),
+    )
+    
+    def __repr__(self):
+        return f"<ChannelTarget(chat_id='{self.chat_id}', game_id={self.game_id}, template_id={self.recurring_template_id})>"
+
+
+class ChannelMessage(Base):
+    """Опубликованный анонс игры в конкретном канале"""
+    __tablename__ = 'channel_messages'
+    
+    id = Column(Integer, primary_key=True)
+    game_id = Column(Integer, ForeignKey('game_announcements.id', ondelete='CASCADE'), nullable=False)
+    chat_id = Column(String(100), nullable=False)
+    message_id = Column(Integer, nullable=False)
+    published_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('game_id', 'chat_id', name='uq_channel_messages_game_chat'),
+    )
+    
+    def __repr__(self):
+        return f"<ChannelMessage(game_id={self.game_id}, chat_id='{self.chat_id}', message_id={self.message_id})>"
+
+
+class LotteryEntry(Base):
+    """Заявка на игру в режиме лотереи; превращается в запись при розыгрыше"""
+    __tablename__ = 'lottery_entries'
+    
+    id = Column(Integer, primary_key=True)
+    game_id = Column(Integer, ForeignKey('game_announcements.id', ondelete='CASCADE'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
+    entered_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('game_id', 'user_id', name='uq_lottery_entries_game_user'),
+    )
+    
+    def __repr__(self):
+        return f"<LotteryEntry(game_id={self.game_id}, user_id={self.user_id})>"
+
+
+class TemplateSubscription(Base):
+    """Подписка игрока на регулярный шаблон: автозапись на каждую новую игру серии"""
+    __tablename__ = 'template_subscriptions'
+    
+    id = Column(Integer, primary_key=True)
+    template_id = Column(Integer, ForeignKey('recurring_game_templates.id', ondelete='CASCADE'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)  # Порядок подписки = приоритет при нехватке мест
+    
+    __table_args__ = (
+        UniqueConstraint('template_id', 'user_id', name='uq_template_subscriptions_template_user'),
+        Index('ix_template_subscriptions_order', 'template_id', 'created_at', 'id'),
+    )
+    
+    def __repr__(self):
+        return f"<TemplateSubscription(template_id={self.template_id}, user_id={self.user_id})>"
+
+
+class Notification(Base):
+    """Личное сообщение игроку, поставленное в очередь в одной транзакции с изменением
+
+    Текст собирается при отправке из текущего состояния игры, поэтому повторная
+    постановка того же уведомления (dedupe_key) лишь взводит его заново.
+    """
+    __tablename__ = 'notifications'
+    
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(30), nullable=False)  # promoted | demoted | lottery | reminder | rescheduled
+    game_id = Column(Integer, ForeignKey('game_announcements.id', ondelete='CASCADE'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
+    dedupe_key = Column(String(100), unique=True, nullable=False)  # <kind>:<game_id>:<user_id>
+    status = Column(String(20), nullable=False, default='pending')  # pending | sent | skipped | failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+    
+    __table_args__ = (
+        Index('ix_notifications_due', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f"<Notification(kind='{self.kind}', game_id={self.game_id}, user_id={self.user_id}, status='{self.status}')>"
+
+
+class ConversationState(Base):
+    """Состояние диалога (ConversationHandler) для пары чат/пользователь
+
+    Строка есть только у идущих диалогов: при выходе из диалога она удаляется.
+    """
+    __tablename__ = 'conversation_states'
+    
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50), nullable=False)  # Имя ConversationHandler'а
+    key = Column(String(100), nullable=False)  # JSON ключа диалога, например [chat_id, user_id]
+    state = Column(LargeBinary, nullable=False)  # pickle состояния: int, строка или Enum
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('name', 'key', name='uq_conversation_states_name_key'),
+    )
+    
+    def __repr__(self):
+        return f"<ConversationState(name='{self.name}', key='{self.key}', state='{self.state}')>"
+
+
+class UserDataEntry(Base):
+    """Один ключ context.user_data пользователя (значение в pickle)
+
+    Ключи хранятся отдельными строками, чтобы сбрасывать на диск только измененные.
+    """
+    __tablename__ = 'user_data_entries'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    key = Column(String(100), nullable=False)
+    value = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('user_id', 'key', name='uq_user_data_entries_user_key'),
+    )
+    
+    def __repr__(self):
+        return f"<UserDataEntry(user_id={self.user_id}, key='{self.key}')>"
+
+
+class SchemaVersion(Base):
+    """Отпечаток схемы, с которой последний раз запускался init_db
+
+    Быстрый старт сверяет его с моделями одним запросом вместо create_all.
+    """
+    __tablename__ = 'schema_version'
+    
+    id = Column(Integer, primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def __repr__(self):
-        return f"<RecurringGameTemplate(title='{self.title}', frequency={self.frequency})>"
\ No newline at end of file
+        return f"<SchemaVersion(fingerprint='{self.fingerprint}', applied_at='{self.applied_at}')>"
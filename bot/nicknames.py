@@ -0,0 +1,87 @@
+import logging
+import unicodedata
+
+# Буквы кириллицы и греческого, которые в одном из регистров выглядят как латинские:
+# «Вот» и «BOT», «Рорa» и «Popa» — один и тот же ник
+HOMOGLYPHS = {
+    'а': 'a', 'в': 'b', 'е': 'e', 'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o', 'р': 'p',
+    'с': 'c', 'т': 't', 'у': 'y', 'х': 'x', 'і': 'i', 'ј': 'j', 'ѕ': 's', 'ԁ': 'd', 'ӏ': 'l',
+    'α': 'a', 'β': 'b', 'ε': 'e', 'ζ': 'z', 'η': 'h', 'ι': 'i', 'κ': 'k', 'μ': 'm',
+    'ν': 'n', 'ο': 'o', 'ρ': 'p', 'τ': 't', 'υ': 'y', 'χ': 'x',
+}
+_HOMOGLYPH_TABLE = str.maketrans(HOMOGLYPHS)
+
+
+class NicknameTaken(Exception):
+    """Игровой ник уже занят другим пользователем (уникальный индекс или реестр ников)"""
+
+
+def normalize_nickname(nickname):
+    """Ключ уникальности ника: NFKC, без лишних пробелов, без учета регистра и похожих букв
+
+    То же выражение считает ключи в SCHEMA_UPGRADES (normalize, translate) — правила
+    меняются в обоих местах вместе.
+    """
+    nickname = unicodedata.normalize('NFKC', nickname or '')
+    return ' '.join(nickname.split()).lower().translate(_HOMOGLYPH_TABLE)
+
+
+class NicknameRegistry:
+    """Занятые игровые ники в памяти процесса
+
+    Загружается один раз при старте и обновляется при каждом сохранении профиля,
+    поэтому проверка ника и подбор свободных вариантов не ходят в базу. Источник
+    истины — уникальный индекс users.nickname_key: если другой процесс успел занять
+    ник, сохранение упадет с NicknameTaken, и владелец запишется сюда (remember).
+    """
+
+    def __init__(self, database):
+        self.db = database
+        self.logger = logging.getLogger(__name__)
+        self._owners = {}  # nickname_key -> user_id
+        self._keys = {}  # user_id -> nickname_key
+
+    def load(self):
+        """Загрузка всех занятых ников одним запросом"""
+        self._owners = dict(self.db.get_nickname_owners())
+        self._keys = {user_id: key for key, user_id in self._owners.items()}
+        self.logger.info(f"Загружено игровых ников: {len(self._owners)}")
+
+    def is_available(self, nickname, user_id=None):
+        """Свободен ли ник (свой текущий ник пользователю доступен)"""
+        owner = self._owners.get(normalize_nickname(nickname))
+        return owner is None or owner == user_id
+
+    def suggest(self, nickname, user_id=None, limit=3):
+        """Свободные варианты занятого ника: ник с числовым суффиксом"""
+        base = ' '.join(nickname.split())
+        suggestions = []
+        for suffix in range(2, 1000):
+            for candidate in (f"{base}{suffix}", f"{base}_{suffix}"):
+                if len(candidate) <= 100 and self.is_available(candidate, user_id):
+                    suggestions.append(candidate)
+                    if len(suggestions) >= limit:
+                        return suggestions
+        return suggestions
+
+    def claim(self, nickname, user_id):
+        """Занять ник перед записью в базу; NicknameTaken — ник уже у другого пользователя"""
+        if not self.is_available(nickname, user_id):
+            raise NicknameTaken(nickname)
+        self.remember(nickname, user_id)
+
+    def remember(self, nickname, user_id):
+        """Запомнить ник за пользователем по ответу базы (прежний его ник освобождается)"""
+        key = normalize_nickname(nickname)
+        old_key = self._keys.get(user_id)
+        if old_key and old_key != key and self._owners.get(old_key) == user_id:
+            del self._owners[old_key]
+        self._owners[key] = user_id
+        self._keys[user_id] = key
+
+    def release(self, nickname):
+        """Забыть устаревшего владельца ника (в базе ник свободен)"""
+        key = normalize_nickname(nickname)
+        owner = self._owners.pop(key, None)
+        if owner is not None and self._keys.get(owner) == key:
+            del self._keys[owner]
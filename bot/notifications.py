@@ -0,0 +1,105 @@
+import os
+import asyncio
+import logging
+from telegram.error import RetryAfter
+from .worker import QueueWorker
+
+
+class NotificationWorker(QueueWorker):
+    """Фоновая отправка личных уведомлений игрокам: итоги розыгрыша, переводы между основой и резервом, напоминания, переносы
+
+    Уведомления ставятся в таблицу notifications в той же транзакции, что и изменение
+    (отписка, правка игры, срабатывание напоминания в outbox). Воркер забирает их
+    пачками одним запросом вместе с данными игры и рассылает в пределах лимитов Bot API.
+    Настройки — NOTIFY_* (см. QueueWorker), повторы настраиваются отдельно от outbox.
+    """
+
+    title = "✉️ Воркер уведомлений"
+    # Заблокировавшим бота не пишем — это обычное дело, а не ошибка
+    give_up_level = logging.WARNING
+
+    def __init__(self, database, bot, rate_limiter):
+        super().__init__(
+            database, 'NOTIFY', batch_size='100', poll_interval='5', max_attempts='5', lease_seconds='120',
+        )
+        self.bot = bot
+        self.rate_limiter = rate_limiter
+        self.concurrency = int(os.getenv('NOTIFY_CONCURRENCY', '8'))
+
+    async def drain(self):
+        """Отправка одной пачки уведомлений; возвращает число взятых"""
+        notifications = self.db.claim_notification_batch(self.batch_size, self.lease_seconds)
+        if not notifications:
+            return 0
+
+        sent, skipped = [], []
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(notification):
+            text = self._render(notification)
+            if text is None:
+                skipped.append(notification['id'])
+                return
+            async with semaphore:
+                try:
+                    await self._send(notification['user_id'], text)
+                except Exception as e:
+                    self._schedule_retry(notification, e)
+                    return
+            sent.append(notification['id'])
+
+        await asyncio.gather(*(deliver(notification) for notification in notifications))
+        self.db.finish_notifications(sent, skipped)
+        if sent:
+            self.logger.info("Отправлено уведомлений: %s", len(sent))
+        return len(notifications)
+
+    async def _send(self, user_id, text):
+        """send_message в пределах лимитов; RetryAfter замораживает чат"""
+        await self.rate_limiter.acquire(user_id)
+        try:
+            await self.bot.send_message(chat_id=user_id, text=text)
+        except RetryAfter as e:
+            self.rate_limiter.retry_after(user_id, float(e.retry_after))
+            raise
+
+    def _render(self, notification):
+        """Текст уведомления из текущего состояния игры; None — отправлять уже нечего"""
+        if not notification['is_active'] or not notification['registered']:
+            return None
+
+        details = (
+            f"🏆 {notification['title']}\n"
+            f"📅 {notification['game_date'].strftime('%d.%m %H:%M')}\n"
+            f"📍 {notification['location']}"
+        )
+        kind = notification['kind']
+        if kind == 'promoted':
+            if notification['is_reserve']:
+                return None
+            return f"🎉 Освободилось место — вы переведены из резерва в основной состав!\n\n{details}"
+        if kind == 'lottery':
+            if notification['is_reserve']:
+                return f"🎲 Розыгрыш прошел: вы в резерве. Если место освободится, мы сообщим.\n\n{details}"
+            return f"🎲 Розыгрыш прошел — вам досталось место в основном составе!\n\n{details}"
+        if kind == 'demoted':
+            if not notification['is_reserve']:
+                return None
+            return f"⏳ Число мест уменьшилось — вы переведены из основного состава в резерв.\n\n{details}"
+        if kind == 'reminder':
+            status = "⏳ Вы в резерве" if notification['is_reserve'] else "✅ Вы в основном составе"
+            return f"⏰ Напоминаем об игре\n\n{details}\n\n{status}\nНе сможете прийти — отпишитесь кнопкой в анонсе или через /games."
+        if kind == 'rescheduled':
+            return f"📅 Игра перенесена, новое время:\n\n{details}"
+        self.logger.error(f"Неизвестный тип уведомления: {kind}")
+        return None
+
+    def _retry(self, notification, error, delay, give_up):
+        self.db.retry_notification(notification, error, delay, give_up=give_up)
+
+    def _describe(self, notification):
+        return (
+            f"Уведомление {notification['id']} ({notification['kind']}, игра {notification['game_id']}) "
+            f"пользователю {notification['user_id']}",
+            {'user_id': notification['user_id'], 'game_id': notification['game_id']},
+        )
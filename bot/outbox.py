@@ -0,0 +1,107 @@
+import os
+from .worker import QueueWorker
+
+
+class OutboxWorker(QueueWorker):
+    """Фоновый обработчик outbox: публикации и обновления анонсов, розыгрыши мест, напоминания
+
+    События пишутся в БД в той же транзакции, что и изменение (запись на игру,
+    создание игры), а воркер выбирает их пачками, выполняет вызовы Bot API и
+    повторяет неудачные с экспоненциальной задержкой. Настройки — OUTBOX_* (см. QueueWorker).
+    """
+
+    title = "📤 Outbox-воркер"
+
+    def __init__(self, database, announcement_manager):
+        # Аренда пачки должна покрывать волну публикаций, растянутую лимитом чата;
+        # пауза после пробуждения собирает публикации с одним announcement_time в одну пачку
+        super().__init__(
+            database, 'OUTBOX', batch_size='50', poll_interval='2', max_attempts='8',
+            lease_seconds='300', coalesce_delay='0.2',
+        )
+        self.announcement_manager = announcement_manager
+        # При перегрузке обновления анонсов откладываются: они схлопываются, и потом
+        # уйдет одна правка вместо многих. defer_refreshes — callable от диспетчера апдейтов
+        self.defer_refreshes = None
+        self.defer_seconds = float(os.getenv('OUTBOX_DEFER_SECONDS', '5'))
+
+    async def drain(self):
+        """Обработка одной пачки событий; возвращает число взятых событий"""
+        events = self.db.claim_outbox_batch(self.batch_size, self.lease_seconds)
+        if not events:
+            return 0
+
+        completed = []
+        publications = {}
+        reminders = []
+        deferred = []
+        overloaded = bool(self.defer_refreshes and self.defer_refreshes())
+        for event in events:
+            if event['kind'] == 'refresh' and overloaded:
+                deferred.append(event)
+                continue
+            if event['kind'] == 'publish':
+                publications[event['game_id']] = event
+                continue
+            if event['kind'] == 'remind':
+                reminders.append(event)
+                continue
+            try:
+                if event['kind'] == 'refresh':
+                    await self.announcement_manager.update_channel_announcement(event['game_id'])
+                elif event['kind'] == 'draw':
+                    # Розыгрыш закрывает событие сам и ставит одно обновление анонса
+                    self._draw_lottery(event)
+                    continue
+                else:
+                    self.logger.error(f"Неизвестный тип события outbox: {event['kind']}")
+                completed.append(event)
+            except Exception as e:
+                self._schedule_retry(event, e)
+
+        if publications:
+            # Волна публикаций уходит одной пачкой; каждая игра закрывает свое событие сама,
+            # в одной транзакции с message_id
+            try:
+                errors = await self.announcement_manager.publish_games(list(publications), publications)
+            except Exception as e:
+                errors = {game_id: e for game_id in publications}
+            for game_id, error in errors.items():
+                self._schedule_retry(publications[game_id], error)
+
+        if reminders:
+            # Все напоминания, сработавшие к этой пачке, ставятся в очередь одной вставкой
+            try:
+                self.db.queue_reminders(reminders)
+            except Exception as e:
+                for event in reminders:
+                    self._schedule_retry(event, e)
+
+        if deferred:
+            self.db.defer_outbox_events(deferred, self.defer_seconds)
+            self.logger.info("Перегрузка: отложено обновлений анонсов: %s", len(deferred))
+
+        self.db.complete_outbox_events(completed)
+        # Записи, отписки, правки и напоминания могли поставить личные уведомления
+        self.announcement_manager.notifications.notify()
+        return len(events)
+
+    def _draw_lottery(self, event):
+        """Розыгрыш мест по окончании окна заявок"""
+        result = self.db.draw_lottery(event['game_id'], event)
+        if result is not None:
+            self.logger.info(
+                "Розыгрыш игры %s: %s в основе, %s в резерве",
+                event['game_id'], len(result['main']), len(result['reserve']),
+                extra={'game_id': event['game_id']}
+            )
+            self.notify()
+
+    def _retry(self, event, error, delay, give_up):
+        self.db.retry_outbox_event(event, error, delay, give_up=give_up)
+
+    def _describe(self, event):
+        return (
+            f"Событие outbox {event['id']} ({event['kind']}, игра {event['game_id']})",
+            {'game_id': event['game_id']},
+        )
@@ -0,0 +1,244 @@
+import os
+import json
+import pickle
+import asyncio
+import logging
+from copy import deepcopy
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from telegram.ext import BasePersistence, PersistenceInput
+from .database import DatabaseUnavailable
+
+# Ключи user_data, которые заполняет каждый диалог: удаляются при таймауте и при
+# истечении диалога, брошенного до перезапуска
+CONVERSATION_FLOW_KEYS = {
+    'registration': ('registration', 'is_editing'),
+    'newgame': ('game_announcement',),
+    'editgame': ('editing_game_id', 'editing_field'),
+}
+
+
+def conversation_timeout():
+    """Сколько секунд диалог ждет ответа пользователя (CONVERSATION_TIMEOUT)"""
+    return float(os.getenv('CONVERSATION_TIMEOUT', '900'))
+
+
+class PostgresPersistence(BasePersistence):
+    """Хранение состояний диалогов и context.user_data в Postgres
+
+    user_data загружается лениво: при старте бот ничего не читает, а данные
+    пользователя подтягиваются одним запросом перед его первым апдейтом
+    (refresh_user_data). Записи копятся в памяти и уходят одной транзакцией;
+    по каждому пользователю пишутся только ключи, чьи значения изменились с
+    последней записи. Состояния диалогов читаются при старте — это только
+    идущие диалоги, законченные из таблицы удаляются.
+
+    В памяти держится не больше max_resident_users пользователей: при переполнении
+    давно не писавшие сбрасываются на диск, их user_data очищается и при следующем
+    апдейте снова загрузится из базы.
+    """
+
+    def __init__(self, database, update_interval=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval or float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '5')),
+        )
+        self.db = database
+        self.logger = logging.getLogger(__name__)
+        self.flush_delay = float(os.getenv('PERSISTENCE_FLUSH_DELAY', '0.1'))
+        self.max_resident_users = int(os.getenv('USER_DATA_MAX_RESIDENT', '5000'))
+        # Загруженные пользователи в порядке последнего апдейта: {user_id: user_data}
+        self._resident = OrderedDict()
+        # Выгруженные пользователи: запоздалая запись их старого user_data игнорируется
+        self._evicted = set()
+        self._conversations = set()
+        # Последнее записанное состояние: {user_id: {key: pickle}}; нет записи — пользователь не загружен
+        self._snapshots = {}
+        self._pending_users = {}
+        self._pending_conversations = {}
+        self._dropped_users = set()
+        # Не загруженные из-за недоступной базы: их user_data живет только в памяти
+        self._unloaded = set()
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    # --- Загрузка ---
+    async def get_user_data(self):
+        # Ничего не читаем при старте: refresh_user_data загрузит пользователя при первом апдейте
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        # Таймауты не переживают перезапуск: брошенные до него диалоги истекают здесь
+        self.db.expire_conversation_states(
+            name,
+            datetime.utcnow() - timedelta(seconds=conversation_timeout()),
+            CONVERSATION_FLOW_KEYS.get(name, ())
+        )
+        conversations = {
+            tuple(json.loads(key)): pickle.loads(state)
+            for key, state in self.db.get_conversation_states(name).items()
+        }
+        self._conversations.update((name, key) for key in conversations)
+        return conversations
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._resident[user_id] = user_data
+        self._resident.move_to_end(user_id)
+        if user_id in self._snapshots:
+            return
+        self._evicted.discard(user_id)
+        try:
+            entries = self.db.get_user_data_entries(user_id)
+        except DatabaseUnavailable:
+            # Апдейт обработается без сохраненных данных; загрузим, когда база вернется
+            self._unloaded.add(user_id)
+            return
+        self._unloaded.discard(user_id)
+        self._snapshots[user_id] = dict(entries)
+        for key, value in entries.items():
+            # Значения, записанные в памяти до загрузки, новее сохраненных
+            user_data.setdefault(key, pickle.loads(value))
+        if len(self._resident) > self.max_resident_users:
+            await self._evict()
+
+    async def _evict(self):
+        """Выгрузка давно не активных пользователей (до 90% лимита одной записью)"""
+        target = int(self.max_resident_users * 0.9)
+        victims = []
+        while len(self._resident) > target:
+            victims.append(self._resident.popitem(last=False))
+        for user_id, user_data in victims:
+            # Текущее состояние уходит в буфер: изменения после последней записи не теряются
+            await self.update_user_data(user_id, deepcopy(user_data))
+        await self._write_pending()
+        for user_id, user_data in victims:
+            user_data.clear()
+            self._snapshots.pop(user_id, None)
+            self._evicted.add(user_id)
+        self.logger.debug("Выгружено из памяти пользователей: %s", len(victims))
+
+    def stats(self):
+        """Метрики резидентного состояния: загруженные пользователи и идущие диалоги"""
+        return {
+            'resident_users': len(self._resident),
+            'conversations': len(self._conversations),
+        }
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- Запись ---
+    async def update_user_data(self, user_id, data):
+        if user_id in self._evicted:
+            # Состояние было записано при выгрузке, в памяти осталась пустая копия
+            return
+        if user_id in self._unloaded:
+            # Сохраненное состояние неизвестно: запись целиком затерла бы его
+            return
+        pickled = {key: pickle.dumps(value) for key, value in data.items()}
+        snapshot = self._snapshots.get(user_id)
+        if snapshot is None:
+            # Прошлое состояние неизвестно — переписываем пользователя целиком
+            self._pending_users[user_id] = (pickled, set(), True)
+        else:
+            changed = {key: value for key, value in pickled.items() if snapshot.get(key) != value}
+            removed = set(snapshot) - set(pickled)
+            if not changed and not removed:
+                return
+            pending_changed, pending_removed, replace = self._pending_users.get(user_id, ({}, set(), False))
+            pending_changed.update(changed)
+            pending_removed = (pending_removed - set(changed)) | removed
+            for key in removed:
+                pending_changed.pop(key, None)
+            self._pending_users[user_id] = (pending_changed, pending_removed, replace)
+        self._snapshots[user_id] = pickled
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._resident.pop(user_id, None)
+        self._evicted.discard(user_id)
+        self._unloaded.discard(user_id)
+        self._snapshots[user_id] = {}
+        self._pending_users.pop(user_id, None)
+        self._dropped_users.add(user_id)
+        self._schedule_flush()
+
+    async def update_conversation(self, name, key, new_state):
+        state = None if new_state is None else pickle.dumps(new_state)
+        if state is None:
+            self._conversations.discard((name, key))
+        else:
+            self._conversations.add((name, key))
+        self._pending_conversations[(name, json.dumps(list(key)))] = state
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        """Сброс всего накопленного (вызывается при остановке приложения)"""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._flush_task = None
+        await self._write_pending()
+
+    def _schedule_flush(self):
+        """Отложенная запись: все изменения одного прохода update_persistence уходят вместе"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        try:
+            await self._write_pending()
+        except Exception as e:
+            self.logger.error(f"Ошибка записи состояний диалогов: {e}")
+            # Изменения остались в буфере — повторим на следующем интервале
+            asyncio.get_running_loop().call_later(self.update_interval, self._schedule_flush)
+
+    async def _write_pending(self):
+        async with self._lock:
+            if not (self._pending_users or self._pending_conversations or self._dropped_users):
+                return
+            users, self._pending_users = self._pending_users, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            dropped, self._dropped_users = self._dropped_users, set()
+            try:
+                self.db.save_persistence_batch(
+                    conversations=[(name, key, state) for (name, key), state in conversations.items()],
+                    user_data=users,
+                    dropped_users=dropped,
+                )
+            except Exception:
+                # Не теряем изменения: вернем их в буфер, новые поверх старых
+                for user_id in users:
+                    self._snapshots.pop(user_id, None)
+                    self._pending_users.setdefault(user_id, users[user_id])
+                for key, state in conversations.items():
+                    self._pending_conversations.setdefault(key, state)
+                self._dropped_users |= dropped
+                raise
+            self.logger.debug(
+                "Сохранено: диалогов %s, пользователей %s", len(conversations), len(users)
+            )
@@ -0,0 +1,86 @@
+import os
+import logging
+import functools
+from contextvars import ContextVar
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+_current_budget = ContextVar('query_budget', default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    """Обработчик выполнил больше SQL-запросов, чем разрешено бюджетом"""
+
+
+def budget_mode():
+    """Режим проверки бюджета: off (по умолчанию), warn или raise"""
+    return os.getenv('QUERY_BUDGET_MODE', 'off').lower()
+
+
+class QueryBudget:
+    """Контекстный менеджер, считающий SQL-запросы внутри блока
+
+    with QueryBudget(3, 'show_games_list'):
+        ...
+    """
+
+    def __init__(self, limit, name=None, mode=None):
+        self.limit = limit
+        self.name = name or 'block'
+        self.mode = mode or budget_mode()
+        self.count = 0
+        self.statements = []
+        self._parent = None
+        self._token = None
+
+    def record(self, statement):
+        budget = self
+        while budget is not None:
+            budget.count += 1
+            budget.statements.append(statement)
+            budget = budget._parent
+
+    def __enter__(self):
+        self._parent = _current_budget.get()
+        self._token = _current_budget.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_budget.reset(self._token)
+        if exc_type is None and self.count > self.limit:
+            message = f"{self.name}: {self.count} SQL-запросов при бюджете {self.limit}"
+            if self.mode == 'raise':
+                raise QueryBudgetExceeded(message + "\n" + "\n".join(self.statements))
+            logger.warning(message)
+        return False
+
+
+def query_budget(limit, name=None):
+    """Декоратор async-обработчика с бюджетом SQL-запросов (включается QUERY_BUDGET_MODE)"""
+
+    def decorator(func):
+        budget_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            mode = budget_mode()
+            if mode == 'off':
+                return await func(*args, **kwargs)
+            with QueryBudget(limit, budget_name, mode):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _on_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    budget = _current_budget.get()
+    if budget is not None:
+        budget.record(statement)
+
+
+def install_query_counter(engine):
+    """Подключение счетчика запросов к движку"""
+    event.listen(engine, 'before_cursor_execute', _on_before_cursor_execute)
@@ -0,0 +1,166 @@
+import os
+import time
+import asyncio
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """Взять токены без ожидания; False — лимит исчерпан"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay_for(self, tokens=1):
+        """Через сколько секунд станут доступны токены"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, (tokens - self.tokens) / self.rate) if self.rate else float('inf')
+        return max(wait, self.blocked_until - now)
+
+    async def acquire(self, tokens=1):
+        """Дождаться и взять токены"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(max(self.delay_for(tokens), 0.01))
+
+    def block(self, seconds):
+        """Запрет на выдачу токенов (например, после RetryAfter от Telegram)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+class TelegramRateLimiter:
+    """Лимиты Bot API на исходящие сообщения: общий и на каждый чат/канал
+
+    По умолчанию ~25 сообщений в секунду всего и 20 в минуту в один чат
+    (официальный лимит Telegram для групп), настраивается через env.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(
+            rate=float(os.getenv('TELEGRAM_GLOBAL_RATE', '25')),
+            capacity=float(os.getenv('TELEGRAM_GLOBAL_BURST', '25'))
+        )
+        self.chat_rate = float(os.getenv('TELEGRAM_CHAT_RATE_PER_MIN', '20')) / 60
+        self.chat_burst = float(os.getenv('TELEGRAM_CHAT_BURST', '20'))
+        self._chat_buckets = {}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def acquire(self, chat_id):
+        """Дождаться права на отправку в чат"""
+        await self._chat_bucket(str(chat_id)).acquire()
+        await self.global_bucket.acquire()
+
+    def retry_after(self, chat_id, seconds):
+        """Telegram ответил 429 — замораживаем чат на retry_after"""
+        self._chat_bucket(str(chat_id)).block(seconds)
+
+
+class FloodGuard:
+    """Входящие нажатия и команды: bucket на пользователя, bucket на игру, отдельный
+    bucket команд и дедуп повторных нажатий
+
+    Проверка идет целиком в памяти, поэтому отказ не стоит ни запроса к базе,
+    ни правки анонса. Простаивающие (полные) bucket'ы периодически выбрасываются.
+    """
+
+    def __init__(self):
+        self.user_rate = float(os.getenv('FLOOD_USER_RATE', '1'))
+        self.user_burst = float(os.getenv('FLOOD_USER_BURST', '5'))
+        self.game_rate = float(os.getenv('FLOOD_GAME_RATE', '30'))
+        self.game_burst = float(os.getenv('FLOOD_GAME_BURST', '60'))
+        # Команды считаются отдельно от нажатий: переключения в списке игр не съедают лимит команд
+        self.command_rate = float(os.getenv('FLOOD_COMMAND_RATE', '0.5'))
+        self.command_burst = float(os.getenv('FLOOD_COMMAND_BURST', '5'))
+        # Предупреждение о лимите команд — не чаще раза в FLOOD_WARN_INTERVAL на пользователя
+        self.warn_interval = float(os.getenv('FLOOD_WARN_INTERVAL', '30'))
+        self.dedupe_ttl = float(os.getenv('FLOOD_DEDUPE_TTL', '2'))
+        self.max_entries = int(os.getenv('FLOOD_MAX_ENTRIES', '10000'))
+        self._user_buckets = {}
+        self._game_buckets = {}
+        self._command_buckets = {}
+        self._recent = {}  # (user_id, callback_data) -> когда забыть
+        self._warned = {}  # user_id -> когда можно предупредить снова
+        self.rejected = {'duplicate': 0, 'user': 0, 'game': 0, 'command': 0}
+
+    def check(self, user_id, game_id=None, dedupe_key=None):
+        """None — пропустить; иначе причина отказа: 'duplicate', 'user' или 'game'"""
+        now = time.monotonic()
+        if dedupe_key is not None:
+            key = (user_id, dedupe_key)
+            if self._recent.get(key, 0.0) > now:
+                return self._reject('duplicate')
+            self._recent[key] = now + self.dedupe_ttl
+            if len(self._recent) > self.max_entries:
+                self._recent = {key: until for key, until in self._recent.items() if until > now}
+
+        if not self._bucket(self._user_buckets, user_id, self.user_rate, self.user_burst).try_acquire():
+            return self._reject('user')
+        if game_id is not None and not self._bucket(
+            self._game_buckets, game_id, self.game_rate, self.game_burst
+        ).try_acquire():
+            return self._reject('game')
+        return None
+
+    def check_command(self, user_id):
+        """None — пропустить команду; 'command' — лимит команд пользователя исчерпан"""
+        if not self._bucket(self._command_buckets, user_id, self.command_rate, self.command_burst).try_acquire():
+            return self._reject('command')
+        return None
+
+    def should_warn(self, user_id):
+        """Можно ли ответить на отклоненную команду (сам ответ тоже ограничен)"""
+        now = time.monotonic()
+        if self._warned.get(user_id, 0.0) > now:
+            return False
+        if len(self._warned) >= self.max_entries:
+            self._warned = {key: until for key, until in self._warned.items() if until > now}
+        self._warned[user_id] = now + self.warn_interval
+        return True
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return reason
+
+    def _bucket(self, buckets, key, rate, capacity):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.max_entries:
+                self._sweep(buckets)
+            bucket = TokenBucket(rate, capacity)
+            buckets[key] = bucket
+        return bucket
+
+    @staticmethod
+    def _sweep(buckets):
+        """Удаление bucket'ов, которые успели наполниться: они ничего не ограничивают"""
+        now = time.monotonic()
+        for key in [key for key, bucket in buckets.items()
+                    if bucket.tokens + (now - bucket.updated_at) * bucket.rate >= bucket.capacity
+                    and now >= bucket.blocked_until]:
+            del buckets[key]
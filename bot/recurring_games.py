@@ -17,27 +17,45 @@ class RecurringGameStates:
     END_DATE = 10
     CONFIRM = 11
 
+# Поля, доступные в /editgame
+EDIT_FIELDS = {
+    "📅 Дата и время": 'game_date',
+    "👥 Мест в основе": 'max_players',
+    "🏷️ Название": 'title',
+    "📍 Место": 'location',
+    "🎯 Ведущий": 'host',
+    "📝 Описание": 'description',
+}
+EDIT_FIELDS_KEYBOARD = [
+    ["📅 Дата и время", "👥 Мест в основе"],
+    ["🏷️ Название", "📍 Место"],
+    ["🎯 Ведущий", "📝 Описание"],
+]
+
 class RecurringGameManager:
     def __init__(self, database, announcement_manager):
         self.db = database
         self.announcement_manager = announcement_manager
         self.logger = logging.getLogger(__name__)
     
-    async def create_next_game_from_template(self, template):
-        """Создание следующей игры из шаблона регулярной игры"""
+    async def create_next_game_from_template(self, template, existing_dates=None):
+        """Создание следующей игры из шаблона регулярной игры
+
+        existing_dates — множество (template_id, дата) уже созданных игр; при обходе
+        всех шаблонов его загружают один раз, а не на каждый шаблон.
+        """
         try:
             # Вычисляем дату следующей игры
             next_game_date = self._calculate_next_game_date(template)
             if not next_game_date:
                 return None
-            
+
             # Проверяем, не создана ли уже игра на эту дату
-            existing_games = self.db.get_all_games()
-            for game in existing_games:
-                if (game.recurring_template_id == template.id and 
-                    game.game_date.date() == next_game_date.date()):
-                    self.logger.info(f"Игра для шаблона {template.id} на {next_game_date} уже существует")
-                    return None
+            if existing_dates is None:
+                existing_dates = self.db.get_recurring_game_dates()
+            if (template.id, next_game_date.date()) in existing_dates:
+                self.logger.info(f"Игра для шаблона {template.id} на {next_game_date} уже существует")
+                return None
             
             # Вычисляем дату публикации анонса
             # ИСПРАВЛЕНИЕ: используем правильное имя поля
@@ -58,19 +76,25 @@ class RecurringGameManager:
                 'is_recurring': True,
                 'recurring_template_id': template.id,
                 'host': template.host,
+                'custom_text': template.custom_text,
+                'registration_mode': template.registration_mode,
+                'lottery_window_minutes': template.lottery_window_minutes,
+                'lottery_weighted': template.lottery_weighted,
                 'publication_date': publication_datetime,
                 'is_published': False
             }
             
-            game = self.db.create_game_announcement(game_data)
-            
-            # Планируем публикацию
-            if publication_datetime > datetime.now():
+            # Если время публикации уже прошло, публикуем сразу (через outbox)
+            publish_now = publication_datetime <= datetime.now()
+            game = self.db.create_game_announcement(game_data, publish=publish_now)
+            existing_dates.add((template.id, next_game_date.date()))
+
+            # Планируем публикацию (просроченные игры outbox-воркер опубликует одной пачкой)
+            if publish_now:
+                self.announcement_manager.outbox.notify()
+            else:
                 self.announcement_manager.schedule_announcement_publication(game.id, publication_datetime)
                 self.logger.info(f"Запланирована публикация регулярной игры {game.id} на {publication_datetime}")
-            else:
-                # Если время публикации уже прошло, публикуем сразу
-                await self.announcement_manager._publish_announcement_direct(game)
             
             return game
             
@@ -657,6 +681,9 @@ class RecurringGameManager:
                 'created_by': template.created_by,
                 'template': template.template,
                 'custom_text': template.custom_text,
+                'registration_mode': template.registration_mode,
+                'lottery_window_minutes': template.lottery_window_minutes,
+                'lottery_weighted': template.lottery_weighted,
                 'is_recurring': True,
                 'recurring_template_id': template.id
             }
@@ -742,6 +769,63 @@ class RecurringGameManager:
         
         await update.message.reply_text(text)
     
+    async def subscribe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Подписка на серию: /subscribe — список серий, /subscribe <id> — подписаться"""
+        user_id = update.effective_user.id
+
+        user = self.db.get_user(user_id)
+        if not user or not user.registration_complete:
+            await update.message.reply_text(
+                "❌ Сначала нужно завершить регистрацию!\n"
+                "Используйте /registrate для регистрации."
+            )
+            return
+
+        if not context.args:
+            templates = self.db.get_recurring_templates()
+            if not templates:
+                await update.message.reply_text("📝 Регулярных игр пока нет.")
+                return
+
+            subscriptions = self.db.get_user_subscriptions(user_id)
+            text = "🔔 РЕГУЛЯРНЫЕ ИГРЫ:\n\n"
+            for template in templates:
+                mark = "✅" if template.id in subscriptions else "▫️"
+                text += f"{mark} {template.title} — {self._format_frequency(template.frequency)}, {template.game_time}\n"
+                text += f"🆔 ID: {template.id}\n"
+            text += (
+                "\n💡 /subscribe <id> — автоматически записываться на каждую игру серии\n"
+                "/unsubscribe <id> — отменить подписку"
+            )
+            await update.message.reply_text(text)
+            return
+
+        if not context.args[0].isdigit():
+            await update.message.reply_text("❌ Формат: /subscribe <id>")
+            return
+
+        result = self.db.subscribe_to_template(int(context.args[0]), user_id)
+        if result is None:
+            await update.message.reply_text("❌ Регулярная игра не найдена!")
+        elif result == 'duplicate':
+            await update.message.reply_text("✅ Вы уже подписаны на эту серию")
+        else:
+            await update.message.reply_text(
+                "🔔 Подписка оформлена!\n"
+                "Вы будете записаны на каждую новую игру серии, пока есть места для подписчиков."
+            )
+
+    async def unsubscribe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отписка от серии: /unsubscribe <id>"""
+        if not context.args or not context.args[0].isdigit():
+            await update.message.reply_text("❌ Формат: /unsubscribe <id>")
+            return
+
+        if self.db.unsubscribe_from_template(int(context.args[0]), update.effective_user.id):
+            await update.message.reply_text("🔕 Подписка отменена. Записи на уже созданные игры сохранены.")
+        else:
+            await update.message.reply_text("❌ Вы не были подписаны на эту серию")
+
     async def edit_game(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Редактирование существующей игры"""
         user_id = update.effective_user.id
@@ -781,65 +865,107 @@ class RecurringGameManager:
                 await update.message.reply_text("❌ Игра с таким ID не найдена!")
                 return ConversationHandler.END
             
-            context.user_data['editing_game'] = game
             context.user_data['editing_game_id'] = game_id
             
             await update.message.reply_text(
                 f"✏️ РЕДАКТИРОВАНИЕ ИГРЫ:\n\n"
                 f"🏆 {game.title}\n"
-                f"📅 Текущая дата: {game.game_date.strftime('%d.%m.%Y %H:%M')}\n\n"
-                f"📅 Введите новую дату и время (ДД.ММ.ГГГГ ЧЧ:ММ):\n"
-                f"Пример: 25.11.2023 19:00",
-                reply_markup=ReplyKeyboardRemove()
+                f"📅 {game.game_date.strftime('%d.%m.%Y %H:%M')}\n"
+                f"📍 {game.location}\n"
+                f"🎯 {game.host or 'Не указан'}\n"
+                f"👥 Мест в основе: {game.max_players}\n\n"
+                f"Что изменить?",
+                reply_markup=ReplyKeyboardMarkup(EDIT_FIELDS_KEYBOARD, one_time_keyboard=True)
             )
             
-            return "AWAITING_NEW_DATE"
+            return "AWAITING_FIELD"
             
         except ValueError:
             await update.message.reply_text("❌ Пожалуйста, введите числовой ID игры!")
             return "AWAITING_GAME_ID"
     
-    async def handle_new_date(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработка новой даты игры"""
-        try:
-            date_text = update.message.text
-            day, month, year, hour, minute = map(int, date_text.replace('.', ' ').replace(':', ' ').split())
-            new_date = datetime(year, month, day, hour, minute)
-            
-            # Проверяем, что дата в будущем
-            if new_date < datetime.now():
-                await update.message.reply_text("❌ Новая дата должна быть в будущем! Попробуйте снова:")
-                return "AWAITING_NEW_DATE"
-            
-            game_id = context.user_data['editing_game_id']
-            
-            # Обновляем игру
-            self.db.update_game(game_id, {'game_date': new_date})
-            
-            # Обновляем анонс в канале если есть
-            game = self.db.get_game_by_id(game_id)
-            if game.channel_message_id:
-                try:
-                    await self.announcement_manager.update_channel_announcement(game_id)
-                except Exception as e:
-                    self.logger.error(f"Ошибка при обновлении анонса: {e}")
-            
+    async def handle_edit_field(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Выбор поля игры для изменения"""
+        field = EDIT_FIELDS.get(update.message.text)
+        if not field:
             await update.message.reply_text(
-                f"✅ Дата игры обновлена!\n"
-                f"🏆 {game.title}\n"
-                f"📅 Новая дата: {new_date.strftime('%d.%m.%Y %H:%M')}",
-                reply_markup=ReplyKeyboardRemove()
+                "❌ Пожалуйста, выберите вариант из предложенных:",
+                reply_markup=ReplyKeyboardMarkup(EDIT_FIELDS_KEYBOARD, one_time_keyboard=True)
             )
+            return "AWAITING_FIELD"
+        
+        context.user_data['editing_field'] = field
+        prompts = {
+            'game_date': "📅 Введите новую дату и время (ДД.ММ.ГГГГ ЧЧ:ММ):\nПример: 25.11.2023 19:00",
+            'max_players': "👥 Введите количество мест в основе:",
+            'title': "🏷️ Введите новое название:",
+            'location': "📍 Введите новое место:",
+            'host': "🎯 Введите ведущего:",
+            'description': "📝 Введите новое описание:",
+        }
+        await update.message.reply_text(prompts[field], reply_markup=ReplyKeyboardRemove())
+        return "AWAITING_VALUE"
+    
+    async def handle_edit_value(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Сохранение нового значения поля (анонс обновляется через outbox)"""
+        game_id = context.user_data['editing_game_id']
+        field = context.user_data['editing_field']
+        value = update.message.text.strip()
+        
+        if field == 'game_date':
+            try:
+                day, month, year, hour, minute = map(int, value.replace('.', ' ').replace(':', ' ').split())
+                value = datetime(year, month, day, hour, minute)
+            except ValueError:
+                await update.message.reply_text("❌ Неверный формат! Используйте ДД.ММ.ГГГГ ЧЧ:ММ:")
+                return "AWAITING_VALUE"
             
-            # Очищаем временные данные
-            context.user_data.pop('editing_game', None)
-            context.user_data.pop('editing_game_id', None)
-            
+            # Проверяем, что дата в будущем
+            if value < datetime.now():
+                await update.message.reply_text("❌ Новая дата должна быть в будущем! Попробуйте снова:")
+                return "AWAITING_VALUE"
+        
+        elif field == 'max_players':
+            if not value.isdigit() or int(value) < 1:
+                await update.message.reply_text("❌ Введите положительное число:")
+                return "AWAITING_VALUE"
+            value = int(value)
+        
+        elif not value:
+            await update.message.reply_text("❌ Значение не может быть пустым:")
+            return "AWAITING_VALUE"
+        
+        if field == 'max_players':
+            # Смена мест пересчитывает основу/резерв одним запросом в той же транзакции
+            game, changes = self.db.update_game_capacity(game_id, value)
+        else:
+            game, changes = self.db.update_game(game_id, {field: value}), None
+        
+        context.user_data.pop('editing_game_id', None)
+        context.user_data.pop('editing_field', None)
+        
+        if not game:
+            await update.message.reply_text("❌ Игра не найдена!")
             return ConversationHandler.END
-            
-        except (ValueError, AttributeError):
-            await update.message.reply_text("❌ Неверный формат! Используйте ДД.ММ.ГГГГ ЧЧ:ММ:")
-            return "AWAITING_NEW_DATE"
+        
+        self.announcement_manager.outbox.notify()
+        
+        text = f"✅ Игра обновлена!\n🏆 {game.title}\n📅 {game.game_date.strftime('%d.%m.%Y %H:%M')}"
+        if changes is not None:
+            text += f"\n👥 Мест в основе: {game.max_players}"
+            if changes['promoted']:
+                text += f"\n⬆️ Переведены в основу: {len(changes['promoted'])}"
+            if changes['demoted']:
+                text += f"\n⬇️ Переведены в резерв: {len(changes['demoted'])}"
+            if changes['promoted'] or changes['demoted']:
+                self.logger.info(
+                    "Перераспределение состава игры %s: +%s в основу, %s в резерв",
+                    game_id, len(changes['promoted']), len(changes['demoted']),
+                    extra={'game_id': game_id}
+                )
+        
+        await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
     
     async def cancel_creation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Отмена создания шаблона"""
@@ -3,6 +3,8 @@ from telegram.ext import ContextTypes, ConversationHandler
 from enum import Enum
 import logging
 from datetime import datetime
+from .database import NicknameTaken
+from .nicknames import NicknameRegistry
 
 # Состояния регистрации
 class RegistrationState(Enum):
@@ -16,6 +18,8 @@ class RegistrationManager:
     def __init__(self, database):
         self.db = database
         self.logger = logging.getLogger(__name__)
+        # Занятые ники в памяти: загружаются при старте бота
+        self.nicknames = NicknameRegistry(database)
 
     async def start_registration(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начало регистрации (заменяет /start)"""
@@ -87,11 +91,10 @@ class RegistrationManager:
             await update.message.reply_text("❌ Игровой ник должен содержать минимум 3 символа. Попробуйте еще раз:")
             return RegistrationState.GAME_NICKNAME
         
-        # Проверяем уникальность ника (кроме текущего пользователя)
-        existing_user = self.db.get_user_by_nickname(game_nickname)
+        # Проверяем уникальность ника по списку в памяти (свой текущий ник можно оставить)
         current_user_id = context.user_data['registration'].get('user_id')
-        if existing_user and existing_user.user_id != current_user_id:
-            await update.message.reply_text("❌ Этот игровой ник уже занят. Выберите другой:")
+        if not self.nicknames.is_available(game_nickname, current_user_id):
+            await self._reply_nickname_taken(update, game_nickname, current_user_id)
             return RegistrationState.GAME_NICKNAME
         
         context.user_data['registration']['game_nickname'] = game_nickname
@@ -194,17 +197,28 @@ class RegistrationManager:
                 'registered_at': datetime.utcnow()
             }
             
-            # Обновляем или создаем пользователя
-            existing_user = self.db.get_user(user_id)
-            if existing_user:
-                self.db.update_user(user_id, user_data)
-                message = "✅ Профиль успешно обновлен!"
-            else:
-                self.db.add_user(user_data)
-                message = "🎉 Регистрация завершена! Добро пожаловать!"
+            # Ник занимается в реестре (отказ без запроса к базе), затем один upsert:
+            # создание или обновление с возвратом итоговой записи; окончательно
+            # уникальность ника проверяет индекс в базе
+            try:
+                self.nicknames.claim(user_data['game_nickname'], user_id)
+                final_user, created = self.db.upsert_user(user_data)
+            except NicknameTaken:
+                # Ник заняли, пока пользователь заполнял профиль: реестр сверяется с базой
+                owner = self.db.get_user_by_nickname(user_data['game_nickname'])
+                if owner:
+                    self.nicknames.remember(owner.game_nickname, owner.user_id)
+                else:
+                    self.nicknames.release(user_data['game_nickname'])
+                await self._reply_nickname_taken(update, user_data['game_nickname'], user_id)
+                return RegistrationState.GAME_NICKNAME
+            self.nicknames.remember(final_user.game_nickname, user_id)
+            self.logger.info(
+                "Пользователь %s %s", user_id, "зарегистрирован" if created else "обновил профиль",
+                extra={'user_id': user_id}
+            )
             
             # Показываем финальный профиль
-            final_user = self.db.get_user(user_id)
             profile_text = self._format_final_profile(final_user)
             
             if final_user.photo_id:
@@ -243,6 +257,26 @@ class RegistrationManager:
         )
         return ConversationHandler.END
 
+    async def timeout_registration(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Таймаут регистрации: очищаем незаконченный профиль (в нем может быть фото)"""
+        context.user_data.pop('registration', None)
+        context.user_data.pop('is_editing', None)
+        if update.effective_chat:
+            await context.bot.send_message(
+                update.effective_chat.id,
+                "⌛ Время на регистрацию истекло. Начните заново: /registrate",
+                reply_markup=ReplyKeyboardRemove()
+            )
+
+    async def _reply_nickname_taken(self, update: Update, game_nickname, user_id):
+        """Ответ на занятый ник со свободными вариантами на кнопках"""
+        suggestions = self.nicknames.suggest(game_nickname, user_id)
+        await update.message.reply_text(
+            "❌ Этот игровой ник уже занят. Выберите другой"
+            + (" или возьмите свободный вариант:" if suggestions else ":"),
+            reply_markup=ReplyKeyboardMarkup([suggestions], one_time_keyboard=True) if suggestions else ReplyKeyboardRemove()
+        )
+
     def _format_profile_preview(self, data):
         """Форматирование превью профиля"""
         bio_text = data.get('bio') or "Не указано"
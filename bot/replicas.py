@@ -0,0 +1,87 @@
+import os
+import re
+import time
+import logging
+from contextvars import ContextVar
+from sqlalchemy import text
+
+# До какого момента (time.monotonic) чтения текущей задачи идут на основную базу
+_primary_until = ContextVar('primary_until', default=0.0)
+
+# Отставание реплики в секундах; 0, если все полученное уже применено
+LAG_SQL = text("""
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+# DML в любом месте запроса: WITH ... UPDATE/INSERT и текстовые запросы тоже.
+# SELECT ... FOR UPDATE тоже попадает сюда — это часть записи, лишнее закрепление безвредно
+_WRITE_RE = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE)\b', re.IGNORECASE)
+
+
+def replica_urls():
+    """Адреса реплик для чтения из DB_REPLICA_URLS (через запятую)"""
+    return [url.strip() for url in os.getenv('DB_REPLICA_URLS', '').split(',') if url.strip()]
+
+
+def pin_to_primary(seconds):
+    """Чтения текущей задачи (апдейта, прохода воркера) — с основной базы ближайшие seconds"""
+    _primary_until.set(time.monotonic() + seconds)
+
+
+def pinned_to_primary():
+    return time.monotonic() < _primary_until.get()
+
+
+def is_write(statement, context):
+    """Запрос меняет данные (в том числе CTE с UPDATE и текстовые UPDATE)"""
+    if context is not None and (context.isinsert or context.isupdate or context.isdelete):
+        return True
+    return _WRITE_RE.search(statement) is not None
+
+
+class Replica:
+    """Реплика для чтения с учетом отставания
+
+    Отставание проверяется не чаще раза в check_interval секунд, прямо при выборе
+    реплики. Отставшая больше max_lag или упавшая реплика пропускается; упавшая —
+    на retry_seconds.
+    """
+
+    def __init__(self, engine, session_factory, max_lag, check_interval, retry_seconds):
+        self.engine = engine
+        self.SessionLocal = session_factory
+        self.name = engine.url.host or str(engine.url)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_seconds = retry_seconds
+        self.logger = logging.getLogger(__name__)
+        self.lag = None
+        self._checked_at = 0.0
+        self._down_until = 0.0
+
+    def available(self):
+        now = time.monotonic()
+        if now < self._down_until:
+            return False
+        if now - self._checked_at >= self.check_interval:
+            self._check_lag(now)
+        return self.lag is not None and self.lag <= self.max_lag
+
+    def _check_lag(self, now):
+        self._checked_at = now
+        try:
+            with self.engine.connect() as conn:
+                self.lag = float(conn.execute(LAG_SQL).scalar())
+        except Exception as e:
+            self.mark_down(e)
+            return
+        if self.lag > self.max_lag:
+            self.logger.warning(f"Реплика {self.name} отстает на {self.lag:.1f} c, чтения идут на основную базу")
+
+    def mark_down(self, error):
+        self.lag = None
+        self._down_until = time.monotonic() + self.retry_seconds
+        self.logger.warning(f"Реплика {self.name} недоступна на {self.retry_seconds:.0f} c: {error}")
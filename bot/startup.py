@@ -0,0 +1,77 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+
+
+def fast_start_enabled():
+    """Быстрый старт (FAST_START, по умолчанию включен): сверка схемы и фоновые задачи запуска
+
+    Импорты он не откладывает: модули бота и SQLAlchemy нужны, чтобы ответить на
+    первый апдейт, их время в отчете — этап «импорт».
+    """
+    return os.getenv('FAST_START', 'true').lower() in ('1', 'true', 'yes')
+
+
+class StartupReport:
+    """Отчет о времени запуска: этапы до готовности, фоновые задачи и первый апдейт
+
+    started — time.perf_counter() в самом начале процесса (до тяжелых импортов).
+    """
+
+    def __init__(self, started):
+        self.started = started
+        self.logger = logging.getLogger(__name__)
+        self.phases = []
+        self.ready_at = None
+        self._first_update_seen = False
+
+    def elapsed_ms(self, since=None):
+        return round((time.perf_counter() - (since or self.started)) * 1000, 1)
+
+    def mark(self, name):
+        """Этап от начала процесса до этого момента (например, импорт модулей)"""
+        self.phases.append((name, self.elapsed_ms() - sum(ms for _, ms in self.phases)))
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, self.elapsed_ms(started)))
+
+    def ready(self):
+        """Бот принимает апдейты: сводка по этапам в лог"""
+        self.ready_at = time.perf_counter()
+        phases = ', '.join(f"{name} {ms:.0f}" for name, ms in self.phases)
+        self.logger.info(
+            f"🚀 Бот готов принимать апдейты через {self.elapsed_ms():.0f} мс после старта ({phases})",
+            extra={'duration_ms': self.elapsed_ms()}
+        )
+
+    def first_update(self):
+        """Первый апдейт после запуска (вызывается на каждом апдейте, пишет один раз)"""
+        if self._first_update_seen:
+            return
+        self._first_update_seen = True
+        self.logger.info(
+            f"Первый апдейт через {self.elapsed_ms():.0f} мс после старта",
+            extra={'duration_ms': self.elapsed_ms()}
+        )
+
+    async def run_background(self, tasks):
+        """Фоновые задачи запуска параллельно: {название: корутина}; ошибки не валят бота"""
+        async def run(name, coroutine):
+            started = time.perf_counter()
+            try:
+                await coroutine
+            except Exception as e:
+                self.logger.error(f"Фоновая задача запуска «{name}» упала: {e}")
+                return name, None
+            return name, self.elapsed_ms(started)
+
+        results = await asyncio.gather(*(run(name, coroutine) for name, coroutine in tasks.items()))
+        summary = ', '.join(f"{name} {ms:.0f}" if ms is not None else f"{name} ошибка" for name, ms in results)
+        self.logger.info(f"Фоновые задачи запуска завершены через {self.elapsed_ms():.0f} мс после старта ({summary})")
@@ -1,58 +1,315 @@
 from datetime import datetime
+from collections import OrderedDict
+from functools import lru_cache
+from html.parser import HTMLParser
+import html
 import logging
+import os
+import re
+import time
+
+# Плейсхолдеры вида {{time}}; пробелы внутри скобок допускаются
+PLACEHOLDER_RE = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+PLACEHOLDERS = {
+    'title': 'название игры',
+    'description': 'описание',
+    'date': 'дата и время (20.11 (19:00))',
+    'day': 'дата (20.11)',
+    'time': 'время (19:00)',
+    'weekday': 'день недели',
+    'location': 'место',
+    'host': 'ведущий',
+    'max_players': 'мест в основе',
+    'current_players': 'записано в основу',
+    'reserve_count': 'записано в резерв',
+    'players_list': 'список игроков',
+}
+
+WEEKDAYS = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+
+_DEFAULT_BODY = """🏆 {{title}}
+
+📝 {{description}}
+
+📅 {{date}}
+📍 {{location}}
+
+👥 Участники ({{current_players}}/{{max_players}}):
+{{players_list}}
+
+🎯 Ведущий: {{host}}"""
+
+# Встроенные шаблоны: используются, пока в БД нет шаблона с таким именем
+DEFAULT_TEMPLATES = {
+    'standard': {'name': 'Стандартная игра', 'template': _DEFAULT_BODY},
+    'league': {'name': 'ЛИГА КЛУБОВ + ЛИГА МИТ', 'template': _DEFAULT_BODY},
+    'tournament': {'name': 'Турнир', 'template': _DEFAULT_BODY},
+}
+
+
+def validate_template(source):
+    """Проверка плейсхолдеров шаблона; возвращает список неизвестных"""
+    return sorted({name for name in PLACEHOLDER_RE.findall(source) if name not in PLACEHOLDERS})
+
+
+# Разметка, которую Telegram принимает с parse_mode='HTML'
+ALLOWED_TAGS = {
+    'b', 'strong', 'i', 'em', 'u', 'ins', 's', 'strike', 'del', 'span', 'tg-spoiler',
+    'a', 'code', 'pre', 'blockquote', 'tg-emoji',
+}
+ALLOWED_ENTITIES = {'lt', 'gt', 'amp', 'quot'}
+
+
+class _TelegramHTMLChecker(HTMLParser):
+    """Строгая проверка HTML для Bot API: только поддерживаемые теги, все закрыты по порядку"""
 
-class GameTemplates:
     def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.errors = []
+        self.stack = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag not in ALLOWED_TAGS:
+            self.errors.append(f"тег <{tag}> не поддерживается")
+            return
+        if tag == 'span' and attrs.get('class') != 'tg-spoiler':
+            self.errors.append('<span> допускается только с class="tg-spoiler"')
+        if tag == 'a' and not attrs.get('href'):
+            self.errors.append("у <a> нет href")
+        self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.errors.append(f"самозакрывающийся тег <{tag}/> не поддерживается")
+
+    def handle_endtag(self, tag):
+        if self.stack and self.stack[-1] == tag:
+            self.stack.pop()
+        elif tag in self.stack:
+            self.errors.append(f"</{tag}> закрывает тег раньше вложенного <{self.stack[-1]}>")
+            del self.stack[self.stack.index(tag):]
+        else:
+            self.errors.append(f"лишний закрывающий тег </{tag}>")
+
+    def handle_entityref(self, name):
+        if name not in ALLOWED_ENTITIES:
+            self.errors.append(f"сущность &{name}; не поддерживается")
+
+    def handle_data(self, data):
+        for char, entity in (('<', '&lt;'), ('>', '&gt;'), ('&', '&amp;')):
+            if char in data:
+                self.errors.append(f"символ {char} вне тега нужно писать как {entity}")
+
+    def handle_comment(self, data):
+        self.errors.append("HTML-комментарии не поддерживаются")
+
+    def handle_decl(self, decl):
+        self.errors.append(f"<!{decl}> не поддерживается")
+
+    def handle_pi(self, data):
+        self.errors.append(f"<?{data}> не поддерживается")
+
+    def close(self):
+        super().close()
+        # Незавершенный тег в конце текста парсер отдает как данные
+        if self.rawdata:
+            self.handle_data(self.rawdata)
+        self.errors.extend(f"тег <{tag}> не закрыт" for tag in reversed(self.stack))
+
+
+@lru_cache(maxsize=1024)
+def validate_html(source):
+    """Ошибки HTML-разметки для parse_mode='HTML' (пустой кортеж — разметка корректна)"""
+    checker = _TelegramHTMLChecker()
+    checker.feed(source)
+    checker.close()
+    return tuple(dict.fromkeys(checker.errors))
+
+
+def validate_template_html(source):
+    """Ошибки разметки шаблона; плейсхолдеры подставляются экранированными и не проверяются"""
+    return list(validate_html(PLACEHOLDER_RE.sub('x', source)))
+
+
+def compile_template(source):
+    """Разбор шаблона в функцию render(values) -> str
+
+    Текст разбирается один раз на куски (литерал, имя поля); рендер только склеивает
+    литералы с уже экранированными значениями.
+    """
+    parts = []
+    position = 0
+    for match in PLACEHOLDER_RE.finditer(source):
+        parts.append((source[position:match.start()], match.group(1)))
+        position = match.end()
+    tail = source[position:]
+    parts = tuple(parts)
+
+    def render(values):
+        chunks = []
+        for literal, field in parts:
+            chunks.append(literal)
+            chunks.append(values.get(field, ''))
+        chunks.append(tail)
+        return ''.join(chunks)
+
+    return render
+
+
+@lru_cache(maxsize=256)
+def _compile_custom(source):
+    """Компиляция custom_text игры/шаблона (кэш по самому тексту)"""
+    return compile_template(source)
+
+
+def _escape_value(value):
+    return html.escape(str(value), quote=False)
+
+
+def _markup_value(value):
+    """Текст от админа (название, описание): корректная HTML-разметка остается как есть,
+    как было до шаблонов; все остальное экранируется, чтобы не ломать отправку анонса"""
+    value = str(value or '')
+    if not validate_html(value):
+        return value
+    return _escape_value(value)
+
+
+@lru_cache(maxsize=4096)
+def escape_nickname(nickname):
+    """HTML-экранирование ника (анонсы отправляются с parse_mode='HTML')"""
+    return html.escape(nickname, quote=False)
+
+
+class GameTemplates:
+    def __init__(self, database=None):
+        self.db = database
         self.logger = logging.getLogger(__name__)
-    
+        self.cache_ttl = int(os.getenv('TEMPLATE_CACHE_TTL', '60'))
+        self._compiled = {}  # name -> (version, render)
+        self._versions = {}  # name -> version из БД
+        self._versions_checked_at = 0.0
+        self._static_cache = OrderedDict()  # экранированные поля игры, которые не меняются между правками
+
+        for name, data in DEFAULT_TEMPLATES.items():
+            self._compiled[name] = (0, compile_template(data['template']))
+
     def get_templates(self):
-        return {
-            'standard': {
-                'name': 'Стандартная игра',
-                'template': """🏆 {title}
+        return DEFAULT_TEMPLATES
 
-📝 {description}
+    def invalidate(self):
+        """Принудительная перепроверка версий при следующем рендере"""
+        self._versions_checked_at = 0.0
 
-📅 {date}
-📍 {location}
+    def _refresh_versions(self):
+        """Не чаще раза в TEMPLATE_CACHE_TTL секунд сверяем версии шаблонов с БД"""
+        if self.db is None:
+            return
+        now = time.monotonic()
+        if now - self._versions_checked_at < self.cache_ttl:
+            return
+        self._versions_checked_at = now
+        try:
+            self._versions = self.db.get_template_versions()
+        except Exception as e:
+            self.logger.error(f"Не удалось получить версии шаблонов: {e}")
 
-👥 Участники ({current_players}/{max_players}):
-{players_list}
+    def _get_renderer(self, name):
+        """Скомпилированный шаблон по имени с учетом версии в БД"""
+        self._refresh_versions()
+        version = self._versions.get(name)
 
-🎯 Ведущий: {host}"""
-            },
-            'league': {
-                'name': 'ЛИГА КЛУБОВ + ЛИГА МИТ',
-                'template': """🏆 {title}
+        if version is None:
+            # В БД такого шаблона нет: встроенный или стандартный
+            if name not in DEFAULT_TEMPLATES:
+                name = 'standard'
+            return self._compiled[name][1]
 
-📝 {description}
+        cached = self._compiled.get(name)
+        if cached and cached[0] == version:
+            return cached[1]
 
-📅 {date}
-📍 {location}
+        template = self.db.get_announcement_template(name)
+        if not template:
+            return self._compiled.get(name, self._compiled['standard'])[1]
 
-👥 Участники ({current_players}/{max_players}):
-{players_list}
+        render = compile_template(template.body)
+        self._compiled[name] = (template.version, render)
+        self.logger.info(f"Шаблон '{name}' скомпилирован (версия {template.version})")
+        return render
 
-🎯 Ведущий: {host}"""
-            },
-            'tournament': {
-                'name': 'Турнир', 
-                'template': """🏆 {title}
+    def _static_values(self, game):
+        """Экранированные поля игры, кэшируются до изменения самих полей"""
+        key = (game.id, game.title, game.description, game.game_date, game.location, game.host, game.max_players)
+        values = self._static_cache.get(key)
+        if values is not None:
+            self._static_cache.move_to_end(key)
+            return values
 
-📝 {description}
+        escape = _escape_value  # короткое имя для читаемости словаря ниже
+        values = {
+            'title': _markup_value(game.title),
+            'description': _markup_value(game.description),
+            'date': escape(self.format_date(game.game_date)),
+            'day': game.game_date.strftime('%d.%m'),
+            'time': game.game_date.strftime('%H:%M'),
+            'weekday': WEEKDAYS[game.game_date.weekday()],
+            'location': escape(game.location or 'Не указана'),
+            'host': escape(game.host or 'Не указан'),
+            'max_players': str(game.max_players),
+        }
+        self._static_cache[key] = values
+        if len(self._static_cache) > 512:
+            self._static_cache.popitem(last=False)
+        return values
 
-📅 {date}
-📍 {location}
+    def format_players_list(self, registrations):
+        """Список игроков из экранированных ников"""
+        lines = []
+        main_index = 0
+        reserve_index = 0
 
-👥 Участники ({current_players}/{max_players}):
-{players_list}
+        for reg in registrations:
+            if reg.user and reg.user.game_nickname:
+                player_name = escape_nickname(reg.user.game_nickname)
+            else:
+                player_name = "Неизвестный игрок"
 
-🎯 Ведущий: {host}"""
-            }
-        }
+            if reg.is_reserve:
+                if reserve_index == 0:
+                    lines.append("\n⏳ Резерв:")
+                reserve_index += 1
+                lines.append(f"R{reserve_index}. {player_name}")
+            else:
+                main_index += 1
+                lines.append(f"{main_index}. {player_name}")
+
+        # Если записей нет
+        if not lines:
+            return "Пока никто не записался 😔"
+
+        return "\n".join(lines)
+
+    def render(self, game, registrations):
+        """Текст анонса игры: custom_text игры или шаблон по имени"""
+        if game.custom_text:
+            renderer = _compile_custom(game.custom_text)
+        else:
+            renderer = self._get_renderer(game.template or 'standard')
+
+        # Основной состав идет раньше резерва, как в get_game_registrations
+        registrations = sorted(registrations, key=lambda r: r.is_reserve)
+        current_players = sum(1 for r in registrations if not r.is_reserve)
+
+        values = dict(self._static_values(game))
+        values['current_players'] = str(current_players)
+        values['reserve_count'] = str(len(registrations) - current_players)
+        values['players_list'] = self.format_players_list(registrations)
+        return renderer(values)
 
     def format_date(self, date):
         """Форматирование даты"""
         if isinstance(date, datetime):
             return date.strftime('%d.%m (%H:%M)')
-        return date
\ No newline at end of file
+        return date
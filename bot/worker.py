@@ -0,0 +1,111 @@
+import os
+import random
+import asyncio
+import logging
+from telegram.error import RetryAfter, BadRequest, Forbidden
+
+
+class QueueWorker:
+    """Фоновый цикл над очередью в БД: пачки, пробуждение по notify, повторы с экспоненциальной задержкой
+
+    Настройки читаются из окружения с префиксом env_prefix: <prefix>_BATCH_SIZE,
+    _POLL_INTERVAL, _MAX_ATTEMPTS, _RETRY_BASE_DELAY, _RETRY_MAX_DELAY, _LEASE_SECONDS,
+    _COALESCE_DELAY. Подкласс задает drain() (одна пачка), _retry() (запись повтора в БД)
+    и _describe() (элемент очереди для логов).
+    """
+
+    # Название для логов и уровень записи об отброшенном элементе
+    title = "Воркер"
+    give_up_level = logging.ERROR
+
+    def __init__(self, database, env_prefix, batch_size, poll_interval, max_attempts, lease_seconds,
+                 coalesce_delay=0.0):
+        self.db = database
+        # Логгер модуля подкласса: выборка логов настраивается по его имени
+        self.logger = logging.getLogger(type(self).__module__)
+        self.batch_size = int(os.getenv(f'{env_prefix}_BATCH_SIZE', batch_size))
+        self.poll_interval = float(os.getenv(f'{env_prefix}_POLL_INTERVAL', poll_interval))
+        self.max_attempts = int(os.getenv(f'{env_prefix}_MAX_ATTEMPTS', max_attempts))
+        self.base_delay = float(os.getenv(f'{env_prefix}_RETRY_BASE_DELAY', '2'))
+        self.max_delay = float(os.getenv(f'{env_prefix}_RETRY_MAX_DELAY', '300'))
+        self.lease_seconds = int(os.getenv(f'{env_prefix}_LEASE_SECONDS', lease_seconds))
+        self.coalesce_delay = float(os.getenv(f'{env_prefix}_COALESCE_DELAY', coalesce_delay))
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        """Запуск фонового цикла"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self.logger.info(f"{self.title} запущен")
+
+    async def stop(self):
+        """Остановка фонового цикла"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self.logger.info(f"{self.title} остановлен")
+
+    def notify(self):
+        """Разбудить воркер после записи в очередь (иначе он проснется по таймеру)"""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                processed = await self.drain()
+            except Exception as e:
+                self.logger.error(f"{self.title}: ошибка обработки пачки: {e}")
+                processed = 0
+
+            if processed >= self.batch_size:
+                # Очередь не пуста — сразу берем следующую пачку
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                if self.coalesce_delay:
+                    # Записи, поставленные почти одновременно, собираются в одну пачку
+                    await asyncio.sleep(self.coalesce_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def drain(self):
+        """Обработка одной пачки; возвращает число взятых элементов"""
+        raise NotImplementedError
+
+    def _retry(self, item, error, delay, give_up):
+        """Запись повтора (или отказа) в БД"""
+        raise NotImplementedError
+
+    def _describe(self, item):
+        """Элемент очереди для логов и поля extra"""
+        raise NotImplementedError
+
+    def _schedule_retry(self, item, error):
+        """Повтор с экспоненциальной задержкой; постоянные ошибки (BadRequest, Forbidden) не повторяются"""
+        permanent = isinstance(error, (BadRequest, Forbidden))
+        give_up = permanent or item['attempts'] >= self.max_attempts
+
+        if isinstance(error, RetryAfter):
+            delay = float(error.retry_after)
+        else:
+            delay = min(self.max_delay, self.base_delay * 2 ** (item['attempts'] - 1))
+            delay *= random.uniform(0.8, 1.2)
+
+        self._retry(item, error, delay, give_up)
+        description, extra = self._describe(item)
+        if give_up:
+            self.logger.log(
+                self.give_up_level, "%s отброшено после %s попыток: %s",
+                description, item['attempts'], error, extra=extra
+            )
+        else:
+            self.logger.warning(
+                "%s будет повторено через %.1f c: %s", description, delay, error, extra=extra
+            )
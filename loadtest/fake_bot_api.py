@@ -0,0 +1,124 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class FakeBotApiServer:
+    """Локальный фейковый Telegram Bot API: записывает вызовы и умеет отдавать 429"""
+
+    def __init__(self, host='127.0.0.1', port=0, rate_limit_ratio=0.0, retry_after=1):
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        """Значение для TELEGRAM_API_BASE_URL"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.rate_limited.clear()
+
+    def _next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _message(self, params):
+        """Объект Message, достаточный для python-telegram-bot"""
+        chat_id = params.get('chat_id', 0)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            chat_id = -1000000000000
+        message_id = params.get('message_id')
+        return {
+            'message_id': int(message_id) if message_id else self._next_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'channel' if chat_id < 0 else 'private'},
+            'text': params.get('text', ''),
+        }
+
+    def handle(self, method, params):
+        """Ответ на вызов метода Bot API: (HTTP-статус, тело ответа)"""
+        with self._lock:
+            self.calls[method] += 1
+
+        if method != 'getMe' and self.rate_limit_ratio and random.random() < self.rate_limit_ratio:
+            with self._lock:
+                self.rate_limited[method] += 1
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }
+
+        if method == 'getMe':
+            result = {
+                'id': 1,
+                'is_bot': True,
+                'first_name': 'LoadTestBot',
+                'username': 'loadtest_bot',
+                'can_join_groups': True,
+                'can_read_all_group_messages': False,
+                'supports_inline_queries': False,
+            }
+        elif method in ('sendMessage', 'editMessageText', 'sendPhoto'):
+            result = self._message(params)
+        else:
+            result = True
+        return 200, {'ok': True, 'result': result}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8') if length else ''
+                content_type = self.headers.get('Content-Type', '')
+
+                if 'application/json' in content_type and body:
+                    params = json.loads(body)
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body).items()}
+
+                status, payload = server.handle(method, params)
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                # Не засоряем вывод строкой на каждый запрос
+                pass
+
+        return Handler
@@ -0,0 +1,254 @@
+"""Нагрузочный тест записи на игры против фейкового Bot API.
+
+Пример:
+    python -m loadtest.run --users 500 --max-players 20 --leave-ratio 0.2 --rate-limit-ratio 0.05
+
+Запускать только на тестовой базе: скрипт создает dummy-пользователей и игру.
+"""
+import os
+import math
+import time
+import random
+import asyncio
+import argparse
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+
+from telegram import Update
+
+from .fake_bot_api import FakeBotApiServer
+
+DUMMY_USER_ID_BASE = 900_000_000
+
+
+def percentile(values, pct):
+    """Перцентиль по отсортированной выборке (ближайший ранг)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def seed_dummy_users(db, count):
+    """Создание N dummy-пользователей через Database.add_user"""
+    user_ids = []
+    created = 0
+    for i in range(count):
+        user_id = DUMMY_USER_ID_BASE + i
+        if not db.get_user(user_id):
+            db.add_user({
+                'user_id': user_id,
+                'username': f'dummy{i}',
+                'first_name': 'Dummy',
+                'name': f'Dummy {i}',
+                'game_nickname': f'dummy_{i}',
+                'registration_complete': True,
+                'registered_at': datetime.utcnow(),
+            })
+            created += 1
+        user_ids.append(user_id)
+    return user_ids, created
+
+
+def make_callback_update(bot, update_id, user_id, data, channel_id=None):
+    """Update с callback_query: нажатие кнопки в личке или под постом в канале (channel_id)"""
+    if channel_id:
+        chat = {'id': int(channel_id), 'type': 'channel', 'title': 'Load test channel'}
+    else:
+        chat = {'id': user_id, 'type': 'private'}
+    return Update.de_json({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Dummy'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': chat,
+                'text': '🎮 ДОСТУПНЫЕ ИГРЫ',
+            },
+        },
+    }, bot)
+
+
+def check_roster(db, game_id, max_players):
+    """Поиск нарушений: переполнение основы, дубли, резерв при свободных местах"""
+    registrations = db.get_game_registrations(game_id)
+    main = [r for r in registrations if not r.is_reserve]
+    reserve = [r for r in registrations if r.is_reserve]
+    user_counts = Counter(r.user_id for r in registrations)
+
+    violations = []
+    if len(main) > max_players:
+        violations.append(f"основной состав {len(main)} > max_players {max_players}")
+    duplicates = [user_id for user_id, count in user_counts.items() if count > 1]
+    if duplicates:
+        violations.append(f"дублирующиеся записи: {len(duplicates)} пользователей")
+    if reserve and len(main) < max_players:
+        violations.append(f"{len(reserve)} в резерве при свободных местах ({len(main)}/{max_players})")
+    return main, reserve, violations
+
+
+async def run_burst(bot_app, user_ids, game_id, concurrency, leave_ratio, channel_id=None):
+    """Пачка join (и части leave) callback'ов через полный конвейер Application"""
+    application = bot_app.application
+    errors = Counter()
+
+    async def on_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    application.add_error_handler(on_error)
+
+    actions = [(user_id, f'join_{game_id}') for user_id in user_ids]
+    leavers = random.sample(user_ids, int(len(user_ids) * leave_ratio))
+    actions += [(user_id, f'leave_{game_id}') for user_id in leavers]
+
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    update_ids = iter(range(1, len(actions) + 1))
+
+    async def fire(user_id, data):
+        async with semaphore:
+            update = make_callback_update(application.bot, next(update_ids), user_id, data, channel_id)
+            started = time.perf_counter()
+            await application.process_update(update)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    # Сначала все join, затем leave: так проверяется и продвижение резерва
+    await asyncio.gather(*(fire(u, d) for u, d in actions if d.startswith('join_')))
+    await asyncio.gather(*(fire(u, d) for u, d in actions if d.startswith('leave_')))
+    elapsed = time.perf_counter() - started
+
+    return latencies, elapsed, errors
+
+
+def cleanup(db, game_id, user_ids):
+    """Удаление тестовой игры и dummy-пользователей"""
+    from bot.models import GameAnnouncement, GameRegistration, User, OutboxEvent
+
+    session = db.get_session()
+    try:
+        session.query(OutboxEvent).filter(OutboxEvent.game_id == game_id).delete()
+        session.query(GameRegistration).filter(GameRegistration.game_id == game_id).delete()
+        session.query(GameAnnouncement).filter(GameAnnouncement.id == game_id).delete()
+        session.query(User).filter(User.user_id.in_(user_ids)).delete(synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+
+
+async def main(args):
+    # 429 включаются только на время пачки, чтобы подготовка не падала
+    server = FakeBotApiServer(retry_after=args.retry_after).start()
+    os.environ['TELEGRAM_API_BASE_URL'] = server.base_url
+    os.environ.setdefault('BOT_TOKEN', '123456:LOADTEST')
+    os.environ.setdefault('CHANNEL_ID', '-1001234567890')
+    # Превышение бюджета SQL-запросов обработчиком попадает в ошибки отчета
+    os.environ.setdefault('QUERY_BUDGET_MODE', 'raise')
+    # Пачка — одновременный наплыв на одну игру: лимит игры по умолчанию не мешает замеру
+    # пути записи (задайте FLOOD_GAME_RATE/FLOOD_GAME_BURST, чтобы проверить отсев)
+    os.environ.setdefault('FLOOD_GAME_RATE', '1000000')
+    os.environ.setdefault('FLOOD_GAME_BURST', '1000000')
+
+    from bot.main import TelegramBot
+
+    logging.getLogger().setLevel(args.log_level)
+
+    bot_app = TelegramBot()
+    bot_app.db.init_db()
+    bot_app.setup_handlers()
+    await bot_app.application.initialize()
+
+    db = bot_app.db
+    print(f"🤖 Фейковый Bot API: {server.base_url}")
+
+    seed_started = time.perf_counter()
+    user_ids, created = seed_dummy_users(db, args.users)
+    print(f"👥 Dummy-пользователей: {len(user_ids)} (создано {created}) за {time.perf_counter() - seed_started:.1f} c")
+
+    game = db.create_game_announcement({
+        'title': 'Load test',
+        'description': 'Нагрузочный тест записи',
+        'game_date': datetime.utcnow() + timedelta(days=1),
+        'max_players': args.max_players,
+        'created_by': DUMMY_USER_ID_BASE,
+        'registration_mode': 'lottery' if args.lottery else 'fcfs',
+        'lottery_window_minutes': 60,
+    })
+    await bot_app.game_manager.publish_game(game.id)
+    server.reset()
+    server.rate_limit_ratio = args.rate_limit_ratio
+
+    try:
+        latencies, elapsed, errors = await run_burst(
+            bot_app, user_ids, game.id, args.concurrency, args.leave_ratio,
+            os.environ['CHANNEL_ID'].split(',')[0] if args.from_channel else None
+        )
+        draw_elapsed = None
+        if args.lottery:
+            # Окно заявок закрывается сразу после пачки: один розыгрыш одной транзакцией
+            draw_started = time.perf_counter()
+            db.draw_lottery(game.id)
+            draw_elapsed = time.perf_counter() - draw_started
+        # Обновления анонса копятся в outbox и отправляются пачками отдельно от callback'ов
+        drain_started = time.perf_counter()
+        while await bot_app.game_manager.outbox.drain():
+            pass
+        drain_elapsed = time.perf_counter() - drain_started
+        main_players, reserve_players, violations = check_roster(db, game.id, args.max_players)
+
+        total = len(latencies)
+        print("\n📊 РЕЗУЛЬТАТЫ")
+        print(f"Обработано callback'ов: {total} за {elapsed:.2f} c ({total / elapsed if elapsed else 0:.1f} upd/s)")
+        print(f"Латентность: p50={percentile(latencies, 50):.1f} мс, "
+              f"p99={percentile(latencies, 99):.1f} мс, max={max(latencies, default=0):.1f} мс")
+        if draw_elapsed is not None:
+            print(f"Розыгрыш мест: {draw_elapsed:.2f} c")
+        print(f"Разбор outbox после пачки: {drain_elapsed:.2f} c")
+        print(f"Состав: {len(main_players)}/{args.max_players} + {len(reserve_players)} в резерве")
+        print("Вызовы Bot API:")
+        for method, count in sorted(server.calls.items()):
+            limited = server.rate_limited.get(method, 0)
+            print(f"  {method}: {count}" + (f" (429: {limited})" if limited else ""))
+        rejected = bot_app.flood_guard.rejected
+        if any(rejected.values()):
+            print("Отсеяно защитой от флуда: " + ", ".join(f"{k}={v}" for k, v in rejected.items()))
+        if errors:
+            print("Ошибки обработчиков: " + ", ".join(f"{k}={v}" for k, v in errors.items()))
+        if violations:
+            print("❌ Нарушения:")
+            for violation in violations:
+                print(f"  - {violation}")
+        else:
+            print("✅ Нарушений не найдено")
+    finally:
+        await bot_app.application.shutdown()
+        if not args.keep_data:
+            cleanup(db, game.id, user_ids)
+        server.stop()
+
+    return 1 if violations else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест записи на игры")
+    parser.add_argument('--users', type=int, default=200, help="количество dummy-пользователей")
+    parser.add_argument('--max-players', type=int, default=10, help="мест в основном составе")
+    parser.add_argument('--concurrency', type=int, default=50, help="одновременных callback'ов")
+    parser.add_argument('--leave-ratio', type=float, default=0.1, help="доля пользователей, которые отпишутся")
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help="доля ответов 429 от фейкового API")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429")
+    parser.add_argument('--lottery', action='store_true', help="запись через розыгрыш: заявки, затем один розыгрыш")
+    parser.add_argument('--from-channel', action='store_true', help="нажатия кнопок под постом в канале")
+    parser.add_argument('--keep-data', action='store_true', help="не удалять тестовые данные")
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    raise SystemExit(asyncio.run(main(parse_args())))
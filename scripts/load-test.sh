@@ -0,0 +1,24 @@
+#!/bin/bash
+
+# Нагрузочный тест записи на игры против фейкового Bot API
+# Использование: ./scripts/load-test.sh --users 500 --max-players 20 --rate-limit-ratio 0.05
+# ⚠️ Запускать только на тестовой базе: создаются dummy-пользователи и тестовая игра
+
+set -e
+
+if [ ! -f .env ]; then
+    echo "❌ .env файл не найден!"
+    exit 1
+fi
+
+if [ -d "venv" ]; then
+    source venv/bin/activate
+fi
+
+# Загружаем переменные окружения
+set -a
+source .env
+set +a
+
+echo "🏋️ Запускаем нагрузочный тест..."
+python3 -m loadtest.run "$@"
@@ -0,0 +1,29 @@
+"""Общие настройки тестов
+
+Бюджеты SQL-запросов (@query_budget) в тестах строгие: превышение — ошибка, а не строка в логе.
+Тестам с базой нужна отдельная база: TEST_DATABASE_URL=postgresql://... (схема пересоздается!)
+"""
+import os
+
+import pytest
+
+os.environ['QUERY_BUDGET_MODE'] = 'raise'
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+
+@pytest.fixture
+def database():
+    """Пустая тестовая база; без TEST_DATABASE_URL тест пропускается"""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL не задан")
+    pytest.importorskip('sqlalchemy')
+    pytest.importorskip('psycopg2')
+    from bot.database import Database
+    from bot.models import Base
+
+    db = Database(TEST_DATABASE_URL)
+    Base.metadata.drop_all(bind=db.engine)
+    db.init_db()
+    yield db
+    db.engine.dispose()
@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+
+from bot.db_pool import InstrumentedQueuePool, pool_options
+
+POOL_SIZE = 2
+MAX_OVERFLOW = 1
+
+
+def _engine(path, **options):
+    return create_engine(
+        f'sqlite:///{path}',
+        poolclass=InstrumentedQueuePool, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_timeout=0.2,
+        connect_args={'check_same_thread': False}, **options,
+    )
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = _engine(tmp_path / 'pool.db')
+    yield engine
+    engine.dispose()
+
+
+def test_pool_options_use_instrumented_pool(monkeypatch):
+    monkeypatch.setenv('DB_POOL_SIZE', '7')
+    options = pool_options()
+    assert options['poolclass'] is InstrumentedQueuePool
+    assert options['pool_size'] == 7
+
+
+def test_concurrent_checkouts_fill_pool_and_overflow(engine):
+    holders = POOL_SIZE + MAX_OVERFLOW
+    checked_out = threading.Barrier(holders + 1)
+    release = threading.Event()
+
+    def hold():
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            checked_out.wait()
+            release.wait()
+
+    threads = [threading.Thread(target=hold) for _ in range(holders)]
+    for thread in threads:
+        thread.start()
+    checked_out.wait()
+    stats = engine.pool.stats()
+
+    # Пул исчерпан: следующая выдача ждет pool_timeout и падает
+    with pytest.raises(PoolTimeoutError):
+        engine.connect()
+    timeout_stats = engine.pool.stats()
+
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert stats['pool_checked_out'] == holders
+    assert stats['pool_overflow'] == MAX_OVERFLOW
+    assert stats['pool_utilization'] == 1.0
+    assert stats['checkout_timeouts'] == 0
+    assert timeout_stats['checkout_timeouts'] == 1
+    assert timeout_stats['checkout_wait_max_ms'] >= 200
+    assert engine.pool.checkouts == holders + 1
+    assert engine.pool.stats()['pool_checked_out'] == 0
+
+
+def test_waiting_checkout_is_timed(engine):
+    conns = [engine.connect() for _ in range(POOL_SIZE + MAX_OVERFLOW)]
+    engine.pool.stats()
+    timer = threading.Timer(0.05, conns[0].close)
+    timer.start()
+    with engine.connect():
+        pass
+    timer.join()
+    for conn in conns[1:]:
+        conn.close()
+
+    stats = engine.pool.stats()
+    assert stats['checkout_wait_max_ms'] >= 40
+    assert stats['checkout_timeouts'] == 0
+    # Максимум ожидания считается заново с каждого снимка
+    assert engine.pool.stats()['checkout_wait_max_ms'] == 0.0
+
+
+def test_connect_errors_and_invalidations_are_counted(engine, tmp_path):
+    broken = _engine(tmp_path / 'missing' / 'pool.db')
+    with pytest.raises(OperationalError):
+        broken.connect()
+    assert broken.pool.stats()['connect_errors'] == 1
+    broken.dispose()
+
+    with engine.connect() as conn:
+        conn.invalidate(ConnectionError("server closed the connection"))
+    with engine.connect() as conn:
+        conn.invalidate()
+    assert engine.pool.stats()['invalidated_connections'] == 1
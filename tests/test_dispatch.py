@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip('telegram')
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+from bot.dispatch import ADMIN, BULK, INTERACTIVE, PriorityUpdateProcessor, classify
+
+CHANNEL = Chat(id=-100500, type=Chat.CHANNEL)
+PRIVATE = Chat(id=42, type=Chat.PRIVATE)
+NOW = datetime.now(timezone.utc)
+
+
+def _user(user_id):
+    return User(id=user_id, first_name=f'user {user_id}', is_bot=False)
+
+
+def _tap(update_id, user_id, data, chat=CHANNEL):
+    post = Message(message_id=1, date=NOW, chat=chat)
+    query = CallbackQuery(id=str(update_id), from_user=_user(user_id), chat_instance='chat', data=data, message=post)
+    return Update(update_id, callback_query=query)
+
+
+def _channel_post(update_id):
+    return Update(update_id, channel_post=Message(message_id=update_id, date=NOW, chat=CHANNEL, text='пост'))
+
+
+def _command(update_id, user_id, text):
+    return Update(update_id, message=Message(message_id=update_id, date=NOW, chat=PRIVATE, from_user=_user(user_id), text=text))
+
+
+@pytest.mark.parametrize('update, lane', [
+    (_tap(1, 7, 'join_10'), INTERACTIVE),
+    (_tap(2, 7, 'leave_10'), INTERACTIVE),
+    (_tap(3, 7, 'join_10', chat=PRIVATE), INTERACTIVE),
+    (_channel_post(4), BULK),
+    (_tap(5, 7, 'something_else'), BULK),
+    (_command(6, 7, '/newgame'), ADMIN),
+    (_command(7, 7, '/start'), INTERACTIVE),
+    (object(), BULK),
+])
+def test_classify(update, lane):
+    assert classify(update) == lane
+
+
+def test_registration_taps_are_never_shed(monkeypatch):
+    # Любой массовый апдейт сверх нулевой глубины отбрасывается
+    monkeypatch.setenv('SHED_BULK_DEPTH', '0')
+    processor = PriorityUpdateProcessor()
+    handled = []
+
+    async def handle(update):
+        handled.append(update.update_id)
+
+    async def main():
+        updates = [_channel_post(1), _tap(2, 7, 'join_10'), _tap(3, 8, 'leave_10'), _channel_post(4)]
+        await asyncio.gather(*(processor.do_process_update(update, handle(update)) for update in updates))
+
+    asyncio.run(main())
+    assert sorted(handled) == [2, 3]
+    assert processor.shed == 2
+
+
+def test_updates_of_one_user_run_in_order(monkeypatch):
+    monkeypatch.setenv('UPDATE_CONCURRENCY', '4')
+    processor = PriorityUpdateProcessor()
+    events = []
+
+    async def handle(update_id, delay):
+        events.append(('start', update_id))
+        await asyncio.sleep(delay)
+        events.append(('end', update_id))
+
+    async def main():
+        # Без блокировки пользователя поздние нажатия (с меньшей задержкой) закончились бы раньше
+        updates = [_tap(update_id, 7, f'join_{update_id}') for update_id in range(1, 5)]
+        await asyncio.gather(*(
+            processor.do_process_update(update, handle(update.update_id, 0.02 * (5 - update.update_id)))
+            for update in updates
+        ))
+
+    asyncio.run(main())
+    assert events == [(step, update_id) for update_id in range(1, 5) for step in ('start', 'end')]
+    assert processor._user_locks == {}
@@ -0,0 +1,17 @@
+import logging
+
+from bot.logging_config import SamplingFilter
+
+
+def _record(level, **extra):
+    record = logging.LogRecord('bot.game_registration', level, __file__, 1, 'message', None, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_audit_records_are_never_sampled_out():
+    sampling = SamplingFilter({'bot.game_registration': 0.0})
+    assert sampling.filter(_record(logging.INFO, audit=True))
+    assert sampling.filter(_record(logging.WARNING))
+    assert not sampling.filter(_record(logging.INFO))
+    assert not sampling.filter(_record(logging.DEBUG))
@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+
+import pytest
+
+from bot.nicknames import NicknameRegistry, NicknameTaken, normalize_nickname
+
+
+@pytest.mark.parametrize('nickname, key', [
+    ('Shadow', 'shadow'),
+    ('SHADOW', 'shadow'),
+    ('  Dark   Knight\t', 'dark knight'),
+    ('Dark Knight', 'dark knight'),
+    # Кириллица и греческий, похожие на латиницу
+    ('ВОТ', 'bot'),
+    ('Рорa', 'popa'),
+    ('Κοκο', 'koko'),
+    # Полноширинные буквы и лигатуры (NFKC)
+    ('Ｓｈａｄｏｗ', 'shadow'),
+    ('ﬁre', 'fire'),
+    # Прочие буквы не трогаются
+    ('Дракон', 'дpakoh'),
+    ('', ''),
+    (None, ''),
+])
+def test_normalize_nickname(nickname, key):
+    assert normalize_nickname(nickname) == key
+
+
+@pytest.mark.parametrize('first, second', [
+    ('Shadow', 'shadow '),
+    ('BOT', 'ВОТ'),
+    ('Cool Cat', 'cool  сat'),
+])
+def test_lookalike_nicknames_collide(first, second):
+    assert normalize_nickname(first) == normalize_nickname(second)
+
+
+@pytest.fixture
+def registry():
+    owners = [(normalize_nickname('Shadow'), 1), (normalize_nickname('Shadow2'), 2), (normalize_nickname('Ghost'), 3)]
+    registry = NicknameRegistry(SimpleNamespace(get_nickname_owners=lambda: owners))
+    registry.load()
+    return registry
+
+
+def test_availability(registry):
+    assert not registry.is_available('SHADOW')
+    assert not registry.is_available('Ѕhаdоw')
+    assert registry.is_available('shadow', user_id=1)
+    assert registry.is_available('Phantom')
+
+
+@pytest.mark.parametrize('nickname, user_id, suggestions', [
+    ('Shadow', 5, ['Shadow_2', 'Shadow3', 'Shadow_3']),
+    ('  Ghost ', 5, ['Ghost2', 'Ghost_2', 'Ghost3']),
+    # Свой ник пользователю доступен и в вариантах
+    ('Shadow', 2, ['Shadow2', 'Shadow_2', 'Shadow3']),
+])
+def test_suggest_skips_taken_variants(registry, nickname, user_id, suggestions):
+    assert registry.suggest(nickname, user_id) == suggestions
+
+
+def test_claim_rejects_nickname_of_another_user(registry):
+    with pytest.raises(NicknameTaken):
+        registry.claim('shadow', 5)
+    with pytest.raises(NicknameTaken):
+        registry.claim('Ѕhadow', 5)
+    assert not registry.is_available('Shadow', 5)
+
+
+def test_claim_moves_user_to_new_nickname(registry):
+    registry.claim('Shadow', 1)
+    registry.claim('Phantom', 1)
+    assert registry.is_available('Shadow', 5)
+    assert not registry.is_available('phantom', 5)
+    registry.claim('Shadow', 5)
+
+
+def test_remember_and_release_follow_the_database(registry):
+    # База сказала, что ник у другого пользователя: память исправляется без ошибки
+    registry.remember('Ghost', 4)
+    assert not registry.is_available('Ghost', 3)
+    registry.release('Ghost')
+    assert registry.is_available('Ghost', 5)
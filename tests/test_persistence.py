@@ -0,0 +1,224 @@
+import json
+import pickle
+import asyncio
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('telegram')
+pytest.importorskip('sqlalchemy')
+
+from bot.persistence import PostgresPersistence
+
+
+class FakeDatabase:
+    """Методы Database, которыми пользуется persistence, поверх словарей"""
+
+    def __init__(self):
+        self.conversations = {}  # (name, key_json) -> (pickle, updated_at)
+        self.user_data = {}  # user_id -> {key: pickle}
+        self.batches = []
+        self.loads = []
+        self.fail_writes = 0
+
+    def get_conversation_states(self, name):
+        return {key: state for (n, key), (state, _) in self.conversations.items() if n == name}
+
+    def expire_conversation_states(self, name, older_than, flow_keys=()):
+        for (n, key), (_, updated_at) in list(self.conversations.items()):
+            if n == name and updated_at < older_than:
+                del self.conversations[(n, key)]
+                for flow_key in flow_keys:
+                    self.user_data.get(json.loads(key)[1], {}).pop(flow_key, None)
+
+    def get_user_data_entries(self, user_id):
+        self.loads.append(user_id)
+        return dict(self.user_data.get(user_id, {}))
+
+    def save_persistence_batch(self, conversations=(), user_data=None, dropped_users=()):
+        if self.fail_writes:
+            self.fail_writes -= 1
+            raise ConnectionError("database is down")
+        conversations = list(conversations)
+        self.batches.append((conversations, dict(user_data or {}), set(dropped_users)))
+        for name, key, state in conversations:
+            if state is None:
+                self.conversations.pop((name, key), None)
+            else:
+                self.conversations[(name, key)] = (state, datetime.utcnow())
+        for user_id in dropped_users:
+            self.user_data.pop(user_id, None)
+        for user_id, (changed, removed, replace) in (user_data or {}).items():
+            stored = {} if replace else self.user_data.get(user_id, {})
+            for key in removed:
+                stored.pop(key, None)
+            stored.update(changed)
+            self.user_data[user_id] = stored
+
+
+def _unpickled(changed):
+    return {key: pickle.loads(value) for key, value in changed.items()}
+
+
+@pytest.fixture
+def db():
+    return FakeDatabase()
+
+
+@pytest.fixture
+def persistence(db, monkeypatch):
+    monkeypatch.setenv('PERSISTENCE_FLUSH_DELAY', '0.01')
+    return PostgresPersistence(db)
+
+
+def test_user_data_loads_lazily_on_first_update(db, persistence):
+    db.user_data[7] = {'name': pickle.dumps('Old'), 'step': pickle.dumps(2)}
+
+    async def scenario():
+        assert await persistence.get_user_data() == {}
+        assert db.loads == []
+        user_data = {'name': 'Set before load'}
+        await persistence.refresh_user_data(7, user_data)
+        await persistence.refresh_user_data(7, user_data)
+        return user_data
+
+    user_data = asyncio.run(scenario())
+    assert db.loads == [7]
+    assert user_data == {'name': 'Set before load', 'step': 2}
+
+
+def test_flush_writes_only_changed_keys(db, persistence):
+    db.user_data[7] = {'a': pickle.dumps(1), 'b': pickle.dumps(2)}
+
+    async def scenario():
+        await persistence.refresh_user_data(7, {})
+        await persistence.update_user_data(7, {'a': 1, 'b': 3, 'c': 4})
+        await persistence.flush()
+        await persistence.update_user_data(7, {'a': 1, 'b': 3})
+        await persistence.flush()
+        # Ничего не изменилось — записи нет
+        await persistence.update_user_data(7, {'a': 1, 'b': 3})
+        await persistence.flush()
+
+    asyncio.run(scenario())
+    (_, first, _), (_, second, _) = db.batches
+    changed, removed, replace = first[7]
+    assert (_unpickled(changed), removed, replace) == ({'b': 3, 'c': 4}, set(), False)
+    changed, removed, replace = second[7]
+    assert (changed, removed, replace) == ({}, {'c'}, False)
+    assert _unpickled(db.user_data[7]) == {'a': 1, 'b': 3}
+
+
+def test_unloaded_user_is_replaced_whole(db, persistence):
+    db.user_data[7] = {'stale': pickle.dumps(True)}
+
+    async def scenario():
+        await persistence.update_user_data(7, {'fresh': True})
+        await persistence.flush()
+
+    asyncio.run(scenario())
+    (_, users, _), = db.batches
+    assert users[7][2] is True
+    assert _unpickled(db.user_data[7]) == {'fresh': True}
+
+
+def test_changes_of_one_pass_go_out_in_one_batch(db, persistence):
+    async def scenario():
+        for user_id in (1, 2, 3):
+            await persistence.refresh_user_data(user_id, {})
+            await persistence.update_user_data(user_id, {'step': user_id})
+        await persistence.update_conversation('registration', (1, 1), 'NAME')
+        await persistence.drop_user_data(3)
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+    (conversations, users, dropped), = db.batches
+    assert conversations == [('registration', '[1, 1]', pickle.dumps('NAME'))]
+    assert set(users) == {1, 2}
+    assert dropped == {3}
+
+
+def test_failed_flush_keeps_changes(db, persistence):
+    db.fail_writes = 1
+
+    async def scenario():
+        await persistence.refresh_user_data(7, {})
+        await persistence.update_user_data(7, {'step': 1})
+        await persistence.update_conversation('registration', (7, 7), 'NAME')
+        with pytest.raises(ConnectionError):
+            await persistence.flush()
+        await persistence.update_user_data(7, {'step': 2})
+        await persistence.flush()
+
+    asyncio.run(scenario())
+    (conversations, users, _), = db.batches
+    assert conversations == [('registration', '[7, 7]', pickle.dumps('NAME'))]
+    assert _unpickled(db.user_data[7]) == {'step': 2}
+
+
+def test_conversation_resumes_after_restart(db, persistence):
+    async def before_restart():
+        await persistence.refresh_user_data(7, {})
+        await persistence.update_user_data(7, {'registration': {'name': 'Ann'}})
+        await persistence.update_conversation('registration', (7, 7), 'NICKNAME')
+        await persistence.update_conversation('registration', (8, 8), 'NAME')
+        await persistence.update_conversation('registration', (8, 8), None)
+        await persistence.flush()
+
+    async def after_restart():
+        restarted = PostgresPersistence(db)
+        conversations = await restarted.get_conversations('registration')
+        user_data = {}
+        await restarted.refresh_user_data(7, user_data)
+        return restarted, conversations, user_data
+
+    asyncio.run(before_restart())
+    restarted, conversations, user_data = asyncio.run(after_restart())
+    assert conversations == {(7, 7): 'NICKNAME'}
+    assert user_data == {'registration': {'name': 'Ann'}}
+    assert restarted.stats() == {'resident_users': 1, 'conversations': 1}
+
+
+def test_least_recently_active_users_are_evicted(db, monkeypatch):
+    monkeypatch.setenv('USER_DATA_MAX_RESIDENT', '10')
+    persistence = PostgresPersistence(db)
+    users = {user_id: {} for user_id in range(1, 12)}
+
+    async def scenario():
+        for user_id in range(1, 11):
+            await persistence.refresh_user_data(user_id, users[user_id])
+            await persistence.update_user_data(user_id, {'step': user_id})
+            users[user_id]['step'] = user_id
+        await persistence.flush()
+        # Пользователь 1 снова активен; 2 изменил данные после последней записи
+        await persistence.refresh_user_data(1, users[1])
+        users[2]['step'] = 'unsaved'
+        await persistence.refresh_user_data(11, users[11])
+        # Запоздалая запись пустой копии выгруженного пользователя игнорируется
+        await persistence.update_user_data(2, {})
+        await persistence.flush()
+        reloaded = {}
+        await persistence.refresh_user_data(2, reloaded)
+        return reloaded
+
+    reloaded = asyncio.run(scenario())
+    # До 90% лимита выгружены самые давние: 2 и 3, но не снова активный 1
+    assert list(persistence._resident) == [4, 5, 6, 7, 8, 9, 10, 1, 11, 2]
+    assert users[2] == {} and users[3] == {}
+    assert users[1] == {'step': 1}
+    assert _unpickled(db.user_data[2]) == {'step': 'unsaved'}
+    assert reloaded == {'step': 'unsaved'}
+
+
+def test_stale_conversations_expire_on_load(db, persistence, monkeypatch):
+    monkeypatch.setenv('CONVERSATION_TIMEOUT', '900')
+    long_ago = datetime(2020, 1, 1)
+    db.conversations[('registration', '[7, 7]')] = (pickle.dumps('NAME'), long_ago)
+    db.conversations[('registration', '[8, 8]')] = (pickle.dumps('NAME'), datetime.utcnow())
+    db.user_data[7] = {'registration': pickle.dumps({'name': 'Ann'}), 'is_editing': pickle.dumps(False),
+                       'game_picker': pickle.dumps({'picked': []})}
+
+    conversations = asyncio.run(persistence.get_conversations('registration'))
+    assert conversations == {(8, 8): 'NAME'}
+    # Ключи брошенного диалога удалены, остальные данные пользователя — нет
+    assert set(db.user_data[7]) == {'game_picker'}
@@ -0,0 +1,143 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+pytest.importorskip('telegram')
+
+from sqlalchemy import create_engine, text
+from telegram.constants import ChatType
+
+from bot.query_budget import QueryBudget, QueryBudgetExceeded, budget_mode, install_query_counter, query_budget
+
+USER_ID = 910_000_000
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite://')
+    install_query_counter(engine)
+    yield engine
+    engine.dispose()
+
+
+def _run_queries(engine, count):
+    with engine.connect() as conn:
+        for _ in range(count):
+            conn.execute(text("SELECT 1"))
+
+
+def test_tests_run_in_raise_mode():
+    assert budget_mode() == 'raise'
+
+
+def test_budget_over_limit_raises(engine):
+    with pytest.raises(QueryBudgetExceeded, match="3 SQL-запросов при бюджете 2"):
+        with QueryBudget(2, 'block'):
+            _run_queries(engine, 3)
+
+
+def test_budget_within_limit_counts_queries(engine):
+    with QueryBudget(2, 'outer') as outer:
+        with QueryBudget(1, 'inner') as inner:
+            _run_queries(engine, 1)
+        _run_queries(engine, 1)
+    assert (inner.count, outer.count) == (1, 2)
+
+
+def test_decorated_handler_over_budget_raises(engine):
+    @query_budget(1)
+    async def handler():
+        _run_queries(engine, 2)
+
+    with pytest.raises(QueryBudgetExceeded):
+        asyncio.run(handler())
+
+
+# Обработчики с реальной базой: бюджеты в декораторах должны выдерживаться
+
+class FakeQuery:
+    def __init__(self, user_id, data, chat_type=ChatType.PRIVATE):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.data = data
+        self.message = SimpleNamespace(chat=SimpleNamespace(type=chat_type))
+        self.texts = []
+
+    async def answer(self, text=None, show_alert=False, url=None):
+        if text:
+            self.texts.append(text)
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.texts.append(text)
+
+    async def edit_message_reply_markup(self, reply_markup=None):
+        pass
+
+
+class FakeMessage:
+    def __init__(self):
+        self.texts = []
+
+    async def reply_text(self, text, reply_markup=None):
+        self.texts.append(text)
+
+
+@pytest.fixture
+def manager(database):
+    from bot.game_registration import GameRegistrationManager
+
+    database.add_user({
+        'user_id': USER_ID,
+        'name': 'Budget',
+        'game_nickname': 'budget',
+        'registration_complete': True,
+    })
+    announcements = SimpleNamespace(outbox=SimpleNamespace(notify=lambda: None), join_link=lambda game_id: None)
+    return GameRegistrationManager(database, announcements)
+
+
+def _create_games(db, count):
+    return [
+        db.create_game_announcement({
+            'title': f'Budget {i}',
+            'game_date': datetime.now() + timedelta(days=i + 1),
+            'max_players': 1,
+            'created_by': USER_ID,
+            'is_published': True,
+        }).id
+        for i in range(count)
+    ]
+
+
+def _update(message=None, query=None):
+    return SimpleNamespace(update_id=1, message=message, callback_query=query, effective_user=SimpleNamespace(id=USER_ID))
+
+
+def test_show_games_list_within_budget(manager):
+    _create_games(manager.db, 3)
+    message = FakeMessage()
+    context = SimpleNamespace(user_data={})
+    asyncio.run(manager.show_games_list(_update(message=message), context))
+    assert len(message.texts) == 4
+    assert len(context.user_data['game_picker']['games']) == 3
+
+
+def test_handle_picker_callback_within_budget(manager):
+    game_ids = _create_games(manager.db, 3)
+    context = SimpleNamespace(user_data={'game_picker': {'games': [(i, str(i)) for i in game_ids], 'picked': []}})
+    asyncio.run(manager.handle_picker_callback(_update(query=FakeQuery(USER_ID, f'pick_{game_ids[0]}')), context))
+    context.user_data['game_picker']['picked'] = list(game_ids)
+    asyncio.run(manager.handle_picker_callback(_update(query=FakeQuery(USER_ID, 'pickdone')), context))
+    assert all(manager.db.is_user_registered(game_id, USER_ID) for game_id in game_ids)
+
+
+@pytest.mark.parametrize('chat_type', [ChatType.PRIVATE, ChatType.CHANNEL])
+def test_handle_registration_callback_within_budget(manager, chat_type):
+    game_id, = _create_games(manager.db, 1)
+    for data in (f'join_{game_id}', f'leave_{game_id}'):
+        query = FakeQuery(USER_ID, data, chat_type)
+        asyncio.run(manager.handle_registration_callback(_update(query=query), None))
+        assert query.texts
+    assert not manager.db.is_user_registered(game_id, USER_ID)
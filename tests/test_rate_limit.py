@@ -0,0 +1,133 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from bot import rate_limit
+from bot.rate_limit import FloodGuard, TelegramRateLimiter, TokenBucket
+
+
+class FakeClock:
+    """time.monotonic и asyncio.sleep модуля rate_limit: время идет только вручную или во сне"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    async def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    monkeypatch.setattr(rate_limit, 'asyncio', SimpleNamespace(sleep=clock.sleep))
+    return clock
+
+
+@pytest.fixture
+def guard(clock, monkeypatch):
+    for name, value in {
+        'FLOOD_USER_RATE': '1', 'FLOOD_USER_BURST': '3',
+        'FLOOD_GAME_RATE': '2', 'FLOOD_GAME_BURST': '4',
+        'FLOOD_COMMAND_RATE': '0.5', 'FLOOD_COMMAND_BURST': '2',
+        'FLOOD_WARN_INTERVAL': '30', 'FLOOD_DEDUPE_TTL': '2',
+    }.items():
+        monkeypatch.setenv(name, value)
+    return FloodGuard()
+
+
+def test_bucket_burst_and_refill(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.delay_for() == pytest.approx(0.5)
+    clock.advance(0.5)
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    # Простой не копит больше capacity
+    clock.advance(60)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_bucket_block(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+    bucket.block(5)
+    assert not bucket.try_acquire()
+    assert bucket.delay_for() == pytest.approx(5)
+    clock.advance(5)
+    assert bucket.try_acquire()
+
+
+def test_telegram_limiter_waits_per_chat(clock, monkeypatch):
+    monkeypatch.setenv('TELEGRAM_CHAT_RATE_PER_MIN', '60')
+    monkeypatch.setenv('TELEGRAM_CHAT_BURST', '2')
+    limiter = TelegramRateLimiter()
+
+    async def send(chat_ids):
+        for chat_id in chat_ids:
+            await limiter.acquire(chat_id)
+
+    asyncio.run(send([1, 1, 2, 2]))
+    assert clock.slept == []
+    # Третье сообщение в чат ждет пополнения его bucket'а (1 в секунду)
+    asyncio.run(send([1]))
+    assert sum(clock.slept) == pytest.approx(1)
+
+
+def test_telegram_limiter_retry_after_freezes_only_that_chat(clock):
+    limiter = TelegramRateLimiter()
+    limiter.retry_after(1, 10)
+    assert not limiter._chat_bucket('1').try_acquire()
+    assert limiter._chat_bucket('2').try_acquire()
+    asyncio.run(limiter.acquire(1))
+    assert sum(clock.slept) >= 10
+
+
+def test_flood_guard_user_burst_and_refill(guard, clock):
+    assert [guard.check(7) for _ in range(4)] == [None, None, None, 'user']
+    clock.advance(1)
+    assert guard.check(7) is None
+    assert guard.check(8) is None
+    assert guard.rejected['user'] == 1
+
+
+def test_flood_guard_game_bucket_is_shared(guard, clock):
+    results = [guard.check(user_id, game_id=10) for user_id in range(5)]
+    assert results == [None, None, None, None, 'game']
+    assert guard.check(99, game_id=11) is None
+
+
+def test_flood_guard_dedupes_double_taps(guard, clock):
+    assert guard.check(7, dedupe_key='join_10') is None
+    assert guard.check(7, dedupe_key='join_10') == 'duplicate'
+    assert guard.check(7, dedupe_key='leave_10') is None
+    clock.advance(2)
+    assert guard.check(7, dedupe_key='join_10') is None
+
+
+def test_command_bucket_is_isolated_from_taps(guard, clock):
+    # Нажатия выбрали лимит пользователя — команды все еще проходят, и наоборот
+    assert [guard.check(7) for _ in range(4)][-1] == 'user'
+    assert [guard.check_command(7) for _ in range(3)] == [None, None, 'command']
+    assert guard.check_command(8) is None
+    clock.advance(2)
+    assert guard.check_command(7) is None
+    assert guard.rejected['command'] == 1
+
+
+def test_throttled_commands_are_answered_once_per_interval(guard, clock):
+    for _ in range(2):
+        guard.check_command(7)
+    warnings = [guard.check_command(7) == 'command' and guard.should_warn(7) for _ in range(5)]
+    assert warnings == [True, False, False, False, False]
+    assert guard.should_warn(8)
+    clock.advance(30)
+    assert guard.should_warn(7)
@@ -0,0 +1,117 @@
+"""Параллельные записи на одну игру не переполняют основу (нужен TEST_DATABASE_URL, см. conftest)"""
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+USER_ID_BASE = 900_000_000
+PLAYERS = 12
+MAX_PLAYERS = 3
+ROUNDS = 5
+
+
+@pytest.fixture
+def db(database):
+    for i in range(PLAYERS):
+        database.add_user({
+            'user_id': USER_ID_BASE + i,
+            'name': f'Test {i}',
+            'game_nickname': f'test_{i}',
+            'registration_complete': True,
+        })
+    return database
+
+
+def _create_game(db):
+    return db.create_game_announcement({
+        'title': 'Concurrency',
+        'game_date': datetime.now() + timedelta(days=1),
+        'max_players': MAX_PLAYERS,
+        'created_by': USER_ID_BASE,
+        'is_published': True,
+    }).id
+
+
+def test_parallel_registrations_never_overbook_main(db):
+    for _ in range(ROUNDS):
+        game_id = _create_game(db)
+        barrier = threading.Barrier(PLAYERS)
+        errors = []
+
+        def register(index):
+            user_id = USER_ID_BASE + index
+            barrier.wait()
+            try:
+                # Пачка и одиночная запись вперемешку: обе должны считать места под блокировкой
+                if index % 2:
+                    db.register_for_games([game_id], user_id)
+                else:
+                    db.register_for_game(game_id, user_id)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=register, args=(i,)) for i in range(PLAYERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not errors
+        registrations = db.get_game_registrations(game_id)
+        main = [r for r in registrations if not r.is_reserve]
+        positions = [r.queue_position for r in registrations]
+        assert len(registrations) == PLAYERS
+        assert len(main) == MAX_PLAYERS
+        assert len(set(positions)) == PLAYERS
+        # В основе — первые по очереди
+        assert max(r.queue_position for r in main) < min(r.queue_position for r in registrations if r.is_reserve)
+
+
+def _run_parallel(actions):
+    """Запуск действий одновременно (через барьер); возвращает результаты и ошибки"""
+    barrier = threading.Barrier(len(actions))
+    results, errors = [None] * len(actions), []
+
+    def run(index):
+        barrier.wait()
+        try:
+            results[index] = actions[index]()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(actions))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_double_taps_create_one_registration(db):
+    game_id = _create_game(db)
+    results, errors = _run_parallel([lambda: db.register_for_game(game_id, USER_ID_BASE)] * PLAYERS)
+
+    assert not errors
+    assert sum(result is not None for result in results) == 1
+    assert len(db.get_game_registrations(game_id)) == 1
+
+
+def test_parallel_leave_and_join_keep_main_full(db):
+    for _ in range(ROUNDS):
+        game_id = _create_game(db)
+        # Основа 0..2, резерв 3..5; основа уходит, одновременно записываются 6..8
+        for i in range(2 * MAX_PLAYERS):
+            db.register_for_game(game_id, USER_ID_BASE + i)
+        leaving = [USER_ID_BASE + i for i in range(MAX_PLAYERS)]
+        joining = [USER_ID_BASE + i for i in range(2 * MAX_PLAYERS, 3 * MAX_PLAYERS)]
+        actions = [lambda user_id=user_id: db.unregister_from_game(game_id, user_id) for user_id in leaving]
+        actions += [lambda user_id=user_id: db.register_for_game(game_id, user_id) for user_id in joining]
+        _, errors = _run_parallel(actions)
+
+        assert not errors
+        registrations = db.get_game_registrations(game_id)
+        main = [r for r in registrations if not r.is_reserve]
+        assert len(registrations) == 2 * MAX_PLAYERS
+        assert len(main) == MAX_PLAYERS
+        # Продвинуты бывшие резервисты, а не опоздавшие
+        assert {r.user_id for r in main} == {USER_ID_BASE + i for i in range(MAX_PLAYERS, 2 * MAX_PLAYERS)}
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from bot.replicas import is_write
+
+NO_DML = SimpleNamespace(isinsert=False, isupdate=False, isdelete=False)
+
+
+@pytest.mark.parametrize('statement', [
+    "SELECT id FROM game_announcements WHERE id = 1",
+    "WITH ranked AS (SELECT id FROM game_registrations) SELECT count(*) FROM ranked",
+])
+def test_reads_are_not_writes(statement):
+    assert not is_write(statement, NO_DML)
+
+
+@pytest.mark.parametrize('statement', [
+    "UPDATE game_announcements SET queue_seq = 1",
+    # CTE-записи: _rebalance_roster, compact_queue_positions, register_for_games
+    """WITH target AS (
+           UPDATE game_announcements g SET queue_seq = coalesce(g.queue_seq, 0) + 1
+           WHERE g.id IN (1) RETURNING g.id
+       )
+       SELECT id FROM target""",
+    """WITH placed AS (SELECT 1 AS game_id)
+       INSERT INTO game_registrations (game_id) SELECT game_id FROM placed""",
+    "  with doomed as (select id from outbox_events) delete from outbox_events using doomed",
+])
+def test_cte_and_text_writes_are_writes(statement):
+    assert is_write(statement, NO_DML)
+
+
+def test_compiled_dml_flags_are_writes():
+    context = SimpleNamespace(isinsert=False, isupdate=True, isdelete=False)
+    assert is_write("WITH x AS (SELECT 1) SELECT 1", context)
@@ -0,0 +1,22 @@
+from bot.templates import validate_html, validate_template_html, _markup_value
+
+
+def test_valid_telegram_markup_passes():
+    assert validate_html('<b>Игра</b> <a href="https://t.me/x">ссылка</a> &lt;3 <span class="tg-spoiler">!</span>') == ()
+
+
+def test_unbalanced_and_unknown_tags_are_rejected():
+    assert validate_html('<b>жирный <i>курсив</b></i>')
+    assert validate_html('<div>блок</div>')
+    assert validate_html('<b>не закрыт')
+    assert validate_html('1 < 2 & 3')
+
+
+def test_placeholders_are_not_checked_as_markup():
+    assert validate_template_html('<b>{{title}}</b>\n{{players_list}}') == []
+    assert validate_template_html('<b>{{title}}') == ['тег <b> не закрыт']
+
+
+def test_admin_text_keeps_valid_markup_and_escapes_the_rest():
+    assert _markup_value('<b>Финал</b>') == '<b>Финал</b>'
+    assert _markup_value('Мафия <3 & друзья') == 'Мафия &lt;3 &amp; друзья'
@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip('telegram')
+
+from telegram.error import Forbidden, NetworkError, RetryAfter
+
+from bot.notifications import NotificationWorker
+from bot.outbox import OutboxWorker
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.retries = []
+
+    def retry_outbox_event(self, event, error, delay, give_up=False):
+        self.retries.append((event['id'], delay, give_up))
+
+    def retry_notification(self, notification, error, delay, give_up=False):
+        self.retries.append((notification['id'], delay, give_up))
+
+
+def _item(attempts):
+    return {'id': 1, 'kind': 'reminder', 'game_id': 2, 'user_id': 3, 'attempts': attempts}
+
+
+def test_retry_settings_are_separate(monkeypatch):
+    monkeypatch.setenv('OUTBOX_RETRY_BASE_DELAY', '1')
+    monkeypatch.setenv('NOTIFY_RETRY_BASE_DELAY', '10')
+    monkeypatch.setenv('NOTIFY_RETRY_MAX_DELAY', '15')
+    outbox = OutboxWorker(FakeDatabase(), announcement_manager=None)
+    notifications = NotificationWorker(FakeDatabase(), bot=None, rate_limiter=None)
+    assert (outbox.base_delay, outbox.max_delay, outbox.coalesce_delay) == (1.0, 300.0, 0.2)
+    assert (notifications.base_delay, notifications.max_delay, notifications.coalesce_delay) == (10.0, 15.0, 0.0)
+
+
+@pytest.mark.parametrize('error, attempts, delay_range, give_up', [
+    (NetworkError('timeout'), 1, (1.6, 2.4), False),
+    (NetworkError('timeout'), 3, (6.4, 9.6), False),
+    (NetworkError('timeout'), 20, (240, 360), False),
+    (RetryAfter(7), 1, (7, 7), False),
+    (Forbidden('bot was blocked by the user'), 1, (1.6, 2.4), True),
+    (NetworkError('timeout'), 30, (240, 360), True),
+])
+def test_schedule_retry_backoff(error, attempts, delay_range, give_up):
+    db = FakeDatabase()
+    worker = OutboxWorker(db, announcement_manager=None)
+    worker.max_attempts = 30
+    worker._schedule_retry(_item(attempts), error)
+    (_, delay, gave_up), = db.retries
+    assert delay_range[0] <= delay <= delay_range[1]
+    assert gave_up == give_up